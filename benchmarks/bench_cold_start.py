@@ -0,0 +1,123 @@
+"""Tempi di avvio del servizio: import del modulo e tempo fino alla prima risposta.
+
+Per l'import esegue N interpreti nuovi che importano talk2db_service; per
+l'avvio completo lancia il servizio (uvicorn --factory) su un database SQLite
+generato e il finto LLM, e misura quando il processo accetta connessioni,
+quando /ready risponde 200 e quando arriva la prima risposta a /question, con
+e senza riscaldamento. Con --json i risultati si possono salvare e confrontare
+tra una versione e l'altra.
+
+Uso: python benchmarks/bench_cold_start.py --runs 5 --tables 500
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+import httpx
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from bench_e2e import ROOT, build_corpus, build_database, free_port, wait_ready  # noqa: E402
+
+IMPORT_SNIPPET = (
+    "import time; start = time.perf_counter(); import talk2db_service; "
+    "print(time.perf_counter() - start)"
+)
+QUESTION = "Quanti record ci sono?"
+
+
+def measure_import(runs):
+    """Secondi per importare talk2db_service in un interprete nuovo."""
+    timings = []
+    for _ in range(runs):
+        output = subprocess.run(
+            [sys.executable, "-c", IMPORT_SNIPPET], cwd=ROOT, capture_output=True, text=True, check=True
+        ).stdout
+        timings.append(float(output.strip().splitlines()[-1]))
+    return timings
+
+
+def measure_startup(db_path, corpus_path, warmup, llm_latency):
+    """Secondi dal lancio del processo a: porta aperta, /ready 200, prima risposta a /question."""
+    llm_port, service_port = free_port(), free_port()
+    llm = subprocess.Popen(
+        [sys.executable, os.path.join(ROOT, "benchmarks", "fake_llm_server.py"), "--corpus", corpus_path,
+         "--port", str(llm_port), "--latency", str(llm_latency)],
+    )
+    env = dict(
+        os.environ,
+        T2DB_DB_URL=f"sqlite:///{db_path}",
+        T2DB_OAI_BASE_URL=f"http://127.0.0.1:{llm_port}/v1",
+        T2DB_OAI_API_TOKEN="bench",
+        T2DB_WARMUP="1" if warmup else "0",
+        T2DB_QUESTION_CACHE_SIZE="0",
+    )
+    url = f"http://127.0.0.1:{service_port}"
+    try:
+        wait_ready(f"http://127.0.0.1:{llm_port}/health", llm)
+        start = time.perf_counter()
+        service = subprocess.Popen(
+            [sys.executable, "-m", "uvicorn", "--factory", "talk2db_service:create_app", "--host", "127.0.0.1",
+             "--port", str(service_port), "--log-level", "warning"],
+            cwd=ROOT, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+        )
+        try:
+            wait_ready(f"{url}/health", service)
+            listening = time.perf_counter() - start
+            wait_ready(f"{url}/ready", service)
+            ready = time.perf_counter() - start
+            response = httpx.post(f"{url}/question", json={"question": QUESTION}, timeout=None)
+            response.raise_for_status()
+            first_answer = time.perf_counter() - start
+        finally:
+            service.terminate()
+            service.wait(10)
+    finally:
+        llm.terminate()
+        llm.wait(10)
+    return {"listening": listening, "ready": ready, "first_answer": first_answer}
+
+
+def summary(values):
+    return f"{statistics.median(values):8.3f} {min(values):8.3f} {max(values):8.3f}"
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Tempi di avvio di talk2db_service")
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--tables", type=int, default=500)
+    parser.add_argument("--rows", type=int, default=100)
+    parser.add_argument("--llm-latency", type=float, default=0, help="Latenza del finto LLM in ms")
+    parser.add_argument("--json", help="Salva i risultati in questo file")
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix="t2db_cold_")
+    db_path = os.path.join(workdir, "bench.db")
+    build_database(db_path, args.tables, 6, args.rows, 50)
+    corpus_path = os.path.join(workdir, "corpus.json")
+    with open(corpus_path, "w", encoding="utf-8") as f:
+        json.dump(build_corpus([QUESTION], args.tables), f)
+
+    report = {"config": vars(args), "import": measure_import(args.runs), "startup": {}}
+    print(f"{'secondi':<36} {'mediana':>8} {'min':>8} {'max':>8}")
+    print(f"{'import talk2db_service':<36} {summary(report['import'])}")
+    for warmup in (False, True):
+        runs = [measure_startup(db_path, corpus_path, warmup, args.llm_latency) for _ in range(args.runs)]
+        label = "con riscaldamento" if warmup else "senza riscaldamento"
+        report["startup"][label] = runs
+        for phase in ("listening", "ready", "first_answer"):
+            print(f"{phase + ' (' + label + ')':<36} {summary([run[phase] for run in runs])}")
+
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
+        print(f"\nRisultati salvati in {args.json}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,325 @@
+"""Benchmark end-to-end offline di talk2db_service: nessun SQL Server e nessun
+LLM a pagamento.
+
+Genera un database SQLite (tabelle collegate da FK, righe e procedure
+simulate), avvia il finto LLM (fake_llm_server.py) e il servizio con
+T2DB_DB_URL, poi invia le domande di un corpus a vari livelli di
+concorrenza. Per ogni livello riporta latenza p50/p95/p99, throughput e
+picco di RSS del processo del servizio; per ogni fase (dall'header
+Server-Timing) i percentili della durata.
+
+Uso: python benchmarks/bench_e2e.py --tables 200 --rows 2000 --concurrency 1,8,32 --requests 200
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+import httpx
+from sqlalchemy import create_engine, text
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+
+# Query "generate" dal finto LLM, a rotazione sulle tabelle del database
+SQL_TEMPLATES = [
+    "SELECT COUNT(*) AS Totale FROM {table}",
+    "SELECT t.Id AS Id, t.Nome AS Nome, t.Importo AS Importo FROM {table} t WHERE t.Importo > 500 ORDER BY t.Importo DESC",
+    "SELECT p.Nome AS NomePadre, COUNT(*) AS Figli FROM {table} c JOIN {parent} p ON p.Id = c.{parent}Id GROUP BY p.Nome",
+    "SELECT t.Id AS Id, t.Nome AS Nome, t.Data AS Data FROM {table} t ORDER BY t.Id",
+    "SELECT t.Data AS Data, SUM(t.Importo) AS Totale FROM {table} t GROUP BY t.Data ORDER BY t.Data",
+]
+
+
+def build_database(path, table_count, column_count, row_count, procedure_count):
+    """Crea il database SQLite: tabelle con FK verso la precedente, righe generate e procedure simulate."""
+    engine = create_engine(f"sqlite:///{path}")
+    with engine.begin() as connection:
+        for i in range(table_count):
+            columns = ["Id INTEGER PRIMARY KEY", "Nome VARCHAR(50)", "Importo DECIMAL(12,2)", "Data DATE"]
+            columns += [f"Campo{j} VARCHAR(50)" for j in range(column_count)]
+            columns += ["DataCreazione DATETIME", "UtenteModifica VARCHAR(50)"]
+            values = ["'Nome ' || i", "(i * 37) % 1000", "date('2024-01-01', '+' || (i % 365) || ' days')"]
+            values += [f"'valore {j} ' || (i % 50)" for j in range(column_count)]
+            values += ["datetime('now')", "'bench'"]
+            if i > 0:
+                columns.append(f"Tabella{i - 1:04d}Id INTEGER REFERENCES Tabella{i - 1:04d}(Id)")
+                values.append(f"1 + i % {row_count}")
+            connection.execute(text(f"CREATE TABLE Tabella{i:04d} ({', '.join(columns)})"))
+            connection.execute(text(
+                f"INSERT INTO Tabella{i:04d} "
+                f"WITH RECURSIVE r(i) AS (SELECT 1 UNION ALL SELECT i + 1 FROM r WHERE i < {row_count}) "
+                f"SELECT i, {', '.join(values)} FROM r"
+            ))
+        connection.execute(text(
+            "CREATE TABLE t2db_procedures (procedure_name TEXT, position INTEGER, parameter_name TEXT, data_type TEXT)"
+        ))
+        for i in range(procedure_count):
+            for position, (name, data_type) in enumerate([("IdCliente", "int"), ("DataInizio", "date")][:i % 3]):
+                connection.execute(
+                    text("INSERT INTO t2db_procedures VALUES (:proc, :position, :name, :type)"),
+                    {"proc": f"sp_Elaborazione{i:04d}", "position": position, "name": name, "type": data_type},
+                )
+            if i % 3 == 0:
+                connection.execute(
+                    text("INSERT INTO t2db_procedures VALUES (:proc, 0, NULL, NULL)"), {"proc": f"sp_Elaborazione{i:04d}"}
+                )
+    engine.dispose()
+
+
+def load_questions(path):
+    """Domande del corpus: una per riga, oppure JSON per riga con "question" o "title" (es. requests.jsonl)."""
+    questions = []
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                item = json.loads(line)
+                line = item.get("question") or item.get("title") if isinstance(item, dict) else line
+            except ValueError:
+                pass
+            if line:
+                # La domanda viaggia su una sola riga del prompt
+                questions.append(" ".join(str(line).split()))
+    return questions
+
+
+def build_corpus(questions, table_count):
+    """Associa a ogni domanda una SQL valida sul database generato."""
+    corpus = {}
+    for index, question in enumerate(questions):
+        table = max(index % table_count, 1) if table_count > 1 else 0
+        template = SQL_TEMPLATES[index % len(SQL_TEMPLATES)]
+        if "{parent}" in template and table_count < 2:
+            template = SQL_TEMPLATES[0]
+        corpus[question] = template.format(table=f"Tabella{table:04d}", parent=f"Tabella{table - 1:04d}")
+    return corpus
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def wait_ready(url, process, timeout=60):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"Il processo per {url} e' terminato (codice {process.returncode})")
+        try:
+            if httpx.get(url, timeout=1).status_code == 200:
+                return
+        except httpx.HTTPError:
+            pass
+        time.sleep(0.2)
+    raise RuntimeError(f"{url} non risponde dopo {timeout} s")
+
+
+def rss_mb(pid):
+    """RSS corrente del processo in MB (Linux, da /proc); None se non disponibile."""
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        return None
+    return None
+
+
+def parse_server_timing(header):
+    """{fase: ms} dall'header Server-Timing."""
+    stages = {}
+    for part in (header or "").split(","):
+        fields = part.strip().split(";")
+        for field in fields[1:]:
+            if field.startswith("dur="):
+                stages[fields[0]] = float(field[4:])
+    return stages
+
+
+def percentile(values, p):
+    """Percentile con il metodo nearest-rank."""
+    if not values:
+        return float("nan")
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, max(0, int(round(p / 100 * len(ordered) + 0.5)) - 1))]
+
+
+async def run_level(url, questions, concurrency, total, pid):
+    semaphore = asyncio.Semaphore(concurrency)
+    results = []
+    peak = {"rss": rss_mb(pid)}
+    done = asyncio.Event()
+
+    async def sample_rss():
+        while not done.is_set():
+            current = rss_mb(pid)
+            if current is not None and (peak["rss"] is None or current > peak["rss"]):
+                peak["rss"] = current
+            await asyncio.sleep(0.02)
+
+    async def ask(client, question):
+        async with semaphore:
+            start = time.perf_counter()
+            response = await client.post(f"{url}/question", json={"question": question})
+            results.append((
+                (time.perf_counter() - start) * 1000,
+                response.status_code,
+                parse_server_timing(response.headers.get("server-timing")),
+            ))
+
+    sampler = asyncio.create_task(sample_rss())
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+    async with httpx.AsyncClient(timeout=None, limits=limits) as client:
+        start = time.perf_counter()
+        await asyncio.gather(*(ask(client, questions[i % len(questions)]) for i in range(total)))
+        elapsed = time.perf_counter() - start
+    done.set()
+    await sampler
+    return results, elapsed, peak["rss"]
+
+
+def report_level(concurrency, results, elapsed, peak_rss):
+    latencies = [latency for latency, _, _ in results]
+    errors = sum(1 for _, status, _ in results if status != 200)
+    rss = f"{peak_rss:8.1f}" if peak_rss is not None else "     n/d"
+    print(
+        f"{concurrency:>5} {len(results):>7} {errors:>6} {len(results) / elapsed:>9.1f} "
+        f"{percentile(latencies, 50):>9.1f} {percentile(latencies, 95):>9.1f} {percentile(latencies, 99):>9.1f} {rss}"
+    )
+    return {
+        "concurrency": concurrency,
+        "requests": len(results),
+        "errors": errors,
+        "throughput_rps": round(len(results) / elapsed, 2),
+        "p50_ms": percentile(latencies, 50),
+        "p95_ms": percentile(latencies, 95),
+        "p99_ms": percentile(latencies, 99),
+        "peak_rss_mb": peak_rss,
+    }
+
+
+def report_stages(level_results):
+    """Percentili per fase di tutte le richieste di un livello."""
+    stages = {}
+    for _, _, timings in level_results:
+        for name, ms in timings.items():
+            stages.setdefault(name, []).append(ms)
+    summary = {}
+    for name, values in stages.items():
+        summary[name] = {
+            "count": len(values),
+            "p50_ms": percentile(values, 50),
+            "p95_ms": percentile(values, 95),
+            "p99_ms": percentile(values, 99),
+        }
+        print(f"      {name:<16} {len(values):>6} {summary[name]['p50_ms']:>9.1f} "
+              f"{summary[name]['p95_ms']:>9.1f} {summary[name]['p99_ms']:>9.1f}")
+    return summary
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark end-to-end offline del servizio talk2db")
+    parser.add_argument("--tables", type=int, default=200)
+    parser.add_argument("--columns", type=int, default=6, help="Colonne aggiuntive per tabella")
+    parser.add_argument("--rows", type=int, default=2000, help="Righe per tabella")
+    parser.add_argument("--procedures", type=int, default=50, help="Procedure simulate")
+    parser.add_argument("--questions", default=os.path.join(ROOT, "requests.jsonl"),
+                        help="Corpus di domande (testo o JSON per riga)")
+    parser.add_argument("--concurrency", default="1,8,32", help="Livelli di concorrenza separati da virgola")
+    parser.add_argument("--requests", type=int, default=200, help="Richieste per livello")
+    parser.add_argument("--llm-latency", type=float, default=300, help="Latenza media del finto LLM in ms")
+    parser.add_argument("--llm-jitter", type=float, default=100)
+    parser.add_argument("--llm-error-rate", type=float, default=0.0)
+    parser.add_argument("--no-cache", action="store_true", help="Disattiva le cache di domande e risultati")
+    parser.add_argument("--env", action="append", default=[], help="Variabile aggiuntiva per il servizio, NOME=valore")
+    parser.add_argument("--json", help="Salva i risultati in questo file")
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    random.seed(args.seed)
+    workdir = tempfile.mkdtemp(prefix="t2db_bench_")
+    db_path = os.path.join(workdir, "bench.db")
+    start = time.perf_counter()
+    build_database(db_path, args.tables, args.columns, args.rows, args.procedures)
+    print(f"Database generato in {time.perf_counter() - start:.1f} s: {args.tables} tabelle x {args.rows} righe, "
+          f"{args.procedures} procedure ({db_path})")
+
+    questions = load_questions(args.questions)
+    corpus_path = os.path.join(workdir, "corpus.json")
+    with open(corpus_path, "w", encoding="utf-8") as f:
+        json.dump(build_corpus(questions, args.tables), f, ensure_ascii=False, indent=1)
+
+    llm_port, service_port = free_port(), free_port()
+    llm = subprocess.Popen(
+        [sys.executable, os.path.join(ROOT, "benchmarks", "fake_llm_server.py"), "--corpus", corpus_path,
+         "--port", str(llm_port), "--latency", str(args.llm_latency), "--jitter", str(args.llm_jitter),
+         "--error-rate", str(args.llm_error_rate)],
+    )
+    env = dict(
+        os.environ,
+        T2DB_DB_URL=f"sqlite:///{db_path}",
+        T2DB_OAI_BASE_URL=f"http://127.0.0.1:{llm_port}/v1",
+        T2DB_OAI_API_TOKEN="bench",
+        T2DB_HF_API_URL=f"http://127.0.0.1:{llm_port}/hf",
+        T2DB_HF_API_TOKEN="bench",
+        T2DB_ADMIN_TOKEN="",
+    )
+    if args.no_cache:
+        env.update(T2DB_QUESTION_CACHE_SIZE="0", T2DB_RESULT_CACHE_MB="0")
+    else:
+        env.setdefault("T2DB_RESULT_CACHE_MB", "64")
+    for item in args.env:
+        name, value = item.split("=", 1)
+        env[name] = value
+    log_path = os.path.join(workdir, "service.log")
+    with open(log_path, "w") as log:
+        service = subprocess.Popen(
+            [sys.executable, "-m", "uvicorn", "--factory", "talk2db_service:create_app", "--host", "127.0.0.1",
+             "--port", str(service_port), "--log-level", "warning"],
+            cwd=ROOT, env=env, stdout=log, stderr=subprocess.STDOUT,
+        )
+    url = f"http://127.0.0.1:{service_port}"
+    report = {"config": vars(args), "levels": []}
+    try:
+        wait_ready(f"http://127.0.0.1:{llm_port}/health", llm)
+        wait_ready(f"{url}/metrics", service)
+        print(f"Servizio pronto (RSS {rss_mb(service.pid) or 0:.1f} MB), log in {log_path}")
+
+        # Riscaldamento: prima costruzione dello schema, fuori dalle misure
+        start = time.perf_counter()
+        httpx.post(f"{url}/question", json={"question": questions[0]}, timeout=None)
+        print(f"Prima richiesta (schema a freddo): {(time.perf_counter() - start) * 1000:.0f} ms")
+
+        print(f"\n{'conc':>5} {'richieste':>7} {'errori':>6} {'req/s':>9} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9} {'RSS MB':>8}")
+        for concurrency in [int(level) for level in args.concurrency.split(",")]:
+            results, elapsed, peak_rss = asyncio.run(
+                run_level(url, questions, concurrency, args.requests, service.pid)
+            )
+            level = report_level(concurrency, results, elapsed, peak_rss)
+            print(f"      {'fase':<16} {'n':>6} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9}")
+            level["stages"] = report_stages(results)
+            report["levels"].append(level)
+    finally:
+        service.terminate()
+        llm.terminate()
+        service.wait(10)
+        llm.wait(10)
+
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
+        print(f"\nRisultati salvati in {args.json}")
+
+
+if __name__ == "__main__":
+    main()
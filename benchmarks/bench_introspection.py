@@ -0,0 +1,79 @@
+"""Confronta l'introspezione con l'inspector di SQLAlchemy (una query per tabella)
+con le query di catalogo massive di talk2db_introspection, su un database SQLite
+generato con migliaia di tabelle.
+
+Uso: python benchmarks/bench_introspection.py --tables 3000 --columns 12
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+from sqlalchemy import create_engine, inspect, text
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from talk2db_introspection import format_schema, load_schema_model
+
+
+def build_database(path, table_count, column_count):
+    """Crea un database SQLite con tabelle collegate da chiavi esterne."""
+    engine = create_engine(f"sqlite:///{path}")
+    with engine.begin() as connection:
+        for i in range(table_count):
+            columns = ["Id INTEGER PRIMARY KEY"]
+            columns += [f"Campo{j} VARCHAR(50)" for j in range(column_count)]
+            if i > 0:
+                columns.append(f"Tabella{i - 1:05d}Id INTEGER REFERENCES Tabella{i - 1:05d}(Id)")
+            connection.execute(text(f"CREATE TABLE Tabella{i:05d} ({', '.join(columns)})"))
+    engine.dispose()
+
+
+def inspector_schema(engine):
+    """Percorso originale: get_table_names() e poi get_columns() per ogni tabella."""
+    inspector = inspect(engine)
+    schema_context = ""
+    for table_name in inspector.get_table_names():
+        columns = inspector.get_columns(table_name)
+        schema_context += f"{table_name} ({', '.join(column['name'] for column in columns)})\n"
+    return schema_context
+
+
+def bulk_schema(engine):
+    return format_schema(load_schema_model(engine))
+
+
+def measure(label, fn, engine, repeat):
+    timings = []
+    result = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = fn(engine)
+        timings.append((time.perf_counter() - start) * 1000)
+    print(f"{label:<10} min {min(timings):9.1f} ms   media {sum(timings) / len(timings):9.1f} ms")
+    return result, min(timings)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark dell'introspezione dello schema")
+    parser.add_argument("--tables", type=int, default=3000)
+    parser.add_argument("--columns", type=int, default=12)
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "bench.db")
+        build_database(path, args.tables, args.columns)
+        engine = create_engine(f"sqlite:///{path}")
+
+        print(f"{args.tables} tabelle, {args.columns + 1} colonne ciascuna")
+        inspector_text, inspector_ms = measure("inspector", inspector_schema, engine, args.repeat)
+        bulk_text, bulk_ms = measure("bulk", bulk_schema, engine, args.repeat)
+        print(f"speedup    {inspector_ms / bulk_ms:.1f}x")
+        print(f"output identico: {inspector_text == bulk_text}")
+        engine.dispose()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,178 @@
+"""Cache per worker contro cache condivisa (T2DB_SHARED_CACHE) con piu' worker uvicorn.
+
+Per ogni numero di worker avvia il servizio due volte su un database SQLite
+generato e il finto LLM: con le cache nella memoria di ogni processo e con
+la cache condivisa in un file SQLite. Invia ogni domanda del corpus --rounds
+volte in ordine casuale e riporta le chiamate al modello (hit rate della
+cache delle domande), le pagine servite dalla cache dei risultati (dall'header
+Server-Timing: nessuna fase db_execute), le costruzioni dello schema (dal log)
+e la RSS totale dei processi del servizio alla fine del giro.
+
+Uso: python benchmarks/bench_shared_cache.py --workers 1,4 --tables 200 --rounds 3
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
+
+import httpx
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from bench_e2e import (  # noqa: E402
+    ROOT, build_corpus, build_database, free_port, load_questions, parse_server_timing, rss_mb, wait_ready,
+)
+
+
+def process_tree(pid):
+    """Il processo e tutti i discendenti (Linux, da /proc)."""
+    pids = [pid]
+    try:
+        with open(f"/proc/{pid}/task/{pid}/children") as f:
+            for child in f.read().split():
+                pids += process_tree(int(child))
+    except OSError:
+        pass
+    return pids
+
+
+async def send_all(url, questions, concurrency):
+    """Invia le domande con al massimo concurrency richieste in corso; esito per richiesta."""
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def ask(client, question):
+        async with semaphore:
+            response = await client.post(f"{url}/question", json={"question": question})
+        stages = parse_server_timing(response.headers.get("server-timing", ""))
+        return {
+            "ok": response.status_code == 200,
+            "result_hit": "result_cache" in stages and "db_execute" not in stages,
+            "coalesced": any(stage.startswith("coalesced") for stage in stages),
+        }
+
+    async with httpx.AsyncClient(timeout=None) as client:
+        return await asyncio.gather(*[ask(client, question) for question in questions])
+
+
+def run(workers, shared, db_path, corpus_path, questions, args, workdir):
+    llm_port, service_port = free_port(), free_port()
+    llm = subprocess.Popen(
+        [sys.executable, os.path.join(ROOT, "benchmarks", "fake_llm_server.py"), "--corpus", corpus_path,
+         "--port", str(llm_port), "--latency", str(args.llm_latency)],
+        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+    )
+    label = f"{workers}_{'shared' if shared else 'memory'}"
+    env = dict(
+        os.environ,
+        T2DB_DB_URL=f"sqlite:///{db_path}",
+        T2DB_OAI_BASE_URL=f"http://127.0.0.1:{llm_port}/v1",
+        T2DB_OAI_API_TOKEN="bench",
+        T2DB_ADMIN_TOKEN="",
+        # Ogni richiesta conta: niente accorpamento delle domande identiche in corso
+        T2DB_COALESCE="0",
+        T2DB_RESULT_CACHE_MB="64",
+        T2DB_RESULT_CACHE_TTL="3600",
+    )
+    env.pop("T2DB_SHARED_CACHE", None)
+    if shared:
+        env["T2DB_SHARED_CACHE"] = os.path.join(workdir, f"cache_{label}.db")
+    log_path = os.path.join(workdir, f"service_{label}.log")
+    url = f"http://127.0.0.1:{service_port}"
+    try:
+        wait_ready(f"http://127.0.0.1:{llm_port}/health", llm)
+        with open(log_path, "w") as log:
+            service = subprocess.Popen(
+                [sys.executable, "-m", "uvicorn", "--factory", "talk2db_service:create_app", "--host", "127.0.0.1",
+                 "--port", str(service_port), "--workers", str(workers), "--log-level", "warning"],
+                cwd=ROOT, env=env, stdout=log, stderr=subprocess.STDOUT,
+            )
+        try:
+            wait_ready(f"{url}/ready", service, timeout=120)
+            # I worker completano il riscaldamento uno alla volta: si attende che lo abbiano fatto tutti
+            deadline = time.time() + 120
+            while time.time() < deadline:
+                with open(log_path) as f:
+                    if f.read().count("Riscaldamento") >= workers:
+                        break
+                time.sleep(0.2)
+            sequence = [question for question in questions for _ in range(args.rounds)]
+            random.Random(args.seed).shuffle(sequence)
+            start = time.perf_counter()
+            results = asyncio.run(send_all(url, sequence, args.concurrency))
+            elapsed = time.perf_counter() - start
+            rss = sum(rss_mb(pid) or 0 for pid in process_tree(service.pid))
+        finally:
+            service.terminate()
+            service.wait(30)
+        llm_calls = httpx.get(f"http://127.0.0.1:{llm_port}/health").json()["requests"]
+    finally:
+        llm.terminate()
+        llm.wait(10)
+    with open(log_path) as f:
+        log_text = f.read()
+    total = len(results)
+    return {
+        "workers": workers,
+        "cache": "condivisa" if shared else "per worker",
+        "requests": total,
+        "errors": sum(not result["ok"] for result in results),
+        "seconds": elapsed,
+        "llm_calls": llm_calls,
+        "question_hit_rate": 1 - llm_calls / total,
+        "result_hit_rate": sum(result["result_hit"] for result in results) / total,
+        "schema_builds": log_text.count("Schema ricostruito"),
+        "schema_shared_loads": log_text.count("Schema preso dalla cache condivisa"),
+        "rss_mb": rss,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Hit rate e memoria con cache per worker e cache condivisa")
+    parser.add_argument("--workers", default="1,4", help="Numeri di worker separati da virgola")
+    parser.add_argument("--tables", type=int, default=200)
+    parser.add_argument("--rows", type=int, default=500, help="Righe per tabella")
+    parser.add_argument("--questions", default=os.path.join(ROOT, "requests.jsonl"),
+                        help="Corpus di domande (testo o JSON per riga)")
+    parser.add_argument("--rounds", type=int, default=3, help="Volte in cui ogni domanda viene inviata")
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--llm-latency", type=float, default=50, help="Latenza del finto LLM in ms")
+    parser.add_argument("--json", help="Salva i risultati in questo file")
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix="t2db_shared_")
+    db_path = os.path.join(workdir, "bench.db")
+    build_database(db_path, args.tables, 6, args.rows, 50)
+    questions = load_questions(args.questions)
+    corpus_path = os.path.join(workdir, "corpus.json")
+    with open(corpus_path, "w", encoding="utf-8") as f:
+        json.dump(build_corpus(questions, args.tables), f, ensure_ascii=False)
+    print(f"{len(questions)} domande x {args.rounds} giri, log in {workdir}\n")
+
+    print(f"{'worker':>6} {'cache':<11} {'richieste':>9} {'errori':>6} {'LLM':>5} {'hit dom.':>8} {'hit ris.':>8} "
+          f"{'schema':>6} {'condiv.':>7} {'RSS MB':>8} {'secondi':>8}")
+    report = {"config": vars(args), "runs": []}
+    for workers in [int(value) for value in args.workers.split(",")]:
+        for shared in (False, True):
+            result = run(workers, shared, db_path, corpus_path, questions, args, workdir)
+            report["runs"].append(result)
+            print(
+                f"{result['workers']:>6} {result['cache']:<11} {result['requests']:>9} {result['errors']:>6} "
+                f"{result['llm_calls']:>5} {result['question_hit_rate']:>8.1%} {result['result_hit_rate']:>8.1%} "
+                f"{result['schema_builds']:>6} {result['schema_shared_loads']:>7} {result['rss_mb']:>8.1f} "
+                f"{result['seconds']:>8.2f}"
+            )
+
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
+        print(f"\nRisultati salvati in {args.json}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,90 @@
+"""Finto provider LLM per i benchmark offline: espone /v1/chat/completions
+(compatibile OpenAI) e /hf (inferenza Hugging Face) e risponde con la SQL
+associata alla domanda in un corpus JSON {domanda: sql}, dopo una latenza
+configurabile.
+
+Uso: python benchmarks/fake_llm_server.py --corpus corpus.json --latency 300 --jitter 100 --port 9100
+"""
+import argparse
+import asyncio
+import json
+import random
+import re
+
+import uvicorn
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse
+
+# Il prompt contiene la domanda in una riga "Question: ..." (la CLI la annida
+# nel prompt completo, quindi vale l'ultima occorrenza)
+QUESTION_RE = re.compile(r"Question:\s*(.*)")
+
+
+def create_app(corpus, latency_ms=0, jitter_ms=0, error_rate=0.0, default_sql="SELECT 1 AS Valore"):
+    app = FastAPI()
+    app.state.requests = 0
+
+    def sql_for(prompt):
+        matches = QUESTION_RE.findall(prompt)
+        question = matches[-1].strip() if matches else prompt.strip()
+        return corpus.get(question, default_sql)
+
+    async def simulate():
+        """Latenza del modello ed eventuale limite di frequenza (429)."""
+        app.state.requests += 1
+        delay = max(latency_ms + random.uniform(-jitter_ms, jitter_ms), 0) / 1000
+        await asyncio.sleep(delay)
+        if error_rate and random.random() < error_rate:
+            return JSONResponse({"error": "rate limited"}, status_code=429, headers={"Retry-After": "0.1"})
+        return None
+
+    @app.get("/health")
+    async def health():
+        return {"requests": app.state.requests}
+
+    @app.post("/v1/chat/completions")
+    async def chat_completions(request: Request):
+        body = await request.json()
+        error = await simulate()
+        if error is not None:
+            return error
+        prompt = body["messages"][-1]["content"]
+        sql = sql_for(prompt)
+        prompt_tokens = sum(len(message["content"]) for message in body["messages"]) // 4
+        return {
+            "model": body.get("model"),
+            "choices": [{"index": 0, "message": {"role": "assistant", "content": sql}, "finish_reason": "stop"}],
+            "usage": {"prompt_tokens": prompt_tokens, "completion_tokens": len(sql) // 4},
+        }
+
+    @app.post("/hf")
+    async def huggingface(request: Request):
+        body = await request.json()
+        error = await simulate()
+        if error is not None:
+            return error
+        return [{"generated_text": sql_for(body["inputs"])}]
+
+    return app
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Finto provider LLM per i benchmark")
+    parser.add_argument("--corpus", help="File JSON {domanda: sql}")
+    parser.add_argument("--latency", type=float, default=300, help="Latenza media in ms")
+    parser.add_argument("--jitter", type=float, default=0, help="Variazione massima della latenza in ms")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Frazione di risposte 429")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=9100)
+    args = parser.parse_args()
+
+    corpus = {}
+    if args.corpus:
+        with open(args.corpus, encoding="utf-8") as f:
+            corpus = json.load(f)
+    app = create_app(corpus, args.latency, args.jitter, args.error_rate)
+    uvicorn.run(app, host=args.host, port=args.port, log_level="warning")
+
+
+if __name__ == "__main__":
+    main()
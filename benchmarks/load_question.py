@@ -0,0 +1,49 @@
+"""Test di carico di POST /question: invia N domande in parallelo a un servizio
+in esecuzione e confronta il tempo totale con quello della richiesta piu' lenta.
+
+Con una pipeline non bloccante il rapporto totale/piu' lenta resta vicino a 1;
+se il servizio serializza le richieste cresce con N.
+
+Uso: python benchmarks/load_question.py --url http://localhost:8000 -n 20 "Quanti clienti ci sono?"
+"""
+import argparse
+import asyncio
+import time
+
+import httpx
+
+
+async def ask(client, url, question):
+    start = time.perf_counter()
+    response = await client.post(f"{url}/question", json={"question": question})
+    return time.perf_counter() - start, response.status_code
+
+
+async def run(url, questions, concurrency):
+    async with httpx.AsyncClient(timeout=None, limits=httpx.Limits(max_connections=concurrency)) as client:
+        start = time.perf_counter()
+        results = await asyncio.gather(*(ask(client, url, question) for question in questions))
+        total = time.perf_counter() - start
+
+    latencies = sorted(latency for latency, _ in results)
+    errors = sum(1 for _, status in results if status != 200)
+    slowest = latencies[-1]
+    print(f"richieste            {len(results)} (errori: {errors})")
+    print(f"latenza min/med/max  {latencies[0]:.2f} / {latencies[len(latencies) // 2]:.2f} / {slowest:.2f} s")
+    print(f"tempo totale         {total:.2f} s")
+    print(f"totale / piu' lenta  {total / slowest:.2f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Test di carico concorrente di POST /question")
+    parser.add_argument("questions", nargs="+", help="Domande da inviare (ripetute a rotazione)")
+    parser.add_argument("--url", default="http://localhost:8000")
+    parser.add_argument("-n", "--requests", type=int, default=20, help="Numero di richieste concorrenti")
+    args = parser.parse_args()
+
+    questions = [args.questions[i % len(args.questions)] for i in range(args.requests)]
+    asyncio.run(run(args.url, questions, args.requests))
+
+
+if __name__ == "__main__":
+    main()
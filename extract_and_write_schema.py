@@ -1,55 +1,105 @@
-from sqlalchemy import create_engine, inspect
+"""Esporta lo schema del database: DDL (schema_<timestamp>.sql) e snapshot JSON
+(schema_<timestamp>.json) con tabelle, colonne, chiavi primarie ed esterne,
+indici e procedure.
+
+Se nella cartella di output c'e' uno snapshot precedente dello stesso database
+rilegge solo gli oggetti modificati da allora e scrive la differenza in
+schema_<timestamp>_diff.json; se non e' cambiato nulla non scrive nuovi file.
+La connessione usa le stesse variabili di ambiente di talk2db.py
+(T2DB_DB_URL oppure T2DB_DB_USER, T2DB_DB_PASS, T2DB_DB_HOST, T2DB_DB_NAME).
+
+Uso: python extract_and_write_schema.py --output-dir schema --workers 8
+"""
+import argparse
+import json
+import logging
+import os
+import re
+import sys
 from datetime import datetime
 
-# Configura la connessione al database
-DB_USER = "sa"
-DB_PASS = "Password01!"
-DB_PORT = "1433"
-DB_NAME = "NAUS_PROD"
-DB_HOST = "WINDELL-186CUHK\\SQLEXPRESS"
-connection_url = f"mssql+pyodbc://{DB_USER}:{DB_PASS}@{DB_HOST}/{DB_NAME}?driver=ODBC+Driver+17+for+SQL+Server&TrustServerCertificate=yes&Encrypt=no"
-# Crea l'engine di SQLAlchemy
-engine = create_engine(connection_url)
-
-# Crea l'inspector per ispezionare le tabelle
-inspector = inspect(engine)
-
-# Ottieni tutte le tabelle nel database
-tables = inspector.get_table_names()
-
-# Prepara il nome del file con timestamp
-timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-filename = f"schema_{timestamp}.sql"
-
-# Apri il file per scrivere lo schema
-with open(filename, "w") as file:
-    for table_name in tables:
-        # Ottieni i dettagli delle colonne della tabella
-        columns = inspector.get_columns(table_name)
-        
-        # Costruisci la definizione della tabella
-        table_definition = f"CREATE TABLE {table_name} (\n"
-        column_definitions = []
-        
-        for column in columns:
-            # Estrai il tipo e i dettagli della colonna
-            column_name = column["name"]
-            column_type = column["type"]
-            is_nullable = column["nullable"]
-            default = column.get("default", None)
-            
-            # Definisci il tipo di colonna e le restrizioni
-            column_def = f"    {column_name} {column_type}"
-            if not is_nullable:
-                column_def += " NOT NULL"
-            if default is not None:
-                column_def += f" DEFAULT {default}"
-                
-            column_definitions.append(column_def)
-        
-        table_definition += ",\n".join(column_definitions) + "\n);\n\n"
-        
-        # Scrivi la definizione della tabella nel file
-        file.write(table_definition)
-
-print(f"Schema salvato in {filename}")
+from talk2db_pool import build_engine
+from talk2db_schema_export import diff_snapshots, export_schema, format_diff, has_changes, render_ddl
+
+# Configura il logging
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+logger = logging.getLogger(__name__)
+
+_SNAPSHOT_RE = re.compile(r"^schema_\d{8}_\d{6}\.json$")
+
+
+def connection_url():
+    """URL del database dalle variabili di ambiente; termina il processo se mancano."""
+    url = os.getenv("T2DB_DB_URL")
+    if url:
+        return url
+    required_env_vars = ["T2DB_DB_USER", "T2DB_DB_PASS", "T2DB_DB_HOST", "T2DB_DB_NAME"]
+    missing_vars = [var for var in required_env_vars if not os.getenv(var)]
+    if missing_vars:
+        logger.error(f"Errore: Le seguenti variabili di ambiente non sono impostate: {', '.join(missing_vars)}")
+        sys.exit(1)
+    return (
+        f"mssql+pyodbc://{os.getenv('T2DB_DB_USER')}:{os.getenv('T2DB_DB_PASS')}@{os.getenv('T2DB_DB_HOST')}/"
+        f"{os.getenv('T2DB_DB_NAME')}?driver=ODBC+Driver+17+for+SQL+Server&TrustServerCertificate=yes&Encrypt=no"
+    )
+
+
+def latest_snapshot(output_dir):
+    """Percorso dello snapshot piu' recente nella cartella, None se non ce ne sono."""
+    if not os.path.isdir(output_dir):
+        return None
+    names = sorted(name for name in os.listdir(output_dir) if _SNAPSHOT_RE.match(name))
+    return os.path.join(output_dir, names[-1]) if names else None
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Esporta lo schema del database in DDL e JSON")
+    parser.add_argument("--output-dir", default=".", help="Cartella dei file dello schema")
+    parser.add_argument("--workers", type=int, default=4, help="Connessioni che leggono il catalogo in parallelo")
+    parser.add_argument("--previous", help="Snapshot JSON di riferimento (default: il piu' recente in --output-dir)")
+    parser.add_argument("--full", action="store_true", help="Rilegge tutti gli oggetti ignorando lo snapshot precedente")
+    parser.add_argument("--exclude", action="append", default=[], help="Tabella da non esportare (ripetibile)")
+    args = parser.parse_args()
+
+    previous_path = None if args.full else (args.previous or latest_snapshot(args.output_dir))
+    previous = None
+    if previous_path:
+        try:
+            with open(previous_path, encoding="utf-8") as f:
+                previous = json.load(f)
+        except (OSError, ValueError) as e:
+            logger.error(f"Errore nella lettura dello snapshot precedente {previous_path}: {e}")
+            sys.exit(1)
+        logger.info(f"Snapshot precedente: {previous_path}")
+
+    try:
+        engine, _ = build_engine(connection_url(), pool_size=args.workers, max_overflow=0)
+        snapshot, stats = export_schema(engine, previous, workers=args.workers, excluded_tables=args.exclude)
+    except Exception as e:
+        logger.error(f"Errore durante l'esportazione dello schema: {e}")
+        sys.exit(1)
+
+    diff = diff_snapshots(previous, snapshot) if stats["incremental"] else None
+    if diff is not None:
+        if not has_changes(diff):
+            logger.info("Nessuna modifica rispetto allo snapshot precedente: nessun file scritto.")
+            return
+        for line in format_diff(diff):
+            logger.info(line)
+
+    os.makedirs(args.output_dir, exist_ok=True)
+    timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+    base = os.path.join(args.output_dir, f"schema_{timestamp}")
+    with open(f"{base}.sql", "w", encoding="utf-8") as f:
+        f.write(render_ddl(snapshot))
+    with open(f"{base}.json", "w", encoding="utf-8") as f:
+        json.dump(snapshot, f, indent=1, ensure_ascii=False, default=str)
+    if diff is not None:
+        with open(f"{base}_diff.json", "w", encoding="utf-8") as f:
+            json.dump({"previous": os.path.basename(previous_path), "diff": diff}, f, indent=1,
+                      ensure_ascii=False, default=str)
+    logger.info(f"Schema salvato in {base}.sql e {base}.json ({stats['read']} oggetti letti, {stats['reused']} invariati).")
+
+
+if __name__ == "__main__":
+    main()
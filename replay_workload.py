@@ -0,0 +1,137 @@
+"""Riesegue un carico registrato dal servizio (T2DB_WORKLOAD_LOG) su un database
+di destinazione: una copia SQLite o un database di staging.
+
+Le SQL generate vengono rieseguite con la stessa paginazione dell'originale,
+rispettando gli intervalli tra le richieste divisi per --speedup (0 = tutte
+subito) con al massimo --concurrency query in corso. Il rapporto confronta i
+tempi sul database (db_execute + db_fetch) con quelli registrati: percentili,
+regressioni oltre --regression volte e le --top istruzioni piu' costose.
+Solo le SELECT, salvo --include-writes.
+
+Uso: python replay_workload.py "logs/workload-*.jsonl*" --db-url sqlite:///copia.db --speedup 10 --concurrency 8
+"""
+import argparse
+import json
+import logging
+import os
+import sys
+
+from sqlalchemy import make_url
+
+from talk2db_pool import build_engine
+from talk2db_workload import find_regressions, load_workload, replay_workload, replayable, top_statements
+
+# Configura il logging
+logging.basicConfig(level=logging.WARNING, format='%(asctime)s - %(levelname)s - %(message)s')
+logger = logging.getLogger(__name__)
+
+
+def percentile(values, fraction):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+
+def format_ms(value):
+    return f"{value:10.1f}" if value is not None else f"{'-':>10}"
+
+
+def one_line(sql, width=100):
+    sql = " ".join(sql.split())
+    return sql if len(sql) <= width else sql[:width - 3] + "..."
+
+
+def summary(results):
+    """Percentili dei tempi sul database registrati e rieseguiti, sulle richieste confrontabili."""
+    paired = [result for result in results
+              if not result["error"] and result.get("db_ms") is not None and result["record"].get("db_ms") is not None]
+    captured = [result["record"]["db_ms"] for result in paired]
+    replayed = [result["db_ms"] for result in paired]
+    return {
+        "replayed": len(results),
+        "errors": sum(result["error"] is not None for result in results),
+        "compared": len(paired),
+        "captured_ms": {name: percentile(captured, fraction) for name, fraction in (("p50", 0.5), ("p95", 0.95), ("p99", 0.99))},
+        "replayed_ms": {name: percentile(replayed, fraction) for name, fraction in (("p50", 0.5), ("p95", 0.95), ("p99", 0.99))},
+        "max_lag_ms": max((result["lag_ms"] for result in results), default=0.0),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Riesegue un carico registrato e riporta regressioni e query piu' costose")
+    parser.add_argument("logs", nargs="+", help="File del registro del carico (accetta glob, es. \"workload.jsonl*\")")
+    parser.add_argument("--db-url", default=os.getenv("T2DB_DB_URL"),
+                        help="Database di destinazione, URL SQLAlchemy (default: T2DB_DB_URL)")
+    parser.add_argument("--database", help="Solo le richieste di questo database (tenant)")
+    parser.add_argument("--concurrency", type=int, default=4, help="Query in corso al massimo")
+    parser.add_argument("--speedup", type=float, default=1.0,
+                        help="Fattore di accelerazione degli intervalli registrati (0 = tutte subito)")
+    parser.add_argument("--limit", type=int, default=0, help="Rieseguire al massimo queste richieste (0 = tutte)")
+    parser.add_argument("--top", type=int, default=10, help="Istruzioni e regressioni riportate")
+    parser.add_argument("--regression", type=float, default=1.5,
+                        help="Regressione: tempo rieseguito almeno questo multiplo di quello registrato")
+    parser.add_argument("--min-ms", type=float, default=5.0, help="...e piu' lento di almeno questi millisecondi")
+    parser.add_argument("--include-writes", action="store_true",
+                        help="Riesegue anche le istruzioni che non sono SELECT (mai su un database di produzione)")
+    parser.add_argument("--json", help="Salva il rapporto completo in questo file")
+    args = parser.parse_args()
+
+    records = load_workload(args.logs)
+    selected = replayable(records, args.database, args.include_writes)
+    if args.limit:
+        selected = selected[:args.limit]
+    print(f"{len(records)} richieste registrate, {len(selected)} da rieseguire")
+    if not args.db_url:
+        logger.error("Errore: database di destinazione non indicato (--db-url o T2DB_DB_URL).")
+        sys.exit(1)
+    if not selected:
+        sys.exit(1)
+
+    engine, _ = build_engine(args.db_url, "replay",
+                             pool_size=args.concurrency, max_overflow=0)
+    try:
+        results = replay_workload(engine, selected, concurrency=args.concurrency, speedup=args.speedup)
+    finally:
+        engine.dispose()
+
+    report = summary(results)
+    print(f"Rieseguite {report['replayed']}, errori {report['errors']}, confrontabili {report['compared']}, "
+          f"ritardo massimo sul programma {report['max_lag_ms']:.1f} ms")
+    print(f"\n{'ms sul database':<16} {'p50':>10} {'p95':>10} {'p99':>10}")
+    for label, key in (("registrati", "captured_ms"), ("rieseguiti", "replayed_ms")):
+        values = report[key]
+        print(f"{label:<16} {format_ms(values['p50'])} {format_ms(values['p95'])} {format_ms(values['p99'])}")
+
+    regressions = find_regressions(results, args.regression, args.min_ms)
+    print(f"\nRegressioni (>= {args.regression:g}x e +{args.min_ms:g} ms): {len(regressions)}")
+    for item in regressions[:args.top]:
+        ratio = f"{item['ratio']:.1f}x" if item["ratio"] is not None else "-"
+        print(f"{item['captured_ms']:>10.1f} -> {item['db_ms']:>10.1f} ms {ratio:>7}  "
+              f"[{item['record'].get('database')}] {one_line(item['record']['sql'])}")
+
+    statements = top_statements(results, args.top)
+    print("\nIstruzioni piu' costose (tempo totale rieseguito; registr. = media dei tempi registrati):")
+    print(f"{'esec.':>6} {'errori':>6} {'totale ms':>10} {'medio ms':>10} {'max ms':>10} {'registr. ms':>11}  sql")
+    for item in statements:
+        print(f"{item['executions']:>6} {item['errors']:>6} {item['total_ms']:>10.1f} {format_ms(item['avg_ms'])} "
+              f"{item['max_ms']:>10.1f} {format_ms(item['captured_avg_ms']):>11}  {one_line(item['sql'])}")
+        if item.get("last_error"):
+            print(f"{'':>58}errore: {one_line(item['last_error'])}")
+
+    if args.json:
+        report.update(
+            # Senza password: il rapporto si condivide
+            config={**vars(args), "db_url": make_url(args.db_url).render_as_string(hide_password=True)},
+            regressions=[{"database": item["record"].get("database"), "sql": item["record"]["sql"],
+                          "captured_ms": item["captured_ms"], "replayed_ms": item["db_ms"], "ratio": item["ratio"],
+                          "ts": item["record"].get("ts")} for item in regressions],
+            top_statements=statements,
+        )
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2, ensure_ascii=False, default=str)
+        print(f"\nRapporto salvato in {args.json}")
+
+
+if __name__ == "__main__":
+    main()
@@ -2,19 +2,23 @@ import argparse
 import os
 import re
 import sys
+import threading
 import logging
 import requests
-from sqlalchemy import create_engine, inspect, text
+from sqlalchemy import text
 import pandas as pd
-import config
 from openai import OpenAI
+from talk2db_batch import OUTPUT_FORMATS, check_output_format, load_questions, run_batch
+from talk2db_introspection import format_schema, load_schema_model
+from talk2db_pool import DatabaseEngines, open_connections
 
 # Configura il logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 
-# Verifica le variabili di ambiente
-required_env_vars = ["T2DB_DB_USER", "T2DB_DB_PASS", "T2DB_DB_HOST", "T2DB_DB_PORT", "T2DB_DB_NAME", "T2DB_HF_API_TOKEN"]
+# Verifica le variabili di ambiente (T2DB_DB_URL, se presente, sostituisce i parametri di connessione)
+DB_URL = os.getenv("T2DB_DB_URL")
+required_env_vars = [] if DB_URL else ["T2DB_DB_USER", "T2DB_DB_PASS", "T2DB_DB_HOST", "T2DB_DB_PORT", "T2DB_DB_NAME"]
 
 missing_vars = [var for var in required_env_vars if os.getenv(var) is None]
 
@@ -53,14 +57,25 @@ def query_huggingface_api(prompt):
     else:
         logger.error(f"Errore nella richiesta API: {response.status_code} - {response.text}")
         raise Exception("Errore nella richiesta API")
+
+
+_openai_client = None
+_openai_client_lock = threading.Lock()
+
+
+def get_openai_client():
+    """Client OpenAI condiviso (e' thread-safe e riusa le connessioni HTTP)."""
+    global _openai_client
+    with _openai_client_lock:
+        if _openai_client is None:
+            _openai_client = OpenAI(api_key=os.environ.get('T2DB_OAI_API_TOKEN'))
+        return _openai_client
+
 # Funzione per chiamare l'API di OpenAI
 def query_openai_api(question,schema):
     
     try:
-        client = OpenAI()
-        client.api_key = os.environ.get('T2DB_OAI_API_TOKEN')
-
-        completion = client.chat.completions.create(
+        completion = get_openai_client().chat.completions.create(
             model="gpt-4o-mini",
             messages=[
                 {"role": "system", "content": "You are a helpful assistant specialized in generating SQL queries. Your task is to translate the user's question into TSQL code that will run on a database. Only respond with SQL code, without any additional text, explanations, or comments."},
@@ -90,15 +105,25 @@ DB_HOST = os.getenv("T2DB_DB_HOST")
 DB_PORT = os.getenv("T2DB_DB_PORT", "1433")
 DB_NAME = os.getenv("T2DB_DB_NAME")
 
-if not all([DB_USER, DB_PASS, DB_HOST, DB_NAME]):
+if not DB_URL and not all([DB_USER, DB_PASS, DB_HOST, DB_NAME]):
     logger.error("Errore: Assicurati che tutte le variabili di ambiente per la connessione al database siano impostate.")
     sys.exit(1)
 
-connection_url = f"mssql+pyodbc://{DB_USER}:{DB_PASS}@{DB_HOST}/{DB_NAME}?driver=ODBC+Driver+17+for+SQL+Server&TrustServerCertificate=yes&Encrypt=no"
+connection_url = DB_URL or f"mssql+pyodbc://{DB_USER}:{DB_PASS}@{DB_HOST}/{DB_NAME}?driver=ODBC+Driver+17+for+SQL+Server&TrustServerCertificate=yes&Encrypt=no"
 
 try:
     logger.info("Connessione al database...")
-    engine = create_engine(connection_url)
+    # Impostazioni del pool e replica in sola lettura come nel servizio (T2DB_DB_POOL_*, T2DB_DB_REPLICA_URL)
+    db_engines = DatabaseEngines(
+        connection_url,
+        os.getenv("T2DB_DB_REPLICA_URL"),
+        pool_size=int(os.getenv("T2DB_DB_POOL_SIZE", "5")),
+        max_overflow=int(os.getenv("T2DB_DB_POOL_OVERFLOW", "10")),
+        pool_timeout=float(os.getenv("T2DB_DB_POOL_TIMEOUT", "30")),
+        pool_recycle=float(os.getenv("T2DB_DB_POOL_RECYCLE", "1800")),
+        pre_ping=os.getenv("T2DB_DB_POOL_PRE_PING", "1") == "1",
+    )
+    engine = db_engines.primary
     logger.info("Connessione al database stabilita.")
 except Exception as e:
     logger.error(f"Errore nella connessione al database: {e}")
@@ -154,22 +179,8 @@ filtered_tables = [
 def get_db_schema():
     """Recupera lo schema del database in formato compatto."""
     try:
-        inspector = inspect(engine)
-        schema_context = ""
-
-        table_names = inspector.get_table_names()
-
-        # print(",".join(table_names))
-
-        for table_name in table_names:
-             if table_name not in filtered_tables:
-                columns = inspector.get_columns(table_name)
-                column_names = [column["name"] for column in columns]
-                schema_context += f"{table_name} ({', '.join(column_names)})\n"
-        
-        # logger.info("Schema del database recuperato con successo.")
-        # logger.info(schema_context)
-        return schema_context
+        model = load_schema_model(engine, excluded_tables=filtered_tables)
+        return format_schema(model, include_procedures=False)
     except Exception as e:
         logger.error(f"Errore nel recupero dello schema del database: {e}")
         raise
@@ -200,7 +211,7 @@ def question_to_sql(question, schema_context,use_openai):
 def execute_query(query):
     """Esegue la query SQL e restituisce i risultati come DataFrame."""
     try:
-        with engine.connect() as connection:
+        with db_engines.for_sql(query).connect() as connection:
             logger.info(f"Esecuzione della query: {query}")
             result = connection.execute(text(query))
             df = pd.DataFrame(result.fetchall(), columns=result.keys())
@@ -215,6 +226,11 @@ def main():
     parser = argparse.ArgumentParser(description="Genera query SQL usando OpenAI o Hugging Face")
     parser.add_argument("--oai", action="store_true", help="Usa l'API di OpenAI")
     parser.add_argument("--hf", action="store_true", help="Usa l'API di Hugging Face")
+    parser.add_argument("--batch", metavar="FILE", help="File di domande (testo, una per riga, o JSONL) da elaborare senza interazione")
+    parser.add_argument("--output-dir", default="talk2db_output", help="Cartella dei risultati del batch")
+    parser.add_argument("--format", choices=OUTPUT_FORMATS, default="csv", help="Formato dei risultati del batch")
+    parser.add_argument("--llm-concurrency", type=int, default=4, help="Chiamate contemporanee al modello nel batch")
+    parser.add_argument("--db-concurrency", type=int, default=4, help="Query contemporanee sul database nel batch")
     args = parser.parse_args()
 
     # Controllo dei parametri
@@ -222,7 +238,32 @@ def main():
         logger.error("Errore: Specificare --openai o --hf per scegliere l'API.")
         sys.exit(1)
     use_openai = args.oai
+    if not use_openai and not API_TOKEN:
+        logger.error("Errore: T2DB_HF_API_TOKEN non impostata, necessaria per --hf.")
+        sys.exit(1)
 
+    if args.batch:
+        try:
+            check_output_format(args.format)
+            questions = load_questions(args.batch)
+        except (OSError, ValueError) as e:
+            logger.error(f"Errore: {e}")
+            sys.exit(1)
+        schema_context = get_db_schema()
+        # Le connessioni per le query parallele vengono aperte prima di iniziare
+        for batch_engine, _ in db_engines.all():
+            open_connections(batch_engine, args.db_concurrency)
+        summary = run_batch(
+            questions,
+            lambda question: question_to_sql(question, schema_context, use_openai),
+            execute_query,
+            args.output_dir,
+            fmt=args.format,
+            llm_concurrency=args.llm_concurrency,
+            db_concurrency=args.db_concurrency,
+        )
+        # Codice di uscita diverso da zero se qualche domanda non e' andata a buon fine
+        sys.exit(1 if any(entry["status"] != "ok" for entry in summary) else 0)
 
     try:
         logger.info("Inizio dello script. Scrivi 'exit' per terminare.")
@@ -0,0 +1,186 @@
+import datetime
+import decimal
+import logging
+from importlib.util import find_spec
+
+# Dipendenza opzionale: senza, i formati binari non sono disponibili.
+# Importata alla prima codifica perche' rallenta l'avvio.
+PYARROW_AVAILABLE = find_spec("pyarrow") is not None
+pa = None
+pq = None
+
+
+def _load_pyarrow():
+    global pa, pq
+    if pa is None:
+        import pyarrow
+        import pyarrow.parquet
+        pq = pyarrow.parquet
+        pa = pyarrow
+
+logger = logging.getLogger(__name__)
+
+JSON_MEDIA_TYPE = "application/json"
+NDJSON_MEDIA_TYPE = "application/x-ndjson"
+ARROW_STREAM_MEDIA_TYPE = "application/vnd.apache.arrow.stream"
+PARQUET_MEDIA_TYPE = "application/vnd.apache.parquet"
+
+# Tipi MIME accettati nell'header Accept per ciascun formato
+MEDIA_TYPES = {
+    ARROW_STREAM_MEDIA_TYPE: "arrow",
+    "application/vnd.apache.arrow": "arrow",
+    PARQUET_MEDIA_TYPE: "parquet",
+    "application/x-parquet": "parquet",
+}
+
+FORMAT_MEDIA_TYPES = {
+    "arrow": ARROW_STREAM_MEDIA_TYPE,
+    "parquet": PARQUET_MEDIA_TYPE,
+}
+
+
+class UnsupportedFormatError(Exception):
+    """Formato binario richiesto ma pyarrow non e' installato."""
+
+
+def negotiate_format(accept):
+    """Formato della risposta in base all'header Accept: "arrow", "parquet" o None (formato testuale di default)."""
+    if not accept:
+        return None
+    for entry in accept.split(","):
+        media_type = entry.split(";")[0].strip().lower()
+        if media_type in MEDIA_TYPES:
+            if not PYARROW_AVAILABLE:
+                raise UnsupportedFormatError(f"Formato {media_type} non disponibile: installare pyarrow")
+            return MEDIA_TYPES[media_type]
+        if media_type in (JSON_MEDIA_TYPE, NDJSON_MEDIA_TYPE, "*/*"):
+            return None
+    return None
+
+
+def _arrow_type(type_code, precision=None, scale=None):
+    """Tipo Arrow dal type_code DB-API (pyodbc restituisce classi Python); None se non determinabile."""
+    if type_code is bool:
+        return pa.bool_()
+    if type_code is int:
+        return pa.int64()
+    if type_code is float:
+        return pa.float64()
+    if type_code is decimal.Decimal:
+        if precision and 0 < precision <= 38:
+            return pa.decimal128(precision, scale or 0)
+        return None
+    if type_code is str:
+        return pa.string()
+    if type_code is datetime.datetime:
+        return pa.timestamp("us")
+    if type_code is datetime.date:
+        return pa.date32()
+    if type_code is datetime.time:
+        return pa.time64("us")
+    if type_code in (bytes, bytearray):
+        return pa.binary()
+    return None
+
+
+def _to_array(values, arrow_type=None):
+    try:
+        return pa.array(values, type=arrow_type)
+    except (pa.ArrowInvalid, pa.ArrowTypeError, TypeError):
+        if arrow_type is not None and arrow_type != pa.string():
+            raise
+        # Valori misti o non rappresentabili (es. UUID): come testo
+        return pa.array([None if value is None else str(value) for value in values], type=pa.string())
+
+
+def build_schema(columns, description, rows, metadata=None):
+    """Schema Arrow dalla descrizione del cursore; i tipi ignoti si deducono dal primo lotto di righe."""
+    _load_pyarrow()
+    fields = []
+    values_by_column = list(zip(*rows)) if rows else [()] * len(columns)
+    for index, name in enumerate(columns):
+        arrow_type = None
+        if description and index < len(description):
+            column = description[index]
+            arrow_type = _arrow_type(column[1], *(column[4:6] if len(column) >= 6 else (None, None)))
+        if arrow_type is None:
+            arrow_type = _to_array(list(values_by_column[index])).type
+            if pa.types.is_null(arrow_type):
+                arrow_type = pa.string()
+        fields.append(pa.field(name, arrow_type))
+    return pa.schema(fields, metadata=metadata)
+
+
+def rows_to_record_batch(rows, schema):
+    """Lotto di righe del cursore -> RecordBatch, colonna per colonna, senza passare da pandas."""
+    columns = list(zip(*rows)) if rows else [()] * len(schema)
+    arrays = [_to_array(list(values), field.type) for values, field in zip(columns, schema)]
+    return pa.RecordBatch.from_arrays(arrays, schema=schema)
+
+
+class _ChunkSink:
+    """File in sola scrittura che accumula i byte prodotti da pyarrow fino al prossimo drain()."""
+
+    closed = False
+
+    def __init__(self):
+        self._chunks = []
+
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+    def drain(self):
+        data = b"".join(self._chunks)
+        self._chunks = []
+        return data
+
+
+class ArrowEncoder:
+    """Codifica incrementale di lotti di righe in Arrow IPC stream o Parquet.
+
+    encode() restituisce i byte pronti da inviare dopo ogni lotto (per
+    Parquet un row group per lotto), finish() chiude il flusso.
+    """
+
+    def __init__(self, fmt, columns, description=None, metadata=None):
+        self.fmt = fmt
+        self.columns = columns
+        self.description = description
+        self.metadata = metadata
+        self.schema = None
+        self._sink = _ChunkSink()
+        self._writer = None
+
+    def _open(self, rows):
+        self.schema = build_schema(self.columns, self.description, rows, self.metadata)
+        sink = pa.PythonFile(self._sink, mode="w")
+        if self.fmt == "parquet":
+            self._writer = pq.ParquetWriter(sink, self.schema)
+        else:
+            self._writer = pa.ipc.new_stream(sink, self.schema)
+
+    def encode(self, rows):
+        if self._writer is None:
+            self._open(rows)
+        if rows:
+            self._writer.write_batch(rows_to_record_batch(rows, self.schema))
+        return self._sink.drain()
+
+    def finish(self):
+        if self._writer is None:
+            self._open([])
+        self._writer.close()
+        return self._sink.drain()
+
+
+def encode_rows(fmt, columns, description, rows, metadata=None):
+    """Codifica in un colpo solo un insieme limitato di righe (una pagina)."""
+    encoder = ArrowEncoder(fmt, columns, description, metadata)
+    return encoder.encode(rows) + encoder.finish()
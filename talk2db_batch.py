@@ -0,0 +1,127 @@
+import json
+import logging
+import os
+import re
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from importlib.util import find_spec
+
+logger = logging.getLogger(__name__)
+
+OUTPUT_FORMATS = ("csv", "parquet")
+SUMMARY_FILE = "summary.jsonl"
+
+_SLUG_RE = re.compile(r"[^A-Za-z0-9]+")
+
+
+def load_questions(path):
+    """Legge le domande da un file di testo (una per riga, # per i commenti)
+    o JSONL con i campi "question" e, facoltativo, "id" (usato per i file di output)."""
+    questions = []
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            line = line.strip()
+            if not line or line.startswith("#"):
+                continue
+            if line.startswith("{"):
+                item = json.loads(line)
+                question = item.get("question") or item.get("title")
+                if not question:
+                    logger.warning(f"Riga senza domanda ignorata: {line[:80]}")
+                    continue
+                questions.append((item.get("id") or item.get("request_id"), question.strip()))
+            else:
+                questions.append((None, line))
+    return questions
+
+
+def output_name(index, question_id, question):
+    """Nome del file dei risultati: numero progressivo piu' id o inizio della domanda."""
+    slug = _SLUG_RE.sub("_", str(question_id or question)).strip("_")[:40]
+    return f"{index:04d}_{slug}" if slug else f"{index:04d}"
+
+
+def check_output_format(fmt):
+    if fmt not in OUTPUT_FORMATS:
+        raise ValueError(f"Formato di output non supportato: {fmt}")
+    if fmt == "parquet" and find_spec("pyarrow") is None:
+        raise ValueError("Il formato parquet richiede il pacchetto pyarrow")
+
+
+def write_frame(df, path, fmt):
+    if fmt == "parquet":
+        df.to_parquet(path, index=False)
+    else:
+        df.to_csv(path, index=False)
+
+
+def run_batch(questions, generate_sql, execute_query, output_dir, fmt="csv", llm_concurrency=4, db_concurrency=4):
+    """Elabora le domande in parallelo e scrive un file di risultati per domanda
+    e il riepilogo summary.jsonl (SQL, tempi, righe, errori) in output_dir.
+
+    generate_sql(domanda) -> SQL e execute_query(SQL) -> DataFrame sono chiamate
+    da thread diversi: al massimo llm_concurrency chiamate al modello e
+    db_concurrency query sono in corso allo stesso tempo, cosi' una domanda puo'
+    interrogare il database mentre le successive attendono il modello.
+    Un errore su una domanda viene registrato nel riepilogo senza fermare le altre.
+    Restituisce le voci del riepilogo nell'ordine delle domande.
+    """
+    check_output_format(fmt)
+    os.makedirs(output_dir, exist_ok=True)
+    llm_slots = threading.Semaphore(llm_concurrency)
+    db_slots = threading.Semaphore(db_concurrency)
+    progress = {"done": 0}
+    progress_lock = threading.Lock()
+
+    def process(index, question_id, question):
+        entry = {"index": index, "id": question_id, "question": question, "sql": None, "status": "ok",
+                 "rows": None, "output": None, "llm_ms": None, "db_ms": None, "write_ms": None, "error": None}
+        stage = "llm"
+        start = time.perf_counter()
+        try:
+            with llm_slots:
+                started = time.perf_counter()
+                entry["sql"] = generate_sql(question)
+                entry["llm_ms"] = round((time.perf_counter() - started) * 1000, 1)
+            stage = "db"
+            with db_slots:
+                started = time.perf_counter()
+                df = execute_query(entry["sql"])
+                entry["db_ms"] = round((time.perf_counter() - started) * 1000, 1)
+            stage = "write"
+            started = time.perf_counter()
+            path = os.path.join(output_dir, f"{output_name(index, question_id, question)}.{fmt}")
+            write_frame(df, path, fmt)
+            entry["write_ms"] = round((time.perf_counter() - started) * 1000, 1)
+            entry["rows"] = len(df)
+            entry["output"] = os.path.basename(path)
+        except Exception as e:
+            entry["status"] = f"{stage}_error"
+            entry["error"] = str(e)
+            logger.error(f"Errore sulla domanda {index} ('{question}') in fase {stage}: {e}")
+        entry["total_ms"] = round((time.perf_counter() - start) * 1000, 1)
+        with progress_lock:
+            progress["done"] += 1
+            logger.info(f"Domande elaborate: {progress['done']}/{len(questions)}")
+        return entry
+
+    start = time.perf_counter()
+    # Un thread per ogni slot dei due stadi: nessuno stadio resta senza lavoratori
+    with ThreadPoolExecutor(max_workers=llm_concurrency + db_concurrency) as executor:
+        futures = [
+            executor.submit(process, index, question_id, question)
+            for index, (question_id, question) in enumerate(questions, start=1)
+        ]
+        summary = [future.result() for future in futures]
+    elapsed = time.perf_counter() - start
+
+    with open(os.path.join(output_dir, SUMMARY_FILE), "w", encoding="utf-8") as f:
+        for entry in summary:
+            f.write(json.dumps(entry, ensure_ascii=False, default=str) + "\n")
+    errors = sum(1 for entry in summary if entry["status"] != "ok")
+    logger.info(
+        f"Batch completato in {elapsed:.1f} s: {len(summary) - errors} domande riuscite, {errors} errori. "
+        f"Riepilogo in {os.path.join(output_dir, SUMMARY_FILE)}"
+    )
+    return summary
@@ -0,0 +1,315 @@
+import hashlib
+import logging
+import os
+import pickle
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:  # Windows: nessun lock tra processi
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+
+class MemoryCacheBackend:
+    """Archivio LRU in memoria del processo, limitato in byte e/o in numero di voci.
+
+    Ogni voce ha una scadenza facoltativa e delle etichette (tag) con cui
+    invalidarla: le tabelle citate per i risultati, la versione dello schema
+    per la SQL generata. I valori sono conservati cosi' come sono, la
+    dimensione e' quella stimata dal chiamante. 0 = nessun limite.
+    """
+
+    shared = False
+
+    def __init__(self, max_bytes=0, max_entries=0):
+        self.max_bytes = max_bytes
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._by_tag = {}
+        self._lock = threading.Lock()
+        self.bytes = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def _remove(self, key):
+        value, tags, size, expires = self._entries.pop(key)
+        self.bytes -= size
+        for tag in tags:
+            keys = self._by_tag.get(tag)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self._by_tag[tag]
+
+    def get(self, key):
+        """Valore in cache, oppure None (anche se scaduto)."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            if entry[3] is not None and entry[3] <= time.time():
+                self._remove(key)
+                self.expirations += 1
+                return None
+            self._entries.move_to_end(key)
+            return entry[0]
+
+    def put(self, key, value, size=0, ttl=None, tags=()):
+        """Memorizza il valore; False se da solo supera il limite in byte."""
+        if self.max_bytes and size > self.max_bytes:
+            return False
+        tags = tuple(tags)
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = (value, tags, size, time.time() + ttl if ttl is not None else None)
+            self.bytes += size
+            for tag in tags:
+                self._by_tag.setdefault(tag, set()).add(key)
+            while (self.max_bytes and self.bytes > self.max_bytes) or (self.max_entries and len(self._entries) > self.max_entries):
+                self._remove(next(iter(self._entries)))
+                self.evictions += 1
+        return True
+
+    def delete(self, key):
+        """Elimina la voce, se presente."""
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+
+    def invalidate(self, tags=None):
+        """Elimina le voci con almeno una delle etichette (tutte se None); restituisce il numero di voci."""
+        with self._lock:
+            if tags is None:
+                keys = list(self._entries)
+            else:
+                keys = set()
+                for tag in tags:
+                    keys.update(self._by_tag.get(tag, ()))
+            for key in keys:
+                self._remove(key)
+            return len(keys)
+
+    def tags(self):
+        with self._lock:
+            return set(self._by_tag)
+
+    def usage(self):
+        """(voci, byte) occupati."""
+        return len(self._entries), self.bytes
+
+    def stats(self):
+        return {
+            "backend": "memory",
+            "entries": len(self._entries),
+            "bytes": self.bytes,
+            "max_bytes": self.max_bytes,
+            "max_entries": self.max_entries,
+            "evictions": self.evictions,
+            "expirations": self.expirations,
+        }
+
+
+_SQLITE_SCHEMA = [
+    "CREATE TABLE IF NOT EXISTS cache_entries ("
+    "namespace TEXT, key TEXT, value BLOB, size INTEGER, expires REAL, last_used REAL, "
+    "PRIMARY KEY (namespace, key))",
+    "CREATE INDEX IF NOT EXISTS cache_entries_lru ON cache_entries (namespace, last_used)",
+    "CREATE TABLE IF NOT EXISTS cache_tags (namespace TEXT, tag TEXT, key TEXT, PRIMARY KEY (namespace, tag, key))",
+    "CREATE INDEX IF NOT EXISTS cache_tags_key ON cache_tags (namespace, key)",
+    "CREATE TABLE IF NOT EXISTS cache_usage (namespace TEXT PRIMARY KEY, entries INTEGER, bytes INTEGER)",
+    # Totali ed etichette aggiornati dai trigger: nessuna scansione per controllare i limiti
+    "CREATE TRIGGER IF NOT EXISTS cache_entries_insert AFTER INSERT ON cache_entries BEGIN "
+    "INSERT OR IGNORE INTO cache_usage VALUES (new.namespace, 0, 0); "
+    "UPDATE cache_usage SET entries = entries + 1, bytes = bytes + new.size WHERE namespace = new.namespace; END",
+    "CREATE TRIGGER IF NOT EXISTS cache_entries_delete AFTER DELETE ON cache_entries BEGIN "
+    "UPDATE cache_usage SET entries = entries - 1, bytes = bytes - old.size WHERE namespace = old.namespace; "
+    "DELETE FROM cache_tags WHERE namespace = old.namespace AND key = old.key; END",
+]
+
+
+@contextmanager
+def _immediate(db):
+    """BEGIN IMMEDIATE ... COMMIT: prende subito il lock di scrittura, niente deadlock tra processi."""
+    db.execute("BEGIN IMMEDIATE")
+    try:
+        yield db
+    except BaseException:
+        db.execute("ROLLBACK")
+        raise
+    db.execute("COMMIT")
+
+
+# Un hit aggiorna last_used al massimo una volta in questo intervallo (secondi):
+# le letture frequenti della stessa voce non diventano scritture
+_TOUCH_INTERVAL = 1.0
+
+
+class SqliteCacheBackend:
+    """Archivio condiviso tra i processi dello stesso host (worker uvicorn/gunicorn)
+    in un file SQLite in modalita' WAL.
+
+    Stessa interfaccia di MemoryCacheBackend: i valori sono serializzati con
+    pickle e la dimensione e' quella serializzata. Piu' cache usano lo stesso
+    file con namespace diversi, ognuna con i propri limiti. Letture concorrenti
+    non si bloccano; le scritture sono serializzate da SQLite (attesa fino a
+    busy_timeout secondi). Il file contiene oggetti pickle: deve essere
+    scrivibile solo dall'utente del servizio.
+    """
+
+    shared = True
+
+    def __init__(self, path, namespace, max_bytes=0, max_entries=0, busy_timeout=30.0):
+        self.path = path
+        self.namespace = namespace
+        self.max_bytes = max_bytes
+        self.max_entries = max_entries
+        self.busy_timeout = busy_timeout
+        # Una connessione per thread: sqlite3 non va condiviso tra thread senza lock
+        self._local = threading.local()
+        self.evictions = 0
+        self.expirations = 0
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, exist_ok=True)
+        db = self._db()
+        with _immediate(db):
+            for statement in _SQLITE_SCHEMA:
+                db.execute(statement)
+
+    def _db(self):
+        db = getattr(self._local, "db", None)
+        if db is None:
+            db = sqlite3.connect(self.path, timeout=self.busy_timeout, isolation_level=None, check_same_thread=False)
+            db.execute("PRAGMA journal_mode=WAL")
+            # In WAL, NORMAL non perde la coerenza del file; al massimo le ultime scritture dopo un crash
+            db.execute("PRAGMA synchronous=NORMAL")
+            self._local.db = db
+        return db
+
+    def get(self, key):
+        db = self._db()
+        row = db.execute(
+            "SELECT value, expires, last_used FROM cache_entries WHERE namespace = ? AND key = ?",
+            (self.namespace, key),
+        ).fetchone()
+        if row is None:
+            return None
+        value, expires, last_used = row
+        now = time.time()
+        if expires is not None and expires <= now:
+            with _immediate(db):
+                db.execute("DELETE FROM cache_entries WHERE namespace = ? AND key = ? AND expires <= ?",
+                           (self.namespace, key, now))
+            self.expirations += 1
+            return None
+        if now - last_used >= _TOUCH_INTERVAL:
+            with _immediate(db):
+                db.execute("UPDATE cache_entries SET last_used = ? WHERE namespace = ? AND key = ?",
+                           (now, self.namespace, key))
+        return pickle.loads(value)
+
+    def put(self, key, value, size=0, ttl=None, tags=()):
+        blob = pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)
+        if self.max_bytes and len(blob) > self.max_bytes:
+            return False
+        now = time.time()
+        db = self._db()
+        with _immediate(db):
+            # DELETE + INSERT invece di INSERT OR REPLACE: cosi' scattano i trigger dei totali
+            db.execute("DELETE FROM cache_entries WHERE namespace = ? AND key = ?", (self.namespace, key))
+            db.execute(
+                "INSERT INTO cache_entries (namespace, key, value, size, expires, last_used) VALUES (?, ?, ?, ?, ?, ?)",
+                (self.namespace, key, blob, len(blob), now + ttl if ttl is not None else None, now),
+            )
+            db.executemany("INSERT OR IGNORE INTO cache_tags (namespace, tag, key) VALUES (?, ?, ?)",
+                           [(self.namespace, tag, key) for tag in tags])
+            self._evict(db)
+        return True
+
+    def _evict(self, db):
+        """Elimina le voci usate meno di recente finche' i totali rientrano nei limiti."""
+        while True:
+            entries, size = self._usage(db)
+            excess = entries - self.max_entries if self.max_entries else 0
+            if excess <= 0 and not (self.max_bytes and size > self.max_bytes):
+                return
+            removed = db.execute(
+                "DELETE FROM cache_entries WHERE rowid IN (SELECT rowid FROM cache_entries WHERE namespace = ? "
+                "ORDER BY last_used LIMIT ?)",
+                (self.namespace, max(excess, 1)),
+            ).rowcount
+            if not removed:
+                return
+            self.evictions += removed
+
+    def _usage(self, db):
+        row = db.execute("SELECT entries, bytes FROM cache_usage WHERE namespace = ?", (self.namespace,)).fetchone()
+        return tuple(row) if row else (0, 0)
+
+    def delete(self, key):
+        db = self._db()
+        with _immediate(db):
+            db.execute("DELETE FROM cache_entries WHERE namespace = ? AND key = ?", (self.namespace, key))
+
+    def invalidate(self, tags=None):
+        db = self._db()
+        with _immediate(db):
+            if tags is None:
+                return db.execute("DELETE FROM cache_entries WHERE namespace = ?", (self.namespace,)).rowcount
+            tags = list(tags)
+            if not tags:
+                return 0
+            return db.execute(
+                f"DELETE FROM cache_entries WHERE namespace = ? AND key IN (SELECT key FROM cache_tags "
+                f"WHERE namespace = ? AND tag IN ({', '.join('?' * len(tags))}))",
+                [self.namespace, self.namespace, *tags],
+            ).rowcount
+
+    def tags(self):
+        return {row[0] for row in self._db().execute(
+            "SELECT DISTINCT tag FROM cache_tags WHERE namespace = ?", (self.namespace,))}
+
+    @contextmanager
+    def lock(self, name=""):
+        """Lock esclusivo tra i processi su name nel namespace, ad esempio per
+        costruire lo schema di un database una volta sola invece che in ogni
+        worker all'avvio. Un file per nome: i lock di nomi diversi non si
+        attendono (flock blocca anche tra thread dello stesso processo)."""
+        if fcntl is None:
+            yield
+            return
+        suffix = hashlib.sha1(name.encode("utf-8")).hexdigest()[:16]
+        with open(f"{self.path}.{self.namespace}.{suffix}.lock", "a") as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def usage(self):
+        return self._usage(self._db())
+
+    @property
+    def bytes(self):
+        return self.usage()[1]
+
+    def stats(self):
+        entries, size = self.usage()
+        return {
+            "backend": "sqlite",
+            "path": self.path,
+            "namespace": self.namespace,
+            "entries": entries,
+            "bytes": size,
+            "max_bytes": self.max_bytes,
+            "max_entries": self.max_entries,
+            # Eliminazioni e scadenze viste da questo processo
+            "evictions": self.evictions,
+            "expirations": self.expirations,
+        }
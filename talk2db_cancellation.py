@@ -0,0 +1,102 @@
+import contextvars
+import logging
+import threading
+
+import anyio
+from sqlalchemy import event
+
+logger = logging.getLogger(__name__)
+
+# Handle della query in corso nel contesto corrente; anyio lo copia nel thread
+# che esegue la query, quindi il listener del motore lo ritrova li'
+current_query = contextvars.ContextVar("t2db_current_query", default=None)
+
+
+class QueryCancelled(Exception):
+    """La query e' stata annullata prima di essere inviata al database."""
+
+
+class QueryHandle:
+    """Riferimento all'istruzione in esecuzione in un thread, annullabile da un altro thread.
+
+    Il listener registrato da install_cancellation() vi collega il cursore
+    DB-API a ogni execute; cancel() interrompe l'istruzione lato database
+    (pyodbc: SQLCancel sul cursore, sqlite3: interrupt della connessione).
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._dbapi_connection = None
+        self._cursor = None
+        self.cancelled = False
+
+    def attach(self, dbapi_connection, cursor):
+        with self._lock:
+            if self.cancelled:
+                raise QueryCancelled("Query annullata")
+            self._dbapi_connection = dbapi_connection
+            self._cursor = cursor
+
+    def detach(self, dbapi_connection=None):
+        """Scollega il cursore (solo se appartiene a dbapi_connection, quando indicata)."""
+        with self._lock:
+            if dbapi_connection is None or dbapi_connection is self._dbapi_connection:
+                self._dbapi_connection = None
+                self._cursor = None
+
+    def cancel(self):
+        """Interrompe l'istruzione in corso (se c'e') e impedisce le successive."""
+        # Sotto il lock: la connessione non puo' tornare nel pool durante l'interruzione
+        with self._lock:
+            self.cancelled = True
+            connection, cursor = self._dbapi_connection, self._cursor
+            if cursor is None:
+                return
+            try:
+                if hasattr(connection, "interrupt"):
+                    connection.interrupt()
+                elif hasattr(cursor, "cancel"):
+                    cursor.cancel()
+                elif hasattr(connection, "cancel"):
+                    connection.cancel()
+                else:
+                    return
+                logger.info("Query annullata sul database.")
+            except Exception as e:
+                logger.warning(f"Annullamento della query non riuscito: {e}")
+
+
+def install_cancellation(engine):
+    """Collega ogni cursore eseguito dal motore all'eventuale QueryHandle del contesto."""
+
+    @event.listens_for(engine, "before_cursor_execute")
+    def attach_cursor(conn, cursor, statement, parameters, context, executemany):
+        handle = current_query.get()
+        if handle is not None:
+            handle.attach(conn.connection.dbapi_connection, cursor)
+
+    @event.listens_for(engine, "checkin")
+    def detach_connection(dbapi_connection, connection_record):
+        # La connessione torna nel pool e potra' servire un'altra richiesta:
+        # da qui in poi cancel() non deve piu' toccarla
+        handle = current_query.get()
+        if handle is not None:
+            handle.detach(dbapi_connection)
+
+
+async def run_cancellable(fn, *args, limiter=None, handle=None):
+    """Esegue fn in un thread; se il chiamante viene annullato (timeout o client
+    disconnesso) annulla anche l'istruzione sul database invece di attenderne la fine.
+
+    Il thread abbandonato termina non appena il database interrompe l'istruzione.
+    """
+    handle = handle or QueryHandle()
+    token = current_query.set(handle)
+    try:
+        return await anyio.to_thread.run_sync(fn, *args, limiter=limiter, abandon_on_cancel=True)
+    except anyio.get_cancelled_exc_class():
+        handle.cancel()
+        raise
+    finally:
+        current_query.reset(token)
+        handle.detach()
@@ -0,0 +1,194 @@
+import contextlib
+import hashlib
+import logging
+import threading
+import time
+
+from sqlalchemy import text
+
+from talk2db_introspection import format_schema
+from talk2db_retrieval import SchemaIndex
+
+logger = logging.getLogger(__name__)
+
+# Query leggere per capire se lo schema e' cambiato senza rileggerlo tutto.
+# Restituiscono un solo record: la modifica piu' recente e il numero di oggetti.
+VERSION_PROBE_QUERIES = {
+    "mssql": """
+        SELECT CONVERT(varchar(33), MAX(modify_date), 126), COUNT(*)
+        FROM sys.objects
+        WHERE type IN ('U', 'V', 'P')
+    """,
+    "sqlite": """
+        SELECT (SELECT schema_version FROM pragma_schema_version), COUNT(*)
+        FROM sqlite_master
+    """,
+}
+
+
+class SchemaSnapshot:
+    """Versione dello schema costruita una volta e condivisa tra le richieste."""
+
+    def __init__(self, model, probe_token, build_ms):
+        self.model = model
+        self.schema_context = format_schema(model)
+        # Indice per selezionare le parti di schema pertinenti alla domanda
+        self.index = SchemaIndex(model)
+        self.probe_token = probe_token
+        self.build_ms = build_ms
+        self.built_at = time.time()
+        # La versione dipende solo dal contenuto: resta stabile tra i riavvii
+        self.version = hashlib.sha1(self.schema_context.encode("utf-8")).hexdigest()[:12]
+
+
+class SchemaCatalog:
+    """Cache in memoria dello schema del database.
+
+    Lo schema viene ricostruito solo quando la sonda di versione rileva una
+    modifica, quando scade il TTL (se impostato) o su richiesta esplicita.
+
+    Con shared_cache (un backend condiviso tra i worker) lo snapshot costruito
+    da un processo viene riusato dagli altri con la stessa sonda di versione,
+    senza rileggere il catalogo; senza sonda (dialetti non supportati) ogni
+    processo lo costruisce da se'.
+    """
+
+    def __init__(self, engine, builder, ttl=0, probe_interval=10, shared_cache=None):
+        self.engine = engine
+        # Funzione senza argomenti che restituisce un SchemaModel
+        self.builder = builder
+        self.ttl = ttl
+        self.probe_interval = probe_interval
+        self.shared_cache = shared_cache
+        self._snapshot = None
+        self._last_probe = 0.0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.rebuilds = 0
+        self.shared_loads = 0
+        self.probes = 0
+        self.total_build_ms = 0.0
+        # Funzioni chiamate con il nuovo snapshot dopo ogni ricostruzione
+        self.listeners = []
+
+    def probe_version(self):
+        """Esegue la sonda di versione; None se il dialetto non la supporta."""
+        query = VERSION_PROBE_QUERIES.get(self.engine.dialect.name)
+        if query is None:
+            return None
+        try:
+            with self.engine.connect() as connection:
+                row = connection.execute(text(query)).fetchone()
+            self.probes += 1
+            return f"{row[0]}|{row[1]}"
+        except Exception as e:
+            # Se la sonda fallisce ci si affida al solo TTL
+            logger.warning(f"Sonda di versione dello schema non riuscita: {e}")
+            return None
+
+    def _is_stale(self, now):
+        snapshot = self._snapshot
+        if snapshot is None:
+            return True
+        if self.ttl and now - snapshot.built_at >= self.ttl:
+            return True
+        if now - self._last_probe < self.probe_interval:
+            return False
+        self._last_probe = now
+        token = self.probe_version()
+        return token is not None and token != snapshot.probe_token
+
+    def get(self):
+        """Restituisce lo snapshot corrente, ricostruendolo se non e' piu' valido."""
+        now = time.time()
+        if not self._is_stale(now):
+            self.hits += 1
+            return self._snapshot
+        with self._lock:
+            # Un'altra richiesta potrebbe averlo gia' ricostruito nel frattempo
+            if self._snapshot is not None and self._snapshot.built_at >= now:
+                self.hits += 1
+                return self._snapshot
+            self.misses += 1
+            return self._rebuild()
+
+    def refresh(self):
+        """Forza la ricostruzione dello schema (es. da endpoint amministrativo)."""
+        with self._lock:
+            return self._rebuild(use_shared=False)
+
+    def _shared_key(self, probe_token):
+        return hashlib.sha1(f"{self._database_key()}\x00{probe_token}".encode("utf-8")).hexdigest()
+
+    def _database_key(self):
+        return self.engine.url.render_as_string(hide_password=True)
+
+    def _load_shared(self, probe_token):
+        """Snapshot gia' costruito da un altro processo per la stessa versione, se ancora entro il TTL."""
+        if self.shared_cache is None or probe_token is None:
+            return None
+        try:
+            snapshot = self.shared_cache.get(self._shared_key(probe_token))
+        except Exception as e:
+            logger.warning(f"Lettura dello schema dalla cache condivisa non riuscita: {e}")
+            return None
+        if snapshot is None or (self.ttl and time.time() - snapshot.built_at >= self.ttl):
+            return None
+        return snapshot
+
+    def _store_shared(self, snapshot):
+        if self.shared_cache is None or snapshot.probe_token is None:
+            return
+        try:
+            self.shared_cache.put(self._shared_key(snapshot.probe_token), snapshot)
+        except Exception as e:
+            logger.warning(f"Scrittura dello schema nella cache condivisa non riuscita: {e}")
+
+    def _rebuild(self, use_shared=True):
+        start = time.perf_counter()
+        probe_token = self.probe_version()
+        # Con la cache condivisa un solo processo alla volta costruisce lo schema di
+        # questo database: gli altri, in attesa, lo trovano gia' pronto. Il lock e'
+        # per database, quindi la costruzione lenta di uno non ferma gli altri
+        shared = self.shared_cache is not None and probe_token is not None
+        with self.shared_cache.lock(self._database_key()) if shared else contextlib.nullcontext():
+            snapshot = self._load_shared(probe_token) if use_shared else None
+            if snapshot is not None:
+                self.shared_loads += 1
+                logger.info(f"Schema preso dalla cache condivisa (versione {snapshot.version}).")
+            else:
+                model = self.builder()
+                build_ms = (time.perf_counter() - start) * 1000
+                snapshot = SchemaSnapshot(model, probe_token, build_ms)
+                self.rebuilds += 1
+                self.total_build_ms += build_ms
+                logger.info(f"Schema ricostruito in {build_ms:.1f} ms (versione {snapshot.version}).")
+                self._store_shared(snapshot)
+        self._snapshot = snapshot
+        self._last_probe = time.time()
+        for listener in self.listeners:
+            try:
+                listener(self._snapshot)
+            except Exception as e:
+                logger.error(f"Errore nella notifica della ricostruzione dello schema: {e}")
+        return self._snapshot
+
+    def stats(self):
+        """Statistiche di utilizzo della cache dello schema."""
+        snapshot = self._snapshot
+        requests_count = self.hits + self.misses
+        return {
+            "version": snapshot.version if snapshot else None,
+            "built_at": snapshot.built_at if snapshot else None,
+            "last_build_ms": round(snapshot.build_ms, 1) if snapshot else None,
+            "total_build_ms": round(self.total_build_ms, 1),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / requests_count, 3) if requests_count else None,
+            "rebuilds": self.rebuilds,
+            "shared_loads": self.shared_loads,
+            "probes": self.probes,
+            "ttl": self.ttl,
+            "probe_interval": self.probe_interval,
+        }
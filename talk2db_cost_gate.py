@@ -0,0 +1,250 @@
+import logging
+import re
+import threading
+import time
+import xml.etree.ElementTree as ET
+from collections import OrderedDict
+
+from talk2db_result_cache import normalize_sql, table_references
+
+logger = logging.getLogger(__name__)
+
+SHOWPLAN_NS = {"p": "http://schemas.microsoft.com/sqlserver/2004/07/showplan"}
+# Operatori che leggono una tabella o un indice per intero
+SCAN_OPERATORS = {"Table Scan", "Clustered Index Scan", "Index Scan"}
+
+_SQLITE_SCAN_RE = re.compile(r"^SCAN (?:TABLE )?(\w+)", re.IGNORECASE)
+_SQLITE_SEARCH_RE = re.compile(r"^SEARCH (?:TABLE )?(\w+)", re.IGNORECASE)
+# Righe stimate per ogni accesso tramite indice nel modello approssimato di SQLite
+SQLITE_SEARCH_ROWS = 10
+
+
+class PlanEstimate:
+    """Stima dell'ottimizzatore per un'istruzione: righe, costo e letture complete di tabelle."""
+
+    def __init__(self, rows=0.0, cost=None, scans=None, cross_joins=0, plan_ms=0.0):
+        self.rows = rows
+        # Costo nelle unita' dell'ottimizzatore (None se il database non lo fornisce)
+        self.cost = cost
+        # Coppie (tabella, righe della tabella) lette per intero
+        self.scans = scans or []
+        self.cross_joins = cross_joins
+        self.plan_ms = plan_ms
+
+    def to_dict(self):
+        return {
+            "estimated_rows": round(self.rows),
+            "estimated_cost": round(self.cost, 3) if self.cost is not None else None,
+            "full_scans": [{"table": table, "rows": round(rows)} for table, rows in self.scans],
+            "cross_joins": self.cross_joins,
+        }
+
+
+class QueryRejected(Exception):
+    """Istruzione bloccata dal controllo dei costi prima dell'esecuzione."""
+
+    def __init__(self, reasons, estimate, sql=None):
+        super().__init__("Query bloccata dal controllo dei costi: " + "; ".join(reasons))
+        self.reasons = reasons
+        self.estimate = estimate
+        self.sql = sql
+
+
+def _float(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return 0.0
+
+
+def parse_showplan(xml):
+    """Estrae righe e costo stimati, scansioni complete e join senza predicato da uno SHOWPLAN_XML."""
+    root = ET.fromstring(xml)
+    estimate = PlanEstimate(cost=0.0)
+    for statement in root.iterfind(".//p:StmtSimple", SHOWPLAN_NS):
+        estimate.rows = max(estimate.rows, _float(statement.get("StatementEstRows")))
+        estimate.cost += _float(statement.get("StatementSubTreeCost"))
+    for operator in root.iterfind(".//p:RelOp", SHOWPLAN_NS):
+        if operator.find("p:Warnings[@NoJoinPredicate='true']", SHOWPLAN_NS) is not None:
+            estimate.cross_joins += 1
+        if operator.get("PhysicalOp") in SCAN_OPERATORS:
+            table = operator.find(".//p:Object", SHOWPLAN_NS)
+            name = table.get("Table", "?").strip("[]") if table is not None else "?"
+            rows = _float(operator.get("TableCardinality") or operator.get("EstimateRows"))
+            estimate.scans.append((name, rows))
+    return estimate
+
+
+def _mssql_estimate(connection, sql):
+    # SHOWPLAN_XML deve essere l'unica istruzione del batch; con l'opzione
+    # attiva le istruzioni vengono compilate ma non eseguite
+    connection.exec_driver_sql("SET SHOWPLAN_XML ON")
+    try:
+        rows = connection.exec_driver_sql(sql).fetchall()
+    finally:
+        connection.exec_driver_sql("SET SHOWPLAN_XML OFF")
+    estimate = PlanEstimate(cost=0.0)
+    for row in rows:
+        part = parse_showplan(row[0])
+        estimate.rows = max(estimate.rows, part.rows)
+        estimate.cost += part.cost
+        estimate.scans += part.scans
+        estimate.cross_joins += part.cross_joins
+    return estimate
+
+
+def _sqlite_table_rows(connection, table, cache):
+    """Righe della tabella: da sqlite_stat1 se ANALYZE e' stato eseguito, altrimenti MAX(rowid)."""
+    if table not in cache:
+        rows = None
+        try:
+            stat = connection.exec_driver_sql(
+                "SELECT stat FROM sqlite_stat1 WHERE tbl = ? COLLATE NOCASE AND idx IS NULL", (table,)
+            ).fetchone()
+            rows = int(stat[0].split()[0]) if stat else None
+        except Exception:
+            pass
+        if rows is None:
+            try:
+                rows = connection.exec_driver_sql(f'SELECT MAX(rowid) FROM "{table}"').scalar() or 0
+            except Exception:
+                rows = 0
+        cache[table] = rows
+    return cache[table]
+
+
+def _sqlite_estimate(connection, sql):
+    """SQLite non stima righe e costi: le righe si approssimano moltiplicando quelle
+    delle tabelle lette per intero (SCAN) e un fattore fisso per gli accessi con
+    indice (SEARCH), come farebbe un nested loop; un prodotto cartesiano emerge
+    quindi dal numero di righe stimate."""
+    plan = connection.exec_driver_sql(f"EXPLAIN QUERY PLAN {sql}").fetchall()
+    estimate = PlanEstimate(rows=1.0)
+    sizes = {}
+    # Il piano cita le tabelle con il loro alias
+    aliases = {alias: table for table, alias in table_references(sql) if alias}
+    for row in plan:
+        detail = row[-1]
+        scan = _SQLITE_SCAN_RE.match(detail)
+        if scan and scan.group(1).upper() != "CONSTANT":
+            # SCAN legge tutte le righe (anche tramite indice coprente)
+            table = aliases.get(scan.group(1).lower(), scan.group(1))
+            rows = _sqlite_table_rows(connection, table, sizes)
+            estimate.scans.append((table, rows))
+            estimate.rows *= max(rows, 1)
+        elif _SQLITE_SEARCH_RE.match(detail):
+            estimate.rows *= SQLITE_SEARCH_ROWS
+    return estimate
+
+
+ESTIMATORS = {
+    "mssql": _mssql_estimate,
+    "sqlite": _sqlite_estimate,
+}
+
+
+class CostGate:
+    """Controllo facoltativo dei costi prima dell'esecuzione della SQL generata.
+
+    mode "off" non fa nulla, "warn" registra e restituisce i motivi, "reject"
+    solleva QueryRejected. Le stime sono memorizzate per SQL normalizzata,
+    quindi una query ripetuta non richiede un nuovo piano.
+    """
+
+    def __init__(self, engine, mode="off", max_rows=0, max_cost=0, max_scan_rows=0, reject_cross_joins=True,
+                 cache_size=512):
+        self.engine = engine
+        self.mode = mode
+        self.max_rows = max_rows
+        self.max_cost = max_cost
+        self.max_scan_rows = max_scan_rows
+        self.reject_cross_joins = reject_cross_joins
+        self.cache_size = cache_size
+        self._estimates = OrderedDict()
+        self._lock = threading.Lock()
+        self.checks = 0
+        self.plans = 0
+        self.warned = 0
+        self.rejected = 0
+        self.errors = 0
+        self.total_plan_ms = 0.0
+
+    @property
+    def enabled(self):
+        return self.mode in ("warn", "reject") and self.engine.dialect.name in ESTIMATORS
+
+    def estimate(self, sql):
+        """Piano stimato della SQL (dalla cache se gia' calcolato)."""
+        key = normalize_sql(sql)
+        with self._lock:
+            cached = self._estimates.get(key)
+            if cached is not None:
+                self._estimates.move_to_end(key)
+                return cached
+        start = time.perf_counter()
+        with self.engine.connect() as connection:
+            estimate = ESTIMATORS[self.engine.dialect.name](connection, sql)
+        estimate.plan_ms = (time.perf_counter() - start) * 1000
+        with self._lock:
+            self.plans += 1
+            self.total_plan_ms += estimate.plan_ms
+            self._estimates[key] = estimate
+            while len(self._estimates) > self.cache_size:
+                self._estimates.popitem(last=False)
+        return estimate
+
+    def reasons(self, estimate):
+        """Soglie superate dalla stima, in forma leggibile."""
+        reasons = []
+        if self.max_rows and estimate.rows > self.max_rows:
+            reasons.append(f"righe stimate {estimate.rows:,.0f} oltre il limite di {self.max_rows:,.0f}")
+        if self.max_cost and estimate.cost is not None and estimate.cost > self.max_cost:
+            reasons.append(f"costo stimato {estimate.cost:,.2f} oltre il limite di {self.max_cost:,g}")
+        if self.max_scan_rows:
+            for table, rows in estimate.scans:
+                if rows > self.max_scan_rows:
+                    reasons.append(f"lettura completa di {table} ({rows:,.0f} righe)")
+        if self.reject_cross_joins and estimate.cross_joins:
+            reasons.append("join senza condizione (prodotto cartesiano)")
+        return reasons
+
+    def check(self, sql):
+        """Valuta la SQL; restituisce i motivi di avviso (lista vuota se nei limiti).
+
+        In modalita' "reject" solleva QueryRejected invece di restituire i motivi.
+        Se il piano non si puo' ottenere la query non viene bloccata.
+        """
+        if not self.enabled:
+            return []
+        self.checks += 1
+        try:
+            estimate = self.estimate(sql)
+        except Exception as e:
+            self.errors += 1
+            logger.warning(f"Piano stimato non disponibile, controllo dei costi saltato: {e}")
+            return []
+        reasons = self.reasons(estimate)
+        if not reasons:
+            return []
+        if self.mode == "reject":
+            self.rejected += 1
+            logger.warning(f"Query bloccata dal controllo dei costi ({'; '.join(reasons)}): {sql}")
+            raise QueryRejected(reasons, estimate, sql)
+        self.warned += 1
+        logger.warning(f"Query oltre le soglie di costo ({'; '.join(reasons)}): {sql}")
+        return reasons
+
+    def stats(self):
+        return {
+            "mode": self.mode,
+            "enabled": self.enabled,
+            "max_rows": self.max_rows,
+            "max_cost": self.max_cost,
+            "max_scan_rows": self.max_scan_rows,
+            "checks": self.checks,
+            "plans": self.plans,
+            "warned": self.warned,
+            "rejected": self.rejected,
+            "errors": self.errors,
+            "avg_plan_ms": round(self.total_plan_ms / self.plans, 2) if self.plans else None,
+        }
@@ -1,53 +1,166 @@
-import gradio as gr
-import requests
 import json
+import os
+import threading
+
+import requests
+from requests.adapters import HTTPAdapter
+
+# Indirizzo del servizio talk2db (uvicorn talk2db_service:app)
+SERVICE_URL = os.getenv("T2DB_FRONTEND_SERVICE_URL", "http://localhost:8000").rstrip("/")
+# Righe mostrate per pagina: le successive si chiedono al servizio con il token di continuazione
+PAGE_SIZE = int(os.getenv("T2DB_FRONTEND_PAGE_SIZE", "100"))
+# Timeout di connessione e di lettura verso il servizio (secondi)
+TIMEOUT = (
+    float(os.getenv("T2DB_FRONTEND_CONNECT_TIMEOUT", "5")),
+    float(os.getenv("T2DB_FRONTEND_READ_TIMEOUT", "300")),
+)
+
+_session = None
+_session_lock = threading.Lock()
+
+
+def get_session():
+    """Sessione HTTP condivisa: le richieste riusano le connessioni verso il servizio (keep-alive)."""
+    global _session
+    with _session_lock:
+        if _session is None:
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_maxsize=int(os.getenv("T2DB_FRONTEND_POOL_SIZE", "10")))
+            session.mount("http://", adapter)
+            session.mount("https://", adapter)
+            _session = session
+        return _session
+
+
+def call_service(path, payload):
+    """POST al servizio; solleva RuntimeError con il dettaglio dell'errore restituito."""
+    try:
+        response = get_session().post(f"{SERVICE_URL}{path}", json=payload, timeout=TIMEOUT)
+    except requests.exceptions.RequestException as e:
+        raise RuntimeError(f"Errore durante la richiesta: {e}")
+    if response.status_code >= 400:
+        try:
+            detail = response.json().get("detail")
+        except ValueError:
+            detail = response.text
+        if isinstance(detail, dict):
+            detail = detail.get("error", detail)
+        raise RuntimeError(f"Errore {response.status_code}: {detail}")
+    return response.json()
+
+
+def page_table(data, offset):
+    """Righe della pagina per gr.Dataframe, numerate a partire da offset + 1; None se vuota."""
+    # results contiene solo la pagina corrente (al massimo PAGE_SIZE righe)
+    records = json.loads(data.get("results") or "[]")
+    if not records:
+        return None
+    columns = list(records[0].keys())
+    rows = [[offset + index + 1] + list(record.values()) for index, record in enumerate(records)]
+    return {"data": rows, "headers": ["#"] + columns}
+
+
+def new_view(question):
+    """Stato della navigazione: token di ogni pagina visitata (None = la domanda) e prima riga di ciascuna."""
+    return {"question": question, "tokens": [None], "offsets": [0], "index": 0, "next_token": None, "sql_query": ""}
+
+
+def load_page(view, index):
+    """Scarica la pagina index della vista (0 = prima pagina della domanda) e la rende corrente.
+
+    Restituisce (sql_query, tabella, stato) per l'interfaccia; la pagina 0
+    ripete la domanda, servita dalle cache del servizio.
+    """
+    token = view["tokens"][index]
+    if token is None:
+        data = call_service("/question", {"question": view["question"], "page_size": PAGE_SIZE})
+    else:
+        data = call_service("/question/page", {"page_token": token})
+    view["index"] = index
+    view["sql_query"] = data.get("sql_query") or "Nessuna query SQL generata."
+    view["next_token"] = data.get("next_page_token")
+    offset = view["offsets"][index]
+    table = page_table(data, offset)
+    rows = len(table["data"]) if table else 0
+    if view["next_token"] and index + 1 == len(view["tokens"]):
+        view["tokens"].append(view["next_token"])
+        view["offsets"].append(offset + rows)
+    if not rows:
+        status = "Nessun risultato trovato."
+    else:
+        status = f"Pagina {index + 1}: righe {offset + 1}-{offset + rows}"
+        if view["next_token"]:
+            status += ", altre disponibili"
+        elif data.get("truncated"):
+            status += " (risultato troncato dal servizio)"
+    if data.get("cost_warnings"):
+        status += "\nAvvisi: " + "; ".join(data["cost_warnings"])
+    return view["sql_query"], table, status
+
 
 # Funzione per inviare una domanda al tuo servizio AI
 def query_service(question):
-    url = "http://localhost:8000/question"  # Endpoint del tuo servizio
-    payload = {"question": question}  # La domanda che invii come JSON
+    """Prima pagina dei risultati della domanda: (sql_query, tabella, stato, vista)."""
+    view = new_view(question)
     try:
-        # Invia la richiesta al servizio AI
-        response = requests.post(url, json=payload)
-        response.raise_for_status()  # Solleva un'eccezione se la risposta è un errore HTTP
-        data = response.json()  # Ottieni la risposta in formato JSON
-        
-        # Estrai i dati dalla risposta
-        sql_query = data.get("sql_query", "Nessuna query SQL generata.")
-        results = data.get("results", "[]")  # Assicurati che results sia una stringa JSON valida
-        
-        # Converti la stringa JSON in una lista di dizionari
-        results_list = json.loads(results)  # Deserializza la stringa JSON
-        
-        # Se i risultati sono vuoti, restituisci un messaggio
-        if not results_list:
-            return sql_query, "Nessun risultato trovato."
-        
-        # Estrai le etichette delle colonne (chiavi del primo dizionario)
-        column_labels = list(results_list[0].keys())
-        
-        # Aggiungi la numerazione delle righe come prima colonna
-        table_data = [
-            [index + 1] + list(result.values()) for index, result in enumerate(results_list)
-        ]
-        
-        # Aggiungi il nome della colonna per la numerazione
-        column_labels = ['#'] + column_labels
-        
-        # Restituisci la query SQL e la tabella (con intestazioni e dati)
-        return sql_query, {"data": table_data, "headers": column_labels}
-    
-    except requests.exceptions.RequestException as e:
-        return f"Errore durante la richiesta: {e}", {}
-
-# Crea l'interfaccia Gradio
-iface = gr.Interface(
-    fn=query_service,  # La funzione da chiamare
-    inputs=gr.Textbox(label="Fai una domanda"),  # Un campo di testo per l'input
-    outputs=[gr.Textbox(label="SQL Query"), gr.Dataframe(label="Risultati")],  # Due output: uno per la query e uno per la tabella
-    live=False  # La domanda viene inviata solo quando si preme il tasto "Invia"
-)
+        return (*load_page(view, 0), view)
+    except RuntimeError as e:
+        return str(e), None, "", view
+
+
+def next_page(view):
+    if not view or not view["next_token"]:
+        return view and view["sql_query"], None, "Nessuna pagina successiva.", view
+    try:
+        return (*load_page(view, view["index"] + 1), view)
+    except RuntimeError as e:
+        return view["sql_query"], None, str(e), view
+
+
+def previous_page(view):
+    if not view or view["index"] == 0:
+        return view and view["sql_query"], None, "Nessuna pagina precedente.", view
+    try:
+        return (*load_page(view, view["index"] - 1), view)
+    except RuntimeError as e:
+        return view["sql_query"], None, str(e), view
+
+
+def create_interface():
+    """Crea l'interfaccia Gradio (gradio viene importato solo qui: il modulo resta importabile senza).
+
+    Il browser riceve una pagina alla volta: la prima appena il servizio la
+    restituisce, le altre con i pulsanti di navigazione.
+    """
+    import gradio as gr
+
+    def with_buttons(sql_query, table, status, view):
+        has_previous = bool(view) and view["index"] > 0
+        has_next = bool(view) and bool(view["next_token"])
+        return (
+            sql_query, table, status, view,
+            gr.update(interactive=has_previous), gr.update(interactive=has_next),
+        )
+
+    with gr.Blocks() as interface:
+        view = gr.State(None)
+        question = gr.Textbox(label="Fai una domanda")
+        ask = gr.Button("Invia", variant="primary")
+        sql_query = gr.Textbox(label="SQL Query")
+        results = gr.Dataframe(label="Risultati")
+        status = gr.Markdown()
+        with gr.Row():
+            previous = gr.Button("Pagina precedente", interactive=False)
+            following = gr.Button("Pagina successiva", interactive=False)
+
+        outputs = [sql_query, results, status, view, previous, following]
+        for trigger in (ask.click, question.submit):
+            trigger(lambda text: with_buttons(*query_service(text)), inputs=question, outputs=outputs)
+        following.click(lambda state: with_buttons(*next_page(state)), inputs=view, outputs=outputs)
+        previous.click(lambda state: with_buttons(*previous_page(state)), inputs=view, outputs=outputs)
+    return interface
 
 
-# Avvia l'interfaccia
-iface.launch()
+if __name__ == "__main__":
+    # Avvia l'interfaccia; piu' richieste alla volta condividono la sessione HTTP
+    create_interface().queue(default_concurrency_limit=int(os.getenv("T2DB_FRONTEND_CONCURRENCY", "4"))).launch()
@@ -0,0 +1,231 @@
+import logging
+from dataclasses import dataclass, field
+
+from sqlalchemy import inspect, text
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class ColumnInfo:
+    name: str
+    type: str
+    nullable: bool = True
+
+
+@dataclass
+class ForeignKeyInfo:
+    name: str
+    columns: list
+    referred_table: str
+    referred_columns: list
+
+
+@dataclass
+class TableInfo:
+    name: str
+    columns: list = field(default_factory=list)
+    primary_key: list = field(default_factory=list)
+    foreign_keys: list = field(default_factory=list)
+
+
+@dataclass
+class ProcedureInfo:
+    name: str
+    # Coppie (nome senza '@', tipo)
+    parameters: list = field(default_factory=list)
+
+
+@dataclass
+class SchemaModel:
+    tables: dict = field(default_factory=dict)
+    procedures: list = field(default_factory=list)
+
+
+# Query di catalogo per SQL Server: un numero costante di query, qualunque sia
+# il numero di tabelle o di procedure. Limitate allo schema di default
+# dell'utente, come inspector.get_table_names().
+MSSQL_COLUMNS_QUERY = """
+    SELECT c.TABLE_NAME, c.COLUMN_NAME, c.DATA_TYPE, c.IS_NULLABLE
+    FROM INFORMATION_SCHEMA.COLUMNS c
+    JOIN INFORMATION_SCHEMA.TABLES t
+        ON t.TABLE_SCHEMA = c.TABLE_SCHEMA AND t.TABLE_NAME = c.TABLE_NAME
+    WHERE t.TABLE_TYPE = 'BASE TABLE' AND t.TABLE_SCHEMA = SCHEMA_NAME()
+    ORDER BY c.TABLE_NAME, c.ORDINAL_POSITION
+"""
+
+MSSQL_PRIMARY_KEYS_QUERY = """
+    SELECT kcu.TABLE_NAME, kcu.COLUMN_NAME
+    FROM INFORMATION_SCHEMA.TABLE_CONSTRAINTS tc
+    JOIN INFORMATION_SCHEMA.KEY_COLUMN_USAGE kcu
+        ON kcu.CONSTRAINT_SCHEMA = tc.CONSTRAINT_SCHEMA AND kcu.CONSTRAINT_NAME = tc.CONSTRAINT_NAME
+    WHERE tc.CONSTRAINT_TYPE = 'PRIMARY KEY' AND tc.TABLE_SCHEMA = SCHEMA_NAME()
+    ORDER BY kcu.TABLE_NAME, kcu.ORDINAL_POSITION
+"""
+
+MSSQL_FOREIGN_KEYS_QUERY = """
+    SELECT fk.name, tp.name, cp.name, tr.name, cr.name
+    FROM sys.foreign_key_columns fkc
+    JOIN sys.foreign_keys fk ON fk.object_id = fkc.constraint_object_id
+    JOIN sys.tables tp ON tp.object_id = fkc.parent_object_id
+    JOIN sys.columns cp ON cp.object_id = fkc.parent_object_id AND cp.column_id = fkc.parent_column_id
+    JOIN sys.tables tr ON tr.object_id = fkc.referenced_object_id
+    JOIN sys.columns cr ON cr.object_id = fkc.referenced_object_id AND cr.column_id = fkc.referenced_column_id
+    WHERE tp.schema_id = SCHEMA_ID()
+    ORDER BY tp.name, fk.name, fkc.constraint_column_id
+"""
+
+MSSQL_PROCEDURES_QUERY = """
+    SELECT r.SPECIFIC_SCHEMA, r.SPECIFIC_NAME, p.PARAMETER_NAME, p.DATA_TYPE
+    FROM INFORMATION_SCHEMA.ROUTINES r
+    LEFT JOIN INFORMATION_SCHEMA.PARAMETERS p
+        ON p.SPECIFIC_SCHEMA = r.SPECIFIC_SCHEMA AND p.SPECIFIC_NAME = r.SPECIFIC_NAME
+    WHERE r.ROUTINE_TYPE = 'PROCEDURE'
+    ORDER BY r.SPECIFIC_SCHEMA, r.SPECIFIC_NAME, p.ORDINAL_POSITION
+"""
+
+# Equivalenti per SQLite, usato come sostituto locale nei benchmark
+SQLITE_COLUMNS_QUERY = """
+    SELECT m.name, p.name, p.type, p."notnull", p.pk
+    FROM sqlite_master m
+    JOIN pragma_table_info(m.name) p
+    WHERE m.type = 'table' AND m.name NOT LIKE 'sqlite_%'
+    ORDER BY m.name, p.cid
+"""
+
+SQLITE_FOREIGN_KEYS_QUERY = """
+    SELECT m.name, f.id, f."from", f."table", f."to"
+    FROM sqlite_master m
+    JOIN pragma_foreign_key_list(m.name) f
+    WHERE m.type = 'table' AND m.name NOT LIKE 'sqlite_%'
+    ORDER BY m.name, f.id, f.seq
+"""
+
+# SQLite non ha procedure: i benchmark le simulano con questa tabella
+# (una riga per parametro, parameter_name NULL per le procedure senza parametri)
+SQLITE_PROCEDURES_TABLE = "t2db_procedures"
+SQLITE_PROCEDURES_QUERY = f"""
+    SELECT procedure_name, parameter_name, data_type
+    FROM {SQLITE_PROCEDURES_TABLE}
+    ORDER BY procedure_name, position
+"""
+
+
+def _add_foreign_key(table, name, column, referred_table, referred_column):
+    """Accoda una colonna alla FK con lo stesso nome (FK composte su piu' righe)."""
+    if table.foreign_keys and table.foreign_keys[-1].name == name:
+        fk = table.foreign_keys[-1]
+    else:
+        fk = ForeignKeyInfo(name, [], referred_table, [])
+        table.foreign_keys.append(fk)
+    fk.columns.append(column)
+    fk.referred_columns.append(referred_column)
+
+
+def _load_mssql(connection, model):
+    for table_name, column_name, data_type, is_nullable in connection.execute(text(MSSQL_COLUMNS_QUERY)):
+        table = model.tables.setdefault(table_name, TableInfo(table_name))
+        table.columns.append(ColumnInfo(column_name, data_type, is_nullable == "YES"))
+
+    for table_name, column_name in connection.execute(text(MSSQL_PRIMARY_KEYS_QUERY)):
+        if table_name in model.tables:
+            model.tables[table_name].primary_key.append(column_name)
+
+    for fk_name, table_name, column_name, referred_table, referred_column in connection.execute(text(MSSQL_FOREIGN_KEYS_QUERY)):
+        if table_name in model.tables:
+            _add_foreign_key(model.tables[table_name], fk_name, column_name, referred_table, referred_column)
+
+    # Procedure con lo stesso nome in schemi diversi restano distinte: nome qualificato
+    procedures = {}
+    for proc_schema, proc_name, param_name, data_type in connection.execute(text(MSSQL_PROCEDURES_QUERY)):
+        proc = procedures.get((proc_schema, proc_name))
+        if proc is None:
+            proc = procedures[(proc_schema, proc_name)] = ProcedureInfo(f"{proc_schema}.{proc_name}")
+        if param_name:
+            proc.parameters.append((param_name.replace("@", ""), data_type))
+    model.procedures = list(procedures.values())
+
+
+def _load_sqlite(connection, model):
+    pk_positions = {}
+    for table_name, column_name, data_type, notnull, pk in connection.execute(text(SQLITE_COLUMNS_QUERY)):
+        table = model.tables.setdefault(table_name, TableInfo(table_name))
+        table.columns.append(ColumnInfo(column_name, data_type, not notnull))
+        if pk:
+            pk_positions.setdefault(table_name, []).append((pk, column_name))
+
+    for table_name, positions in pk_positions.items():
+        model.tables[table_name].primary_key = [name for _, name in sorted(positions)]
+
+    for table_name, fk_id, column_name, referred_table, referred_column in connection.execute(text(SQLITE_FOREIGN_KEYS_QUERY)):
+        _add_foreign_key(model.tables[table_name], f"fk_{table_name}_{fk_id}", column_name, referred_table, referred_column)
+
+    if model.tables.pop(SQLITE_PROCEDURES_TABLE, None) is not None:
+        procedures = {}
+        for proc_name, param_name, data_type in connection.execute(text(SQLITE_PROCEDURES_QUERY)):
+            proc = procedures.get(proc_name)
+            if proc is None:
+                proc = procedures[proc_name] = ProcedureInfo(proc_name)
+            if param_name:
+                proc.parameters.append((param_name, data_type))
+        model.procedures = list(procedures.values())
+
+
+def _load_generic(connection, model):
+    """Per gli altri dialetti usa la riflessione multi-tabella di SQLAlchemy."""
+    inspector = inspect(connection)
+    for (_, table_name), columns in sorted(inspector.get_multi_columns().items()):
+        table = model.tables.setdefault(table_name, TableInfo(table_name))
+        table.columns = [ColumnInfo(c["name"], str(c["type"]), c.get("nullable", True)) for c in columns]
+
+    for (_, table_name), pk in inspector.get_multi_pk_constraint().items():
+        if table_name in model.tables:
+            model.tables[table_name].primary_key = list(pk.get("constrained_columns") or [])
+
+    for (_, table_name), fks in inspector.get_multi_foreign_keys().items():
+        if table_name in model.tables:
+            model.tables[table_name].foreign_keys = [
+                ForeignKeyInfo(fk.get("name") or "", fk["constrained_columns"], fk["referred_table"], fk["referred_columns"])
+                for fk in fks
+            ]
+
+
+LOADERS = {
+    "mssql": _load_mssql,
+    "sqlite": _load_sqlite,
+}
+
+
+def load_schema_model(engine, excluded_tables=()):
+    """Carica tabelle, colonne, chiavi e procedure con poche query di catalogo su una sola connessione."""
+    try:
+        model = SchemaModel()
+        loader = LOADERS.get(engine.dialect.name, _load_generic)
+        with engine.connect() as connection:
+            loader(connection, model)
+
+        excluded = set(excluded_tables)
+        model.tables = {name: table for name, table in model.tables.items() if name not in excluded}
+        return model
+    except Exception as e:
+        logger.error(f"Errore nell'introspezione del catalogo del database: {e}")
+        raise
+
+
+def format_table(table):
+    """Formato compatto di una tabella: 'Tabella (col1, col2, ...)'."""
+    return f"{table.name} ({', '.join(column.name for column in table.columns)})"
+
+
+def format_procedure(procedure):
+    """Formato compatto di una procedura: 'proc(param tipo, ...)'."""
+    param_list = [f"{name} {data_type}" for name, data_type in procedure.parameters]
+    return f"{procedure.name}({', '.join(param_list)})"
+
+
+def format_schema(model, include_procedures=True):
+    """Restituisce lo schema nello stesso formato testuale usato nei prompt."""
+    schema_context = "".join(f"{format_table(table)}\n" for table in model.tables.values())
+    if include_procedures:
+        schema_context += "\n".join(format_procedure(procedure) for procedure in model.procedures)
+    return schema_context
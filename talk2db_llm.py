@@ -0,0 +1,147 @@
+import asyncio
+import logging
+import random
+import time
+
+import httpx
+
+from talk2db_metrics import record_llm_tokens
+from talk2db_serializer import estimate_tokens
+
+logger = logging.getLogger(__name__)
+
+# Stati HTTP per cui ha senso ritentare: limiti di frequenza e errori lato server
+RETRY_STATUS_CODES = {408, 409, 429, 500, 502, 503, 504}
+
+
+class LLMError(Exception):
+    """Errore restituito da un provider LLM dopo l'esaurimento dei tentativi."""
+
+    def __init__(self, message, status_code=None):
+        super().__init__(message)
+        self.status_code = status_code
+
+
+class LLMBackend:
+    """Client HTTP persistente verso un provider LLM.
+
+    Mantiene un pool di connessioni keep-alive, applica timeout di
+    connessione e lettura, ritenta con backoff esponenziale e jitter sugli
+    errori transitori e limita le richieste concorrenti al provider.
+    """
+
+    name = "llm"
+
+    def __init__(self, base_url, headers=None, connect_timeout=5.0, read_timeout=60.0,
+                 max_retries=3, backoff_base=0.5, backoff_max=8.0, concurrency=8):
+        self.base_url = base_url
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.concurrency = concurrency
+        self._headers = headers or {}
+        self._timeout = httpx.Timeout(read_timeout, connect=connect_timeout)
+        self._limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency, keepalive_expiry=60)
+        self._client = None
+        self._semaphore = asyncio.Semaphore(concurrency)
+        self.requests = 0
+        self.retries = 0
+        self.failures = 0
+
+    @property
+    def client(self):
+        # Creato alla prima richiesta, dentro l'event loop che lo usera'
+        if self._client is None:
+            self._client = httpx.AsyncClient(headers=self._headers, timeout=self._timeout, limits=self._limits)
+        return self._client
+
+    def _backoff(self, attempt, response=None):
+        """Attesa prima del tentativo successivo: Retry-After se presente, altrimenti full jitter."""
+        if response is not None:
+            retry_after = response.headers.get("Retry-After")
+            if retry_after:
+                try:
+                    return min(float(retry_after), self.backoff_max)
+                except ValueError:
+                    pass
+        return random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** attempt))
+
+    async def post_json(self, url, payload):
+        """POST JSON con timeout, tentativi limitati e tetto alla concorrenza."""
+        async with self._semaphore:
+            for attempt in range(self.max_retries + 1):
+                self.requests += 1
+                response = None
+                try:
+                    response = await self.client.post(url, json=payload)
+                    if response.status_code < 400:
+                        return response.json()
+                    if response.status_code not in RETRY_STATUS_CODES:
+                        self.failures += 1
+                        raise LLMError(f"{self.name}: {response.status_code} - {response.text}", response.status_code)
+                    error = LLMError(f"{self.name}: {response.status_code} - {response.text}", response.status_code)
+                except httpx.TransportError as e:
+                    error = LLMError(f"{self.name}: {type(e).__name__} - {e}")
+
+                if attempt == self.max_retries:
+                    self.failures += 1
+                    raise error
+                delay = self._backoff(attempt, response)
+                self.retries += 1
+                logger.warning(f"{error}; nuovo tentativo {attempt + 1}/{self.max_retries} tra {delay:.2f} s")
+                await asyncio.sleep(delay)
+
+    async def aclose(self):
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+    def stats(self):
+        return {
+            "base_url": self.base_url,
+            "concurrency": self.concurrency,
+            "requests": self.requests,
+            "retries": self.retries,
+            "failures": self.failures,
+        }
+
+
+class OpenAIBackend(LLMBackend):
+    """Chat completions compatibili con l'API OpenAI (anche server locali o proxy)."""
+
+    name = "openai"
+
+    def __init__(self, api_key, model, base_url="https://api.openai.com/v1", **options):
+        super().__init__(base_url.rstrip("/"), headers={"Authorization": f"Bearer {api_key}"}, **options)
+        self.model = model
+
+    async def chat(self, messages):
+        """Restituisce il testo della prima risposta del modello."""
+        start = time.perf_counter()
+        data = await self.post_json(f"{self.base_url}/chat/completions", {"model": self.model, "messages": messages})
+        usage = data.get("usage") or {}
+        record_llm_tokens(self.name, usage.get("prompt_tokens"), usage.get("completion_tokens"))
+        logger.info(
+            f"Risposta OpenAI in {(time.perf_counter() - start) * 1000:.0f} ms "
+            f"({usage.get('prompt_tokens')} token di prompt, {usage.get('completion_tokens')} di risposta)."
+        )
+        return data["choices"][0]["message"]["content"]
+
+
+class HuggingFaceBackend(LLMBackend):
+    """Endpoint di inferenza Hugging Face (text generation)."""
+
+    name = "huggingface"
+
+    def __init__(self, api_url, api_token, **options):
+        super().__init__(api_url, headers={"Authorization": f"Bearer {api_token}"}, **options)
+
+    async def generate(self, prompt):
+        """Restituisce il testo generato per il prompt."""
+        start = time.perf_counter()
+        data = await self.post_json(self.base_url, {"inputs": prompt})
+        logger.info(f"Risposta Hugging Face in {(time.perf_counter() - start) * 1000:.0f} ms.")
+        text = data[0]["generated_text"]
+        # L'endpoint non riporta l'uso di token: stima locale
+        record_llm_tokens(self.name, estimate_tokens(prompt), estimate_tokens(text))
+        return text
@@ -0,0 +1,236 @@
+import contextvars
+import logging
+import threading
+import time
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+# Limiti superiori (secondi) dei bucket degli istogrammi di latenza
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _labels(names, values, extra=None):
+    pairs = list(zip(names, values)) + (extra or [])
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in pairs) + "}"
+
+
+def _number(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    """Contatore monotono con etichette, nel formato di esposizione Prometheus."""
+
+    type = "counter"
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1, **labels):
+        key = tuple(str(labels.get(name, "")) for name in self.labelnames)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def samples(self):
+        with self._lock:
+            return [(self.name, _labels(self.labelnames, key), value) for key, value in sorted(self._values.items())]
+
+
+class Histogram:
+    """Istogramma cumulativo con etichette (bucket, somma e conteggio)."""
+
+    type = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(sorted(buckets)) + (float("inf"),)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        key = tuple(str(labels.get(name, "")) for name in self.labelnames)
+        with self._lock:
+            counts, total = self._values.get(key, ([0] * len(self.buckets), 0.0))
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[index] += 1
+                    break
+            self._values[key] = (counts, total + value)
+
+    def samples(self):
+        samples = []
+        with self._lock:
+            for key, (counts, total) in sorted(self._values.items()):
+                cumulative = 0
+                for bound, count in zip(self.buckets, counts):
+                    cumulative += count
+                    labels = _labels(self.labelnames, key, [("le", _number(bound))])
+                    samples.append((f"{self.name}_bucket", labels, cumulative))
+                samples.append((f"{self.name}_sum", _labels(self.labelnames, key), total))
+                samples.append((f"{self.name}_count", _labels(self.labelnames, key), cumulative))
+        return samples
+
+
+class Registry:
+    """Insieme delle metriche esposte su /metrics.
+
+    Oltre alle metriche registrate accetta dei collector: funzioni chiamate a
+    ogni lettura che restituiscono (nome, descrizione, tipo, [(etichette, valore)]),
+    utili per esporre contatori gia' mantenuti dai componenti (cache, backend).
+    """
+
+    def __init__(self):
+        self.metrics = []
+        self.collectors = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def render(self):
+        lines = []
+        for metric in self.metrics:
+            lines.append(f"# HELP {metric.name} {metric.documentation}")
+            lines.append(f"# TYPE {metric.name} {metric.type}")
+            lines.extend(f"{name}{labels} {_number(value)}" for name, labels, value in metric.samples())
+        for collector in self.collectors:
+            try:
+                families = collector()
+            except Exception as e:
+                logger.warning(f"Raccolta delle metriche non riuscita: {e}")
+                continue
+            for name, documentation, kind, values in families:
+                lines.append(f"# HELP {name} {documentation}")
+                lines.append(f"# TYPE {name} {kind}")
+                for labels, value in values:
+                    if value is not None:
+                        lines.append(f"{name}{_labels(list(labels), list(labels.values()))} {_number(value)}")
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+STAGE_SECONDS = REGISTRY.register(Histogram(
+    "t2db_stage_seconds", "Durata delle fasi di elaborazione di una domanda.", ["stage"]
+))
+REQUEST_SECONDS = REGISTRY.register(Histogram(
+    "t2db_request_seconds", "Durata delle richieste HTTP fino all'inizio della risposta.", ["method", "endpoint"]
+))
+REQUESTS_TOTAL = REGISTRY.register(Counter(
+    "t2db_requests_total", "Richieste HTTP per endpoint ed esito.", ["method", "endpoint", "status"]
+))
+LLM_TOKENS = REGISTRY.register(Counter(
+    "t2db_llm_tokens_total", "Token inviati (prompt) e ricevuti (completion) dai provider LLM.", ["provider", "kind"]
+))
+
+
+class RequestTimings:
+    """Tempi per fase di una singola richiesta (millisecondi, sommati se la fase si ripete)."""
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.stages = {}
+        self.tokens = {}
+        self._lock = threading.Lock()
+
+    def add(self, name, ms):
+        with self._lock:
+            self.stages[name] = self.stages.get(name, 0.0) + ms
+
+    def add_tokens(self, kind, count):
+        with self._lock:
+            self.tokens[kind] = self.tokens.get(kind, 0) + count
+
+    def elapsed_ms(self):
+        return (time.perf_counter() - self.started) * 1000
+
+    def server_timing(self):
+        """Valore dell'header Server-Timing (visibile anche negli strumenti del browser)."""
+        with self._lock:
+            parts = [f"{name};dur={ms:.1f}" for name, ms in self.stages.items()]
+            if self.tokens:
+                description = " ".join(f"{kind}={count}" for kind, count in sorted(self.tokens.items()))
+                parts.append(f'llm_tokens;desc="{description}"')
+        parts.append(f"total;dur={self.elapsed_ms():.1f}")
+        return ", ".join(parts)
+
+
+# Tempi della richiesta in corso; il contesto viene copiato nei task e nei
+# thread di anyio, quindi anche il lavoro fuori dall'event loop vi contribuisce
+current_timings = contextvars.ContextVar("t2db_current_timings", default=None)
+
+
+@contextmanager
+def stage(name):
+    """Misura una fase: istogramma globale e, se c'e' una richiesta in corso, il suo dettaglio."""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        seconds = time.perf_counter() - start
+        STAGE_SECONDS.observe(seconds, stage=name)
+        timings = current_timings.get()
+        if timings is not None:
+            timings.add(name, seconds * 1000)
+
+
+def record_llm_tokens(provider, prompt_tokens=None, completion_tokens=None):
+    for kind, count in (("prompt", prompt_tokens), ("completion", completion_tokens)):
+        if count:
+            LLM_TOKENS.inc(count, provider=provider, kind=kind)
+            timings = current_timings.get()
+            if timings is not None:
+                timings.add_tokens(kind, count)
+
+
+class MetricsMiddleware:
+    """Middleware ASGI: conta e cronometra le richieste e aggiunge l'header Server-Timing."""
+
+    def __init__(self, app, server_timing=True):
+        self.app = app
+        self.server_timing = server_timing
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        timings = RequestTimings()
+        token = current_timings.set(timings)
+        status = {"code": 500}
+
+        async def send_with_timings(message):
+            if message["type"] == "http.response.start":
+                status["code"] = message["status"]
+                route = scope.get("route")
+                endpoint = getattr(route, "path", None) or "unmatched"
+                REQUEST_SECONDS.observe(timings.elapsed_ms() / 1000, method=scope["method"], endpoint=endpoint)
+                if self.server_timing:
+                    headers = list(message.get("headers", []))
+                    headers.append((b"server-timing", timings.server_timing().encode("latin-1")))
+                    message = {**message, "headers": headers}
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_timings)
+        finally:
+            route = scope.get("route")
+            REQUESTS_TOTAL.inc(
+                method=scope["method"], endpoint=getattr(route, "path", None) or "unmatched", status=status["code"]
+            )
+            current_timings.reset(token)
@@ -0,0 +1,325 @@
+import base64
+import datetime
+import decimal
+import hashlib
+import hmac
+import json
+import logging
+import re
+import uuid
+
+from sqlalchemy import text
+
+from talk2db_metrics import stage
+
+logger = logging.getLogger(__name__)
+
+_ORDER_BY_RE = re.compile(r"\bORDER\s+BY\b", re.IGNORECASE)
+_LIMITING_CLAUSE_RE = re.compile(r"\b(TOP|OFFSET|FETCH|LIMIT|FOR|OPTION|INTO)\b", re.IGNORECASE)
+_STATEMENT_RE = re.compile(r"^\s*(SELECT|WITH)\b", re.IGNORECASE)
+_DIRECTION_RE = re.compile(r"\s+(ASC|DESC)\s*$", re.IGNORECASE)
+_IDENTIFIER_RE = re.compile(r"^\w+$")
+
+
+def mask_sql(sql):
+    """Copia della SQL della stessa lunghezza in cui stringhe, commenti,
+    identificatori tra parentesi quadre e tutto cio' che sta dentro parentesi
+    tonde e' sostituito da spazi: le ricerche sul risultato vedono solo le
+    parole chiave del livello principale dell'istruzione."""
+    masked = []
+    i = 0
+    depth = 0
+    length = len(sql)
+    while i < length:
+        c = sql[i]
+        if c == "'" or c == '"' or c == "[":
+            close = "]" if c == "[" else c
+            j = i + 1
+            while j < length:
+                if sql[j] == close:
+                    # Apice raddoppiato all'interno della stringa
+                    if j + 1 < length and sql[j + 1] == close and close != "]":
+                        j += 2
+                        continue
+                    break
+                j += 1
+            masked.append(" " * (min(j, length - 1) - i + 1))
+            i = j + 1
+            continue
+        if sql.startswith("--", i):
+            j = sql.find("\n", i)
+            j = length if j == -1 else j
+            masked.append(" " * (j - i))
+            i = j
+            continue
+        if sql.startswith("/*", i):
+            j = sql.find("*/", i + 2)
+            j = length if j == -1 else j + 2
+            masked.append(" " * (j - i))
+            i = j
+            continue
+        if c == "(":
+            depth += 1
+            masked.append(" ")
+        elif c == ")":
+            depth = max(depth - 1, 0)
+            masked.append(" ")
+        else:
+            masked.append(c if depth == 0 else " ")
+        i += 1
+    return "".join(masked)
+
+
+class PageRequest:
+    """Stato di una pagina: la SQL generata e come riprendere da dove si e' arrivati.
+
+    mode "offset" salta le prime offset righe; mode "keyset" riparte dal valore
+    della colonna di ordinamento dell'ultima riga letta (last, codificato da
+    encode_key), saltando le ties righe con lo stesso valore gia' restituite.
+    database e' il database (tenant) su cui eseguirla, None per quello di default.
+    """
+
+    def __init__(self, sql, page_size, mode="offset", offset=0, key=None, descending=False, last=None, ties=0,
+                 database=None):
+        self.sql = sql
+        self.page_size = page_size
+        self.mode = mode
+        self.offset = offset
+        self.key = key
+        self.descending = descending
+        self.last = last
+        self.ties = ties
+        self.database = database
+
+    def to_dict(self):
+        return {
+            "sql": self.sql, "page_size": self.page_size, "mode": self.mode, "offset": self.offset,
+            "key": self.key, "descending": self.descending, "last": self.last, "ties": self.ties,
+            "database": self.database,
+        }
+
+
+class SqlShape:
+    """Analisi minima della SQL generata per decidere come paginarla."""
+
+    def __init__(self, sql):
+        self.sql = sql.strip().rstrip(";").rstrip()
+        masked = mask_sql(self.sql)
+        self.pageable = bool(_STATEMENT_RE.match(masked)) and ";" not in masked
+        self.is_cte = masked.lstrip()[:4].upper() == "WITH"
+        self.order_by_start = None
+        self.order_keys = []
+
+        matches = list(_ORDER_BY_RE.finditer(masked))
+        if matches:
+            self.order_by_start = matches[-1].start()
+            clause_start = matches[-1].end()
+            # Suddivide le chiavi sulle virgole del livello principale
+            start = clause_start
+            for position in [m.start() for m in re.finditer(",", masked[clause_start:])] + [len(masked) - clause_start]:
+                self.order_keys.append(self.sql[start:clause_start + position].strip())
+                start = clause_start + position + 1
+
+        if self.pageable and _LIMITING_CLAUSE_RE.search(masked):
+            # TOP/OFFSET/LIMIT gia' presenti o SELECT INTO: si limita solo la lettura
+            self.pageable = False
+
+    @property
+    def body(self):
+        """La query senza la clausola ORDER BY finale."""
+        return self.sql[:self.order_by_start] if self.order_by_start is not None else self.sql
+
+    def keyset_column(self, columns):
+        """Colonna del risultato usabile per la paginazione keyset, con la direzione; None se non c'e'."""
+        if self.is_cte or len(self.order_keys) != 1:
+            return None
+        if len(set(columns)) != len(columns) or not all(columns):
+            # Una tabella derivata richiede nomi di colonna univoci e non vuoti
+            return None
+        key = self.order_keys[0]
+        direction = _DIRECTION_RE.search(key)
+        descending = bool(direction) and direction.group(1).upper() == "DESC"
+        key = _DIRECTION_RE.sub("", key).strip()
+        parts = [part.strip().strip("[]\"`") for part in key.split(".")]
+        name = parts[-1]
+        if not _IDENTIFIER_RE.match(name) or name not in columns:
+            return None
+        # Una chiave qualificata (c.Nome) deve comparire nella select senza alias
+        # o con alias uguale al nome della colonna (c.Nome AS Nome)
+        if len(parts) > 1:
+            selected = re.compile(
+                re.escape(key) + r"\s*(AS\s+[\[\"]?" + re.escape(name) + r"[\]\"]?\s*)?(,|\bFROM\b)", re.IGNORECASE
+            )
+            if not selected.search(self.body):
+                return None
+        return name, descending
+
+
+def build_page_query(page, dialect):
+    """SQL e parametri per leggere una pagina (page_size + 1 righe per sapere se ce n'e' un'altra).
+
+    Restituisce (None, None) se la SQL non si puo' paginare: in quel caso
+    si esegue cosi' com'e' limitando il numero di righe lette.
+    """
+    shape = SqlShape(page.sql)
+    if not shape.pageable:
+        return None, None
+
+    limit = page.page_size + 1
+    mssql = dialect.name == "mssql"
+
+    if page.mode == "keyset":
+        column = dialect.identifier_preparer.quote_identifier(page.key)
+        if page.descending:
+            condition = f"({column} <= :t2db_last OR {column} IS NULL)"
+        else:
+            condition = f"{column} >= :t2db_last"
+        order = f"{column} {'DESC' if page.descending else 'ASC'}"
+        limit += page.ties
+        query = f"SELECT * FROM (\n{shape.body}\n) AS t2db_page WHERE {condition} ORDER BY {order}"
+        if mssql:
+            return f"{query} OFFSET 0 ROWS FETCH NEXT {limit} ROWS ONLY", {"t2db_last": decode_key(page.last, dialect)}
+        return f"{query} LIMIT {limit}", {"t2db_last": decode_key(page.last, dialect)}
+
+    if mssql:
+        # OFFSET/FETCH richiede un ORDER BY; senza, si ordina per la prima colonna
+        order = "" if shape.order_by_start is not None else "\nORDER BY 1"
+        return f"{shape.sql}{order}\nOFFSET {page.offset} ROWS FETCH NEXT {limit} ROWS ONLY", {}
+    return f"{shape.sql}\nLIMIT {limit} OFFSET {page.offset}", {}
+
+
+# Tipi delle chiavi di ordinamento che non hanno un equivalente JSON, con la
+# funzione che li ricostruisce dal testo salvato nel token
+_KEY_TYPES = {
+    "datetime": datetime.datetime.fromisoformat,
+    "date": datetime.date.fromisoformat,
+    "time": datetime.time.fromisoformat,
+    "decimal": decimal.Decimal,
+    "uuid": uuid.UUID,
+}
+
+
+def encode_key(value, column_description=None):
+    """Valore della chiave di ordinamento in forma JSON, con il tipo per quelli non nativi.
+
+    Stringhe, numeri e booleani restano come sono; date, orari, decimali e uuid
+    diventano {"type": ..., "value": testo}. Un datetime di una colonna
+    SQL Server datetime (scala 3) e' salvato ai millisecondi con "ms": True.
+    Restituisce None se il valore non si puo' usare come chiave (es. bytes).
+    """
+    if isinstance(value, bool) or isinstance(value, (int, float, str)):
+        return value
+    if isinstance(value, datetime.datetime):
+        scale = column_description[5] if column_description is not None and len(column_description) > 5 else None
+        if scale == 3:
+            return {"type": "datetime", "value": value.isoformat(timespec="milliseconds"), "ms": True}
+        return {"type": "datetime", "value": value.isoformat()}
+    for name, kind in (("date", datetime.date), ("time", datetime.time), ("decimal", decimal.Decimal),
+                       ("uuid", uuid.UUID)):
+        if isinstance(value, kind):
+            return {"type": name, "value": value.isoformat() if hasattr(value, "isoformat") else str(value)}
+    return None
+
+
+def decode_key(encoded, dialect):
+    """Valore da passare come parametro per la chiave codificata da encode_key.
+
+    Su SQL Server un datetime ai millisecondi resta testo ISO 8601
+    ("2024-01-01T10:00:00.123"): lo converte il server nel tipo datetime della
+    colonna, mentre un parametro con i microsecondi non corrisponderebbe.
+    I token senza tipo (valori nativi JSON) restano come sono.
+    """
+    if not isinstance(encoded, dict):
+        return encoded
+    if encoded.get("ms") and dialect.name == "mssql":
+        return encoded["value"]
+    return _KEY_TYPES[encoded["type"]](encoded["value"])
+
+
+def next_page(page, columns, rows, description=None):
+    """Richiesta della pagina successiva, oppure None se le righe sono finite.
+
+    description (del cursore) indica la scala delle colonne datetime.
+    """
+    if len(rows) <= page.page_size:
+        return None
+
+    shape = SqlShape(page.sql)
+    keyset = shape.keyset_column(columns)
+    page_rows = rows[:page.page_size]
+    if keyset is not None:
+        key, descending = keyset
+        index = columns.index(key)
+        last = page_rows[-1][index]
+        encoded = encode_key(last, description[index] if description else None) if last is not None else None
+        if encoded is not None:
+            ties = 0
+            for row in reversed(page_rows):
+                if row[index] != last:
+                    break
+                ties += 1
+            # Confronto tra forme codificate: page.last arriva dal token
+            if ties == len(page_rows) and page.mode == "keyset" and page.last == encoded:
+                ties += page.ties
+            return PageRequest(page.sql, page.page_size, "keyset", page.offset + page.page_size, key, descending,
+                               encoded, ties, page.database)
+    return PageRequest(page.sql, page.page_size, "offset", page.offset + page.page_size, database=page.database)
+
+
+class PageResult:
+    """Righe di una pagina con la descrizione del cursore e la richiesta della pagina successiva."""
+
+    def __init__(self, columns, rows, description=None, next_page=None, truncated=False):
+        self.columns = columns
+        self.rows = rows
+        self.description = description
+        self.next_page = next_page
+        self.truncated = truncated
+
+
+def fetch_page(engine, page):
+    """Legge una pagina della query (al massimo page.page_size righe)."""
+    query, params = build_page_query(page, engine.dialect)
+    with engine.connect() as connection:
+        with stage("db_execute"):
+            if query is None:
+                logger.info(f"Query non paginabile, lettura limitata a {page.page_size} righe: {page.sql}")
+                result = connection.execute(text(page.sql))
+            else:
+                logger.info(f"Esecuzione della pagina ({page.mode}, offset {page.offset}): {query}")
+                result = connection.execute(text(query), params)
+        if not result.returns_rows:
+            return PageResult([], [])
+        columns = list(result.keys())
+        description = result.cursor.description
+        with stage("db_fetch"):
+            rows = result.fetchmany(page.page_size + 1 + (page.ties if page.mode == "keyset" else 0))
+
+    if page.mode == "keyset":
+        # Le prime ties righe sono uguali all'ultima gia' restituita
+        rows = rows[page.ties:]
+    truncated = len(rows) > page.page_size
+    following = next_page(page, columns, rows, description) if query is not None else None
+    return PageResult(columns, [tuple(row) for row in rows[:page.page_size]], description, following, truncated)
+
+
+def encode_page_token(page, secret):
+    """Token opaco e firmato (HMAC) della pagina successiva: il client non puo' alterare la SQL."""
+    payload = base64.urlsafe_b64encode(json.dumps(page.to_dict(), separators=(",", ":")).encode("utf-8"))
+    signature = hmac.new(secret, payload, hashlib.sha256).hexdigest()
+    return f"{payload.decode('ascii')}.{signature}"
+
+
+def decode_page_token(token, secret):
+    """Verifica la firma e ricostruisce la richiesta; ValueError se il token non e' valido."""
+    try:
+        payload, signature = token.rsplit(".", 1)
+        expected = hmac.new(secret, payload.encode("ascii"), hashlib.sha256).hexdigest()
+        if not hmac.compare_digest(signature, expected):
+            raise ValueError("firma non valida")
+        data = json.loads(base64.urlsafe_b64decode(payload.encode("ascii")))
+        return PageRequest(**data)
+    except ValueError:
+        raise
+    except Exception as e:
+        raise ValueError(f"token malformato: {e}")
@@ -0,0 +1,161 @@
+import logging
+import threading
+import time
+
+from sqlalchemy import create_engine, event, exc, make_url
+from sqlalchemy.pool import QueuePool
+
+from talk2db_metrics import stage
+from talk2db_result_cache import is_read_only
+
+logger = logging.getLogger(__name__)
+
+
+class PoolMonitor:
+    """Attese, timeout e connessioni invalidate di un pool, per /metrics e /admin/db-pool/stats."""
+
+    def __init__(self, name, max_overflow=0):
+        self.name = name
+        # Overflow configurato in build_engine (0 per i pool che non sono a coda)
+        self.max_overflow = max_overflow
+        self.checkouts = 0
+        self.wait_seconds = 0.0
+        self.max_wait_seconds = 0.0
+        self.timeouts = 0
+        self.invalidated = 0
+        self._lock = threading.Lock()
+
+    def record_wait(self, seconds):
+        with self._lock:
+            self.checkouts += 1
+            self.wait_seconds += seconds
+            self.max_wait_seconds = max(self.max_wait_seconds, seconds)
+
+
+def _timed_pool_class(monitor):
+    """QueuePool che misura l'attesa di una connessione libera (fase db_pool_wait).
+
+    Avvolge connect(), il metodo pubblico con cui il motore prende una
+    connessione: il tempo comprende l'attesa in coda e il pre-ping.
+    """
+
+    class TimedQueuePool(QueuePool):
+        def connect(self):
+            start = time.perf_counter()
+            try:
+                with stage("db_pool_wait"):
+                    return super().connect()
+            except exc.TimeoutError:
+                monitor.timeouts += 1
+                raise
+            finally:
+                monitor.record_wait(time.perf_counter() - start)
+
+    return TimedQueuePool
+
+
+def build_engine(url, name="primary", pool_size=5, max_overflow=10, pool_timeout=30, pool_recycle=1800, pre_ping=True):
+    """Crea il motore con le impostazioni del pool; restituisce (engine, PoolMonitor).
+
+    Dimensione, overflow e timeout valgono solo per i pool a coda (SQL Server,
+    SQLite su file); pre_ping verifica la connessione prima di consegnarla,
+    cosi' dopo un failover le connessioni morte vengono sostituite invece di
+    far fallire le prime richieste. pool_recycle <= 0 non ricicla le connessioni.
+    """
+    options = {"pool_pre_ping": pre_ping, "pool_recycle": pool_recycle if pool_recycle > 0 else -1}
+    parsed = make_url(url)
+    queued = issubclass(parsed.get_dialect().get_pool_class(parsed), QueuePool)
+    monitor = PoolMonitor(name, max_overflow if queued else 0)
+    if queued:
+        options.update(
+            poolclass=_timed_pool_class(monitor),
+            pool_size=pool_size,
+            max_overflow=max_overflow,
+            pool_timeout=pool_timeout,
+        )
+    engine = create_engine(url, **options)
+
+    @event.listens_for(engine, "invalidate")
+    def count_invalidated(dbapi_connection, connection_record, exception):
+        # Connessioni scartate: ping fallito, errore di disconnessione o riciclo forzato
+        monitor.invalidated += 1
+        logger.warning(f"Connessione del pool {name} invalidata: {exception}")
+
+    return engine, monitor
+
+
+def open_connections(engine, count):
+    """Apre count connessioni e le restituisce al pool, pronte per le prime richieste."""
+    connections = []
+    try:
+        for _ in range(count):
+            connections.append(engine.connect())
+    finally:
+        for connection in connections:
+            connection.close()
+    return len(connections)
+
+
+def pool_stats(engine, monitor):
+    pool = engine.pool
+    stats = {"pool": monitor.name, "class": type(pool).__name__}
+    if isinstance(pool, QueuePool):
+        stats.update(
+            size=pool.size(),
+            checked_out=pool.checkedout(),
+            idle=pool.checkedin(),
+            # Negativo finche' il pool non ha aperto tutte le connessioni di base
+            overflow=pool.overflow(),
+            max_overflow=monitor.max_overflow,
+        )
+    stats.update(
+        checkouts=monitor.checkouts,
+        avg_wait_ms=round(monitor.wait_seconds / monitor.checkouts * 1000, 3) if monitor.checkouts else None,
+        max_wait_ms=round(monitor.max_wait_seconds * 1000, 3),
+        timeouts=monitor.timeouts,
+        invalidated=monitor.invalidated,
+    )
+    return stats
+
+
+class DatabaseEngines:
+    """Motore principale e, facoltativo, una replica in sola lettura.
+
+    Le SELECT generate vanno sulla replica (se configurata), tutto il resto
+    (query di catalogo, sonde di versione, piani stimati, procedure e scritture)
+    sul principale. La replica puo' essere in ritardo rispetto al principale.
+    """
+
+    def __init__(self, url, replica_url=None, **pool_options):
+        self.primary, self.primary_monitor = build_engine(url, "primary", **pool_options)
+        self.replica = self.replica_monitor = None
+        if replica_url:
+            self.replica, self.replica_monitor = build_engine(replica_url, "replica", **pool_options)
+        self.routed = {"primary": 0, "replica": 0}
+
+    def all(self):
+        """Coppie (motore, monitor) configurate."""
+        pairs = [(self.primary, self.primary_monitor)]
+        if self.replica is not None:
+            pairs.append((self.replica, self.replica_monitor))
+        return pairs
+
+    def max_connections(self):
+        """Connessioni che i pool possono aprire al massimo (base piu' overflow)."""
+        total = 0
+        for engine, monitor in self.all():
+            pool = engine.pool
+            total += (pool.size() if isinstance(pool, QueuePool) else 1) + max(0, monitor.max_overflow)
+        return total
+
+    def for_sql(self, sql):
+        """Motore su cui eseguire una SQL generata."""
+        target = "replica" if self.replica is not None and is_read_only(sql) else "primary"
+        self.routed[target] += 1
+        return self.replica if target == "replica" else self.primary
+
+    def stats(self):
+        return {
+            "pools": [pool_stats(engine, monitor) for engine, monitor in self.all()],
+            "routed": dict(self.routed),
+        }
@@ -0,0 +1,224 @@
+import hashlib
+import logging
+import re
+import threading
+import unicodedata
+
+from talk2db_cache_backends import MemoryCacheBackend, SqliteCacheBackend
+
+logger = logging.getLogger(__name__)
+
+# Valori letterali estraibili dalla domanda: stringhe tra apici/virgolette,
+# date e numeri. Con l'estrazione attiva "clienti di Milano" e "clienti di
+# Roma" condividono la stessa voce in cache.
+LITERAL_RE = re.compile(
+    r"'([^']*)'|\"([^\"]*)\"|\b(\d{1,4}[/-]\d{1,2}[/-]\d{1,4})\b|\b(\d+(?:[.,]\d+)?)\b"
+)
+# Tipo del letterale per gruppo di LITERAL_RE: stringa, stringa, data, numero
+LITERAL_KINDS = ("s", "s", "d", "n")
+# Valori accettati per tipo quando riempiono un modello: un numero entra nella
+# SQL senza apici, quindi deve essere davvero un numero
+LITERAL_CHECKS = {
+    "s": re.compile(r".*", re.DOTALL),
+    "d": re.compile(r"^\d{1,4}[/-]\d{1,2}[/-]\d{1,4}$"),
+    "n": re.compile(r"^\d+(\.\d+)?$"),
+}
+_PLACEHOLDER_RE = re.compile(r"<([sdn])(\d+)>")
+# Stringhe della SQL generata, con gli apici raddoppiati al loro interno
+_SQL_STRING_RE = re.compile(r"'(?:[^']|'')*'")
+
+
+def _placeholder(index, kind):
+    return f"<{kind}{index}>"
+
+
+def normalize_question(question, extract_literals=False):
+    """Normalizza la domanda (maiuscole, spazi, punteggiatura, accenti).
+
+    Con extract_literals=True i valori letterali vengono sostituiti da
+    segnaposto che ne indicano il tipo e restituiti a parte:
+    (testo normalizzato, lista di coppie (tipo, valore)). Il tipo fa parte del
+    testo normalizzato, quindi "cliente 42" e "cliente '42'" restano domande diverse.
+    """
+    literals = []
+    if extract_literals:
+        def replace(match):
+            group = next(index for index, value in enumerate(match.groups()) if value is not None)
+            literals.append((LITERAL_KINDS[group], match.group(group + 1)))
+            return f" lit{len(literals) - 1}{LITERAL_KINDS[group]} "
+        question = LITERAL_RE.sub(replace, question)
+
+    value = unicodedata.normalize("NFKD", question)
+    value = "".join(c for c in value if not unicodedata.combining(c)).lower()
+    value = re.sub(r"[^\w\s]", " ", value)
+    value = " ".join(value.split())
+    for index in reversed(range(len(literals))):
+        kind = literals[index][0]
+        value = value.replace(f"lit{index}{kind}", _placeholder(index, kind))
+    return value, literals
+
+
+def _literal_pattern(literal):
+    return re.compile(r"(?<![\w.])" + re.escape(literal) + r"(?![\w.])")
+
+
+def make_sql_template(sql, literals):
+    """Sostituisce nella SQL i letterali (tipo, valore) della domanda con segnaposto tipizzati.
+
+    Un numero puo' stare ovunque nella SQL; stringhe e date solo dentro una
+    stringa '...' della SQL, cosi' il valore che riempira' il modello resta tra
+    apici. Restituisce None se un letterale non compare esattamente una volta
+    nella posizione ammessa o se i letterali si sovrappongono: in quel caso la
+    sostituzione non sarebbe sicura.
+    """
+    values = [value for _, value in literals]
+    if not all(values) or len(set(values)) != len(values) or _PLACEHOLDER_RE.search(sql):
+        return None
+    for value in values:
+        if any(value != other and value in other for other in values):
+            return None
+    strings = [match.span() for match in _SQL_STRING_RE.finditer(sql)]
+    replacements = []
+    for index, (kind, value) in enumerate(literals):
+        if kind == "n":
+            matches = list(_literal_pattern(value).finditer(sql))
+        else:
+            pattern = _literal_pattern(value.replace("'", "''"))
+            matches = [match for start, end in strings for match in pattern.finditer(sql, start + 1, end - 1)]
+            # Anche fuori dalle stringhe: il valore sarebbe parte della SQL, non un dato
+            if len(pattern.findall(sql)) != len(matches):
+                return None
+        if len(matches) != 1:
+            return None
+        replacements.append((*matches[0].span(), _placeholder(index, kind)))
+    template = sql
+    for start, end, placeholder in sorted(replacements, reverse=True):
+        template = template[:start] + placeholder + template[end:]
+    return template
+
+
+def fill_sql_template(template, literals):
+    """SQL del modello con i letterali (tipo, valore) della domanda, oppure None.
+
+    Ogni segnaposto deve comparire una volta e con lo stesso tipo del
+    letterale, e il valore deve essere valido per quel tipo: un numero entra
+    senza apici, stringhe e date (gia' tra apici nel modello) con gli apici
+    raddoppiati. I segnaposto sono sostituiti in un solo passaggio, quindi un
+    valore che contiene "<n1>" non viene rielaborato.
+    """
+    expected = sorted(_placeholder(index, kind) for index, (kind, _) in enumerate(literals))
+    if sorted(match.group(0) for match in _PLACEHOLDER_RE.finditer(template)) != expected:
+        return None
+    if not all(LITERAL_CHECKS[kind].match(value) for kind, value in literals):
+        return None
+
+    def render(match):
+        kind, value = literals[int(match.group(2))]
+        # Il valore arriva dall'utente, non dal modello
+        return value if kind == "n" else value.replace("'", "''")
+
+    return _PLACEHOLDER_RE.sub(render, template)
+
+
+class QuestionCache:
+    """Cache LRU domanda -> SQL generata, con persistenza opzionale su SQLite.
+
+    La chiave comprende la domanda normalizzata, la versione dello schema e
+    il provider/modello LLM, quindi un cambio di schema o di modello non
+    restituisce mai SQL generata in un contesto diverso. Le voci stanno in
+    memoria, nel file db_path (persistente tra i riavvii) oppure nel backend
+    indicato, ad esempio condiviso tra i worker.
+    """
+
+    def __init__(self, max_entries=1000, db_path=None, extract_literals=False, backend=None):
+        self.max_entries = max_entries
+        self.db_path = db_path
+        self.extract_literals = extract_literals
+        if backend is None:
+            backend = (SqliteCacheBackend(db_path, "question", max_entries=max_entries) if db_path
+                       else MemoryCacheBackend(max_entries=max_entries))
+        # Voci (versione dello schema, SQL) con la versione come etichetta
+        self.backend = backend
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.discarded = 0
+
+    @staticmethod
+    def _key(normalized, schema_version, provider):
+        return hashlib.sha256(f"{provider}\x00{schema_version}\x00{normalized}".encode("utf-8")).hexdigest()
+
+    def _keys(self, question, schema_version, provider):
+        """Chiavi da provare, dalla piu' generale (con segnaposto) alla domanda esatta."""
+        keys = []
+        if self.extract_literals:
+            normalized, literals = normalize_question(question, extract_literals=True)
+            if literals:
+                keys.append((self._key(normalized, schema_version, provider), literals))
+        normalized, _ = normalize_question(question)
+        keys.append((self._key(normalized, schema_version, provider), []))
+        return keys
+
+    def get(self, question, schema_version, provider):
+        """SQL in cache per la domanda, oppure None."""
+        for key, literals in self._keys(question, schema_version, provider):
+            entry = self.backend.get(key)
+            if entry is None:
+                continue
+            sql = fill_sql_template(entry[1], literals) if literals else entry[1]
+            if sql is not None:
+                with self._lock:
+                    self.hits += 1
+                return sql
+        with self._lock:
+            self.misses += 1
+        return None
+
+    def put(self, question, schema_version, provider, sql):
+        keys = self._keys(question, schema_version, provider)
+        key, literals = keys[0]
+        value = sql
+        if literals:
+            value = make_sql_template(sql, literals)
+            if value is None:
+                # SQL non parametrizzabile: si memorizza per la domanda esatta
+                key, value = keys[-1][0], sql
+        self.backend.put(key, (schema_version, value), len(value), tags=[schema_version])
+
+    def discard(self, question, schema_version, provider):
+        """Elimina le voci (modello ed esatta) della domanda, ad esempio se la SQL non supera piu' la validazione."""
+        for key, _ in self._keys(question, schema_version, provider):
+            self.backend.delete(key)
+        with self._lock:
+            self.discarded += 1
+
+    def purge(self, keep_schema_version=None):
+        """Elimina le voci di versioni dello schema diverse da quella indicata (tutte se None)."""
+        stale = None if keep_schema_version is None else self.backend.tags() - {keep_schema_version}
+        removed = self.backend.invalidate(stale)
+        if removed:
+            logger.info(f"Cache delle domande: eliminate {removed} voci di versioni dello schema precedenti.")
+        return removed
+
+    def discard_schema_version(self, schema_version):
+        """Elimina le voci generate con la versione dello schema indicata."""
+        removed = self.backend.invalidate([schema_version])
+        if removed:
+            logger.info(f"Cache delle domande: eliminate {removed} voci della versione {schema_version}.")
+        return removed
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        backend = self.backend.stats()
+        return {
+            "entries": backend["entries"],
+            "max_entries": self.max_entries,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / lookups, 3) if lookups else None,
+            "evictions": backend["evictions"],
+            "discarded": self.discarded,
+            "persistent": self.backend.shared,
+            "backend": backend["backend"],
+            "extract_literals": self.extract_literals,
+        }
@@ -0,0 +1,237 @@
+import hashlib
+import logging
+import re
+import sys
+import threading
+
+from talk2db_cache_backends import MemoryCacheBackend
+
+logger = logging.getLogger(__name__)
+
+# Token SQL: stringhe, identificatori delimitati, commenti, parole e simboli
+_TOKEN_RE = re.compile(
+    r"(?P<string>N?'(?:[^']|'')*')"
+    r"|(?P<quoted>\[[^\]]*\]|\"[^\"]*\"|`[^`]*`)"
+    r"|(?P<comment>--[^\n]*|/\*.*?\*/)"
+    r"|(?P<word>[^\W\d]\w*|[@#]+\w+)"
+    r"|(?P<number>\d+(?:\.\d+)?)"
+    r"|(?P<space>\s+)"
+    r"|(?P<symbol>.)",
+    re.DOTALL,
+)
+
+# Parole chiave che rendono un'istruzione non in sola lettura
+WRITE_KEYWORDS = {
+    "INSERT", "UPDATE", "DELETE", "MERGE", "INTO", "EXEC", "EXECUTE", "CREATE", "ALTER", "DROP",
+    "TRUNCATE", "GRANT", "REVOKE", "DENY", "DECLARE", "SET", "BACKUP", "RESTORE", "DBCC", "USE",
+}
+# Funzioni non deterministiche: il risultato cambia a ogni esecuzione
+VOLATILE_KEYWORDS = {
+    "GETDATE", "GETUTCDATE", "SYSDATETIME", "SYSUTCDATETIME", "SYSDATETIMEOFFSET", "CURRENT_TIMESTAMP",
+    "NEWID", "NEWSEQUENTIALID", "RAND", "CRYPT_GEN_RANDOM", "RANDOM", "NOW",
+}
+# Dopo queste parole chiave compare un riferimento a tabella
+_TABLE_KEYWORDS = {"FROM", "JOIN", "APPLY"}
+# Parole che chiudono l'elenco delle tabelle di una FROM
+_CLAUSE_KEYWORDS = {
+    "WHERE", "GROUP", "ORDER", "HAVING", "UNION", "EXCEPT", "INTERSECT", "ON", "JOIN", "INNER", "LEFT",
+    "RIGHT", "FULL", "CROSS", "OUTER", "OFFSET", "FETCH", "LIMIT", "OPTION", "FOR", "WINDOW",
+}
+
+
+def _tokens(sql):
+    """Token significativi (senza spazi e commenti) come coppie (tipo, testo)."""
+    for match in _TOKEN_RE.finditer(sql):
+        kind = match.lastgroup
+        if kind not in ("space", "comment"):
+            yield kind, match.group()
+
+
+def normalize_sql(sql):
+    """Testo canonico della SQL: commenti rimossi, spazi compattati e parole
+    chiave/identificatori in maiuscolo; stringhe e numeri restano invariati."""
+    parts = []
+    for kind, value in _tokens(sql.strip().rstrip(";")):
+        parts.append(value.upper() if kind in ("word", "quoted") else value)
+    return " ".join(parts)
+
+
+def _unquote(name):
+    return name[1:-1] if name[:1] in ("[", '"', "`") else name
+
+
+def table_references(sql):
+    """Coppie (tabella, alias) citate dopo FROM, JOIN e APPLY, escluse le CTE; nomi minuscoli, senza schema."""
+    tokens = list(_tokens(sql))
+    ctes = set()
+    references = []
+    for index, (kind, value) in enumerate(tokens):
+        upper = value.upper()
+        # WITH nome AS ( ... ), nome AS ( ... )
+        if kind == "word" and upper == "AS" and index + 1 < len(tokens) and tokens[index + 1][1] == "(" and index > 0:
+            previous_kind, previous = tokens[index - 1]
+            if previous_kind in ("word", "quoted"):
+                ctes.add(_unquote(previous).lower())
+        if kind != "word" or upper not in _TABLE_KEYWORDS:
+            continue
+        position = index + 1
+        while position < len(tokens):
+            # Nome eventualmente qualificato: db.schema.tabella
+            name = None
+            while position < len(tokens) and tokens[position][0] in ("word", "quoted"):
+                name = _unquote(tokens[position][1])
+                if position + 1 < len(tokens) and tokens[position + 1][1] == ".":
+                    position += 2
+                    continue
+                position += 1
+                break
+            if name is None or name.upper() in _CLAUSE_KEYWORDS:
+                break
+            # Escluse le funzioni tabellari (nome seguito da parentesi)
+            function = position < len(tokens) and tokens[position][1] == "("
+            # Alias opzionale, poi eventuale altra tabella dopo la virgola (FROM a, b)
+            alias = None
+            while position < len(tokens) and tokens[position][1] not in (",", "(", ")") and \
+                    tokens[position][1].upper() not in _CLAUSE_KEYWORDS:
+                if alias is None and tokens[position][0] in ("word", "quoted") and tokens[position][1].upper() != "AS":
+                    alias = _unquote(tokens[position][1]).lower()
+                position += 1
+            if not function:
+                references.append((name.lower(), alias))
+            if position < len(tokens) and tokens[position][1] == "," and upper == "FROM":
+                position += 1
+                continue
+            break
+    return [(table, alias) for table, alias in references if table not in ctes]
+
+
+def referenced_tables(sql):
+    """Nomi (minuscoli, senza schema) delle tabelle citate dopo FROM, JOIN e APPLY, escluse le CTE."""
+    return {table for table, _ in table_references(sql)}
+
+
+def is_read_only(sql):
+    """True per una singola SELECT (o WITH ... SELECT) senza scritture ne' tabelle temporanee."""
+    tokens = list(_tokens(sql.strip().rstrip(";")))
+    if not tokens or tokens[0][1].upper() not in ("SELECT", "WITH"):
+        return False
+    for kind, value in tokens:
+        if value == ";":
+            return False
+        if kind == "word" and value.upper() in WRITE_KEYWORDS:
+            return False
+        if kind == "word" and value.startswith("#"):
+            # Tabelle temporanee: visibili solo alla sessione che le ha create
+            return False
+    return True
+
+
+def is_cacheable(sql):
+    """True per una SELECT in sola lettura senza funzioni non deterministiche."""
+    if not is_read_only(sql):
+        return False
+    return not any(kind == "word" and value.upper() in VOLATILE_KEYWORDS for kind, value in _tokens(sql))
+
+
+def parse_table_ttls(value):
+    """"CLIENTI=60,ORDINI=5" -> {"clienti": 60.0, "ordini": 5.0}."""
+    ttls = {}
+    for item in (value or "").split(","):
+        if "=" in item:
+            name, seconds = item.split("=", 1)
+            ttls[name.strip().lower()] = float(seconds)
+    return ttls
+
+
+def _size_of(value):
+    """Stima (per difetto) della memoria occupata dalle righe di un risultato."""
+    rows = getattr(value, "rows", value)
+    size = sys.getsizeof(rows)
+    for row in rows:
+        size += sys.getsizeof(row) + sum(sys.getsizeof(cell) for cell in row)
+    return size
+
+
+class ResultCache:
+    """Cache LRU dei risultati delle query in sola lettura, limitata in byte.
+
+    La chiave e' la SQL normalizzata (piu' un eventuale discriminante, es. la
+    pagina richiesta). Ogni voce ricorda le tabelle citate: scade dopo il TTL
+    piu' breve tra quelli delle sue tabelle e si puo' invalidare per tabella.
+    Le voci stanno nel backend: in memoria del processo (default) oppure
+    condiviso tra i worker (SqliteCacheBackend).
+    """
+
+    def __init__(self, max_bytes=64 * 1024 * 1024, default_ttl=30.0, table_ttls=None, backend=None):
+        self.max_bytes = max_bytes
+        self.default_ttl = default_ttl
+        self.table_ttls = {name.lower(): ttl for name, ttl in (table_ttls or {}).items()}
+        self.backend = backend or MemoryCacheBackend(max_bytes=max_bytes)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+        self.uncacheable = 0
+
+    @staticmethod
+    def _key(sql, variant):
+        return hashlib.sha256(f"{normalize_sql(sql)}\x00{variant}".encode("utf-8")).hexdigest()
+
+    @property
+    def bytes(self):
+        return self.backend.usage()[1]
+
+    def ttl_for(self, tables):
+        """TTL della voce: il minimo tra quelli delle tabelle citate (0 = non memorizzare)."""
+        return min((self.table_ttls.get(table, self.default_ttl) for table in tables), default=self.default_ttl)
+
+    def get(self, sql, variant=""):
+        """Risultato in cache per la SQL, oppure None."""
+        value = self.backend.get(self._key(sql, variant))
+        with self._lock:
+            if value is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return value
+
+    def put(self, sql, value, variant=""):
+        """Memorizza il risultato se l'istruzione e' in sola lettura; restituisce True se memorizzato."""
+        if not is_cacheable(sql):
+            with self._lock:
+                self.uncacheable += 1
+            return False
+        tables = referenced_tables(sql)
+        ttl = self.ttl_for(tables)
+        if ttl <= 0:
+            return False
+        return self.backend.put(self._key(sql, variant), value, _size_of(value), ttl, tables)
+
+    def invalidate(self, tables=None):
+        """Elimina le voci che citano le tabelle indicate (tutte se None); restituisce il numero di voci."""
+        if tables is not None:
+            tables = {_unquote(table.split(".")[-1]).lower() for table in tables}
+        removed = self.backend.invalidate(tables)
+        with self._lock:
+            self.invalidations += removed
+        if removed:
+            logger.info(f"Cache dei risultati: invalidate {removed} voci.")
+        return removed
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        backend = self.backend.stats()
+        return {
+            "entries": backend["entries"],
+            "bytes": backend["bytes"],
+            "max_bytes": self.max_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / lookups, 3) if lookups else None,
+            "evictions": backend["evictions"],
+            "expirations": backend["expirations"],
+            "invalidations": self.invalidations,
+            "uncacheable": self.uncacheable,
+            "tables": len(self.backend.tags()),
+            "backend": backend["backend"],
+        }
@@ -0,0 +1,141 @@
+import logging
+import math
+import re
+import unicodedata
+from collections import Counter
+
+from talk2db_introspection import SchemaModel
+
+logger = logging.getLogger(__name__)
+
+# Parametri standard di BM25
+BM25_K1 = 1.2
+BM25_B = 0.75
+
+# Lunghezza del prefisso usato come "radice" grezza: fa combaciare
+# singolari/plurali e abbreviazioni (movimenti / MOVIMBARC, clienti / CLIENTI_LOG)
+STEM_LENGTH = 5
+
+# Il nome dell'oggetto pesa piu' dei nomi delle colonne o dei parametri
+NAME_WEIGHT = 3
+
+STOPWORDS = {
+    "il", "lo", "la", "i", "gli", "le", "un", "uno", "una", "di", "del", "dello", "della", "dei",
+    "degli", "delle", "da", "dal", "dalla", "dai", "in", "nel", "nella", "nei", "con", "su", "per",
+    "tra", "fra", "e", "o", "che", "chi", "cui", "non", "mi", "ci", "si", "tutti", "tutte", "quali",
+    "quale", "quanti", "quante", "come", "dove", "quando", "sono", "ha", "hanno", "mostra", "mostrami",
+    "dammi", "elenca", "the", "a", "an", "of", "to", "for", "and", "or", "in", "on", "with", "by",
+    "all", "show", "me", "list", "give", "what", "which", "how", "many", "is", "are",
+}
+
+_CAMEL_RE = re.compile(r"[A-Z]+(?=[A-Z][a-z])|[A-Z]?[a-z]+|[A-Z]+|\d+")
+
+
+def _strip_accents(value):
+    return "".join(c for c in unicodedata.normalize("NFKD", value) if not unicodedata.combining(c))
+
+
+def tokenize(value):
+    """Divide identificatori e testo libero in termini: CamelCase, underscore, cifre."""
+    terms = []
+    for word in re.split(r"[^0-9A-Za-z]+", _strip_accents(value)):
+        for part in _CAMEL_RE.findall(word):
+            part = part.lower()
+            if len(part) < 2 or part in STOPWORDS:
+                continue
+            terms.append(part)
+            if len(part) > STEM_LENGTH:
+                terms.append(part[:STEM_LENGTH] + "*")
+    return terms
+
+
+class SchemaIndex:
+    """Indice invertito BM25 su tabelle e procedure di uno SchemaModel.
+
+    Va costruito una volta per versione dello schema; le interrogazioni
+    toccano solo le liste dei termini presenti nella domanda.
+    """
+
+    def __init__(self, model):
+        self.model = model
+        self._documents = []
+        self._postings = {}
+        self._lengths = []
+        self._neighbours = {}
+        self._procedures = {procedure.name: procedure for procedure in model.procedures}
+
+        for table in model.tables.values():
+            terms = tokenize(table.name) * NAME_WEIGHT
+            for column in table.columns:
+                terms += tokenize(column.name)
+            self._add_document(("table", table.name), terms)
+
+        for procedure in model.procedures:
+            terms = tokenize(procedure.name) * NAME_WEIGHT
+            for name, _ in procedure.parameters:
+                terms += tokenize(name)
+            self._add_document(("procedure", procedure.name), terms)
+
+        # Vicini lungo le chiavi esterne, in entrambe le direzioni
+        for table in model.tables.values():
+            for fk in table.foreign_keys:
+                if fk.referred_table in model.tables and fk.referred_table != table.name:
+                    self._neighbours.setdefault(table.name, set()).add(fk.referred_table)
+                    self._neighbours.setdefault(fk.referred_table, set()).add(table.name)
+
+        self._avg_length = sum(self._lengths) / len(self._lengths) if self._lengths else 0.0
+        self._idf = {
+            term: math.log(1 + (len(self._documents) - len(postings) + 0.5) / (len(postings) + 0.5))
+            for term, postings in self._postings.items()
+        }
+
+    def _add_document(self, key, terms):
+        doc_id = len(self._documents)
+        self._documents.append(key)
+        self._lengths.append(len(terms))
+        for term, frequency in Counter(terms).items():
+            self._postings.setdefault(term, []).append((doc_id, frequency))
+
+    def score(self, question):
+        """Punteggio BM25 di ogni documento che condivide almeno un termine con la domanda."""
+        scores = {}
+        for term in set(tokenize(question)):
+            postings = self._postings.get(term)
+            if not postings:
+                continue
+            idf = self._idf[term]
+            for doc_id, frequency in postings:
+                norm = BM25_K1 * (1 - BM25_B + BM25_B * self._lengths[doc_id] / self._avg_length)
+                scores[doc_id] = scores.get(doc_id, 0.0) + idf * frequency * (BM25_K1 + 1) / (frequency + norm)
+        return scores
+
+    def search(self, question, table_k=15, procedure_k=5, expand_foreign_keys=True):
+        """Restituisce uno SchemaModel ridotto agli oggetti piu' pertinenti alla domanda, in ordine di punteggio.
+
+        Se nessun termine della domanda compare nello schema viene restituito
+        lo schema completo, per non privare il modello del contesto.
+        """
+        scores = self.score(question)
+        if not scores:
+            logger.info("Nessun oggetto dello schema pertinente alla domanda: uso lo schema completo.")
+            return self.model
+
+        ranked = sorted(scores.items(), key=lambda item: -item[1])
+        tables = [self._documents[d][1] for d, _ in ranked if self._documents[d][0] == "table"][:table_k]
+        procedures = [self._documents[d][1] for d, _ in ranked if self._documents[d][0] == "procedure"][:procedure_k]
+
+        selected = list(tables)
+        if expand_foreign_keys:
+            # Aggiunge le tabelle collegate da FK (al massimo altre table_k),
+            # preferendo quelle che hanno comunque un punteggio
+            table_scores = {self._documents[d][1]: s for d, s in scores.items() if self._documents[d][0] == "table"}
+            candidates = {n for name in tables for n in self._neighbours.get(name, ()) if n not in tables}
+            candidates = sorted(candidates, key=lambda name: (-table_scores.get(name, 0.0), name))
+            selected += candidates[:table_k]
+
+        # Tabelle e procedure in ordine di pertinenza: il serializzatore
+        # scarta dal fondo quando il prompt supera il budget
+        return SchemaModel(
+            tables={name: self.model.tables[name] for name in selected},
+            procedures=[self._procedures[name] for name in procedures],
+        )
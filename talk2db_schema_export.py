@@ -0,0 +1,567 @@
+import hashlib
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+from sqlalchemy import bindparam, inspect, text
+
+logger = logging.getLogger(__name__)
+
+# Versione del formato dello snapshot JSON
+SNAPSHOT_FORMAT = 1
+# Oggetti letti da ciascun lavoratore con una sola serie di query di catalogo
+CHUNK_SIZE = 500
+
+# SQL Server: elenco di tabelle e procedure con la data di ultima modifica.
+# Per le tabelle vale anche quella degli oggetti figli (vincoli di default,
+# chiavi esterne, trigger), insieme al loro numero: aggiungerne o toglierne
+# uno cambia la versione.
+# Secondo la documentazione la modify_date della tabella cambia anche con la
+# creazione o la modifica di un indice.
+MSSQL_OBJECTS_QUERY = """
+    SELECT o.object_id, s.name, o.name, RTRIM(o.type),
+        MAX(CASE WHEN c.modify_date > o.modify_date THEN c.modify_date ELSE o.modify_date END),
+        COUNT(c.object_id)
+    FROM sys.objects o
+    JOIN sys.schemas s ON s.schema_id = o.schema_id
+    LEFT JOIN sys.objects c ON c.parent_object_id = o.object_id
+    WHERE o.type IN ('U', 'P') AND o.is_ms_shipped = 0
+    GROUP BY o.object_id, s.name, o.name, o.type
+"""
+
+MSSQL_COLUMNS_QUERY = """
+    SELECT c.object_id, c.name, t.name, c.max_length, c.precision, c.scale, c.is_nullable, c.is_identity,
+        dc.definition, cc.definition
+    FROM sys.columns c
+    JOIN sys.types t ON t.user_type_id = c.user_type_id
+    LEFT JOIN sys.default_constraints dc ON dc.object_id = c.default_object_id
+    LEFT JOIN sys.computed_columns cc ON cc.object_id = c.object_id AND cc.column_id = c.column_id
+    WHERE c.object_id IN :ids
+    ORDER BY c.object_id, c.column_id
+"""
+
+MSSQL_INDEXES_QUERY = """
+    SELECT i.object_id, i.name, i.is_primary_key, i.is_unique, i.type_desc, c.name,
+        ic.is_included_column, ic.is_descending_key
+    FROM sys.indexes i
+    JOIN sys.index_columns ic ON ic.object_id = i.object_id AND ic.index_id = i.index_id
+    JOIN sys.columns c ON c.object_id = ic.object_id AND c.column_id = ic.column_id
+    WHERE i.object_id IN :ids AND i.type > 0 AND i.is_hypothetical = 0
+    ORDER BY i.object_id, i.index_id, ic.is_included_column, ic.key_ordinal, ic.index_column_id
+"""
+
+MSSQL_FOREIGN_KEYS_QUERY = """
+    SELECT fk.parent_object_id, fk.name, cp.name, SCHEMA_NAME(tr.schema_id), tr.name, cr.name,
+        fk.delete_referential_action_desc, fk.update_referential_action_desc
+    FROM sys.foreign_keys fk
+    JOIN sys.foreign_key_columns fkc ON fkc.constraint_object_id = fk.object_id
+    JOIN sys.columns cp ON cp.object_id = fkc.parent_object_id AND cp.column_id = fkc.parent_column_id
+    JOIN sys.tables tr ON tr.object_id = fkc.referenced_object_id
+    JOIN sys.columns cr ON cr.object_id = fkc.referenced_object_id AND cr.column_id = fkc.referenced_column_id
+    WHERE fk.parent_object_id IN :ids
+    ORDER BY fk.parent_object_id, fk.name, fkc.constraint_column_id
+"""
+
+MSSQL_PARAMETERS_QUERY = """
+    SELECT p.object_id, p.name, t.name, p.max_length, p.precision, p.scale, p.is_output
+    FROM sys.parameters p
+    JOIN sys.types t ON t.user_type_id = p.user_type_id
+    WHERE p.object_id IN :ids
+    ORDER BY p.object_id, p.parameter_id
+"""
+
+MSSQL_DEFINITIONS_QUERY = """
+    SELECT m.object_id, m.definition
+    FROM sys.sql_modules m
+    WHERE m.object_id IN :ids
+"""
+
+# SQLite (database dei benchmark): niente date di modifica, la versione di una
+# tabella e' l'impronta del suo CREATE TABLE e dei suoi CREATE INDEX
+SQLITE_OBJECTS_QUERY = """
+    SELECT m.name, m.type, m.tbl_name, m.sql
+    FROM sqlite_master m
+    WHERE m.type IN ('table', 'index') AND m.name NOT LIKE 'sqlite_%'
+    ORDER BY m.type DESC, m.name
+"""
+
+SQLITE_COLUMNS_QUERY = """
+    SELECT m.name, p.name, p.type, p."notnull", p.dflt_value, p.pk
+    FROM sqlite_master m
+    JOIN pragma_table_info(m.name) p
+    WHERE m.type = 'table' AND m.name IN :ids
+    ORDER BY m.name, p.cid
+"""
+
+SQLITE_INDEXES_QUERY = """
+    SELECT m.name, il.name, il."unique", il.origin, ii.name, ii."desc"
+    FROM sqlite_master m
+    JOIN pragma_index_list(m.name) il
+    JOIN pragma_index_xinfo(il.name) ii
+    WHERE m.type = 'table' AND m.name IN :ids AND il.origin != 'pk' AND ii."key" = 1
+    ORDER BY m.name, il.name, ii.seqno
+"""
+
+SQLITE_FOREIGN_KEYS_QUERY = """
+    SELECT m.name, f.id, f."from", f."table", f."to", f.on_delete, f.on_update
+    FROM sqlite_master m
+    JOIN pragma_foreign_key_list(m.name) f
+    WHERE m.type = 'table' AND m.name IN :ids
+    ORDER BY m.name, f.id, f.seq
+"""
+
+# Procedure simulate su SQLite (stessa tabella usata da talk2db_introspection)
+SQLITE_PROCEDURES_TABLE = "t2db_procedures"
+SQLITE_PROCEDURES_QUERY = f"""
+    SELECT procedure_name, parameter_name, data_type
+    FROM {SQLITE_PROCEDURES_TABLE}
+    ORDER BY procedure_name, position
+"""
+
+
+def _fingerprint(*parts):
+    return hashlib.sha1("\x1f".join(part or "" for part in parts).encode("utf-8")).hexdigest()[:16]
+
+
+def _expanding(query):
+    return text(query).bindparams(bindparam("ids", expanding=True))
+
+
+def mssql_type(type_name, max_length, precision, scale):
+    """Tipo SQL Server con lunghezza, precisione o scala: nvarchar(50), decimal(18,2), varchar(max)."""
+    if type_name in ("varchar", "char", "varbinary", "binary", "nvarchar", "nchar"):
+        if max_length == -1:
+            return f"{type_name}(max)"
+        length = max_length // 2 if type_name in ("nvarchar", "nchar") else max_length
+        return f"{type_name}({length})"
+    if type_name in ("decimal", "numeric"):
+        return f"{type_name}({precision},{scale})"
+    if type_name in ("datetime2", "time", "datetimeoffset"):
+        return f"{type_name}({scale})"
+    return type_name
+
+
+def _table(schema, name, version):
+    return {"schema": schema, "name": name, "version": version, "columns": [], "primary_key": None,
+            "foreign_keys": [], "indexes": []}
+
+
+def _procedure(schema, name, version):
+    return {"schema": schema, "name": name, "version": version, "parameters": [], "definition": None}
+
+
+def _add_foreign_key(table, name, column, referred_schema, referred_table, referred_column, on_delete, on_update):
+    """Accoda una colonna alla FK con lo stesso nome (FK composte su piu' righe)."""
+    if table["foreign_keys"] and table["foreign_keys"][-1]["name"] == name:
+        fk = table["foreign_keys"][-1]
+    else:
+        fk = {"name": name, "columns": [], "referred_schema": referred_schema, "referred_table": referred_table,
+              "referred_columns": [], "on_delete": on_delete, "on_update": on_update}
+        table["foreign_keys"].append(fk)
+    fk["columns"].append(column)
+    fk["referred_columns"].append(referred_column)
+
+
+def _add_index_column(table, name, column, unique, kind, included=False, descending=False):
+    if table["indexes"] and table["indexes"][-1]["name"] == name:
+        index = table["indexes"][-1]
+    else:
+        index = {"name": name, "unique": unique, "kind": kind, "columns": [], "descending": [], "included": []}
+        table["indexes"].append(index)
+    if included:
+        index["included"].append(column)
+    else:
+        index["columns"].append(column)
+        if descending:
+            index["descending"].append(column)
+
+
+class _MssqlExporter:
+    """Lettura del catalogo di SQL Server per gruppi di object_id."""
+
+    def list_objects(self, connection):
+        objects = {}
+        for object_id, schema, name, kind, modified, children in connection.execute(text(MSSQL_OBJECTS_QUERY)):
+            # Con il numero di figli si nota anche la rimozione di un vincolo meno recente
+            version = f"{modified.isoformat()}/{children}" if modified else None
+            objects[f"{schema}.{name}"] = (object_id, "table" if kind == "U" else "procedure", schema, name, version)
+        return objects
+
+    def read(self, connection, objects):
+        """Dettagli degli oggetti indicati (chiave -> (id, tipo, schema, nome, versione))."""
+        tables, procedures = {}, {}
+        by_id = {}
+        for key, (object_id, kind, schema, name, version) in objects.items():
+            if kind == "table":
+                by_id[object_id] = tables[key] = _table(schema, name, version)
+            else:
+                by_id[object_id] = procedures[key] = _procedure(schema, name, version)
+        ids = list(by_id)
+        params = {"ids": ids}
+
+        for object_id, name, type_name, max_length, precision, scale, nullable, identity, default, computed in \
+                connection.execute(_expanding(MSSQL_COLUMNS_QUERY), params):
+            by_id[object_id]["columns"].append({
+                "name": name,
+                "type": mssql_type(type_name, max_length, precision, scale),
+                "nullable": bool(nullable),
+                "default": default,
+                "identity": bool(identity),
+                "computed": computed,
+            })
+        for object_id, name, is_primary_key, unique, kind, column, included, descending in \
+                connection.execute(_expanding(MSSQL_INDEXES_QUERY), params):
+            table = by_id[object_id]
+            if is_primary_key:
+                if table["primary_key"] is None:
+                    table["primary_key"] = {"name": name, "kind": kind.lower(), "columns": []}
+                table["primary_key"]["columns"].append(column)
+            else:
+                _add_index_column(table, name, column, bool(unique), kind.lower(), bool(included), bool(descending))
+        for object_id, *fk in connection.execute(_expanding(MSSQL_FOREIGN_KEYS_QUERY), params):
+            _add_foreign_key(by_id[object_id], *fk)
+        for object_id, name, type_name, max_length, precision, scale, output in \
+                connection.execute(_expanding(MSSQL_PARAMETERS_QUERY), params):
+            if name:
+                by_id[object_id]["parameters"].append({
+                    "name": name.lstrip("@"),
+                    "type": mssql_type(type_name, max_length, precision, scale),
+                    "output": bool(output),
+                })
+        for object_id, definition in connection.execute(_expanding(MSSQL_DEFINITIONS_QUERY), params):
+            if object_id in by_id and "definition" in by_id[object_id]:
+                by_id[object_id]["definition"] = definition
+        return tables, procedures
+
+
+class _SqliteExporter:
+    """SQLite: tabelle da sqlite_master e pragma, procedure dalla tabella di simulazione."""
+
+    def list_objects(self, connection):
+        tables = {}
+        index_sql = {}
+        for name, kind, table_name, sql in connection.execute(text(SQLITE_OBJECTS_QUERY)):
+            if kind == "table":
+                tables[name] = sql
+            elif sql:
+                index_sql.setdefault(table_name, []).append(sql)
+        objects = {
+            f"main.{name}": (name, "table", "main", name, _fingerprint(sql, *index_sql.get(name, [])))
+            for name, sql in tables.items() if name != SQLITE_PROCEDURES_TABLE
+        }
+        if SQLITE_PROCEDURES_TABLE in tables:
+            rows = {}
+            for proc_name, param_name, data_type in connection.execute(text(SQLITE_PROCEDURES_QUERY)):
+                rows.setdefault(proc_name, []).append(f"{param_name}:{data_type}")
+            for proc_name, params in rows.items():
+                objects[f"main.{proc_name}"] = (proc_name, "procedure", "main", proc_name, _fingerprint(*params))
+        return objects
+
+    def read(self, connection, objects):
+        tables, procedures = {}, {}
+        by_name = {}
+        for key, (object_id, kind, schema, name, version) in objects.items():
+            if kind == "table":
+                by_name[object_id] = tables[key] = _table(schema, name, version)
+            else:
+                procedures[key] = _procedure(schema, name, version)
+        params = {"ids": list(by_name)}
+
+        pk_positions = {}
+        for table_name, name, data_type, notnull, default, pk in connection.execute(_expanding(SQLITE_COLUMNS_QUERY), params):
+            by_name[table_name]["columns"].append({
+                "name": name, "type": data_type, "nullable": not notnull, "default": default,
+                "identity": False, "computed": None,
+            })
+            if pk:
+                pk_positions.setdefault(table_name, []).append((pk, name))
+        for table_name, positions in pk_positions.items():
+            by_name[table_name]["primary_key"] = {
+                "name": f"pk_{table_name}", "kind": None, "columns": [name for _, name in sorted(positions)],
+            }
+        for table_name, name, unique, origin, column, descending in \
+                connection.execute(_expanding(SQLITE_INDEXES_QUERY), params):
+            _add_index_column(by_name[table_name], name, column, bool(unique),
+                              "unique_constraint" if origin == "u" else None, descending=bool(descending))
+        for table_name, fk_id, column, referred_table, referred_column, on_delete, on_update in \
+                connection.execute(_expanding(SQLITE_FOREIGN_KEYS_QUERY), params):
+            _add_foreign_key(by_name[table_name], f"fk_{table_name}_{fk_id}", column, "main", referred_table,
+                             referred_column, on_delete, on_update)
+
+        if procedures:
+            wanted = {procedure["name"]: procedure for procedure in procedures.values()}
+            for proc_name, param_name, data_type in connection.execute(text(SQLITE_PROCEDURES_QUERY)):
+                if proc_name in wanted and param_name:
+                    wanted[proc_name]["parameters"].append({"name": param_name, "type": data_type, "output": False})
+        return tables, procedures
+
+
+class _GenericExporter:
+    """Altri dialetti: riflessione multi-tabella di SQLAlchemy, senza versioni (sempre riletto) ne' procedure."""
+
+    def list_objects(self, connection):
+        inspector = inspect(connection)
+        schema = inspector.default_schema_name or ""
+        return {f"{schema}.{name}": (name, "table", schema, name, None) for name in inspector.get_table_names()}
+
+    def read(self, connection, objects):
+        inspector = inspect(connection)
+        tables = {}
+        by_name = {}
+        for key, (object_id, _, schema, name, version) in objects.items():
+            by_name[object_id] = tables[key] = _table(schema, name, version)
+        names = list(by_name)
+        for (_, name), columns in inspector.get_multi_columns(filter_names=names).items():
+            by_name[name]["columns"] = [
+                {"name": c["name"], "type": str(c["type"]), "nullable": c.get("nullable", True),
+                 "default": c.get("default"), "identity": bool(c.get("identity")),
+                 "computed": (c.get("computed") or {}).get("sqltext")}
+                for c in columns
+            ]
+        for (_, name), pk in inspector.get_multi_pk_constraint(filter_names=names).items():
+            if pk.get("constrained_columns"):
+                by_name[name]["primary_key"] = {"name": pk.get("name"), "kind": None,
+                                                "columns": list(pk["constrained_columns"])}
+        for (_, name), fks in inspector.get_multi_foreign_keys(filter_names=names).items():
+            by_name[name]["foreign_keys"] = [
+                {"name": fk.get("name") or "", "columns": fk["constrained_columns"],
+                 "referred_schema": fk.get("referred_schema"), "referred_table": fk["referred_table"],
+                 "referred_columns": fk["referred_columns"], "on_delete": (fk.get("options") or {}).get("ondelete"),
+                 "on_update": (fk.get("options") or {}).get("onupdate")}
+                for fk in fks
+            ]
+        for (_, name), indexes in inspector.get_multi_indexes(filter_names=names).items():
+            by_name[name]["indexes"] = [
+                {"name": index["name"], "unique": bool(index.get("unique")), "kind": None,
+                 "columns": [column for column in index["column_names"] if column], "descending": [],
+                 "included": list((index.get("dialect_options") or {}).get("mssql_include") or [])}
+                for index in indexes
+            ]
+        return tables, {}
+
+
+EXPORTERS = {
+    "mssql": _MssqlExporter,
+    "sqlite": _SqliteExporter,
+}
+
+
+def export_schema(engine, previous=None, workers=4, excluded_tables=()):
+    """Snapshot dello schema: tabelle (colonne, PK, FK, indici) e procedure (parametri, definizione).
+
+    Con uno snapshot precedente dello stesso database rilegge solo gli oggetti
+    la cui versione (data di modifica su SQL Server, impronta del DDL su
+    SQLite) e' cambiata o che non c'erano; gli altri sono copiati. Gli oggetti
+    da leggere sono divisi in gruppi letti in parallelo da workers connessioni,
+    con poche query di catalogo per gruppo.
+    Restituisce (snapshot, statistiche della lettura).
+    """
+    start = time.perf_counter()
+    exporter = EXPORTERS.get(engine.dialect.name, _GenericExporter)()
+    with engine.connect() as connection:
+        objects = exporter.list_objects(connection)
+    excluded = set(excluded_tables)
+    objects = {key: info for key, info in objects.items() if info[3] not in excluded}
+
+    database = engine.url.database
+    if previous is not None and (previous.get("dialect") != engine.dialect.name or previous.get("database") != database):
+        logger.warning("Lo snapshot precedente appartiene a un altro database: esportazione completa.")
+        previous = None
+    old = {}
+    if previous is not None:
+        old.update({key: ("table", value) for key, value in previous["tables"].items()})
+        old.update({key: ("procedure", value) for key, value in previous["procedures"].items()})
+
+    tables, procedures = {}, {}
+    to_read = {}
+    for key, info in objects.items():
+        kind, version = info[1], info[4]
+        previous_kind, previous_value = old.get(key, (None, None))
+        if version is not None and previous_kind == kind and previous_value.get("version") == version:
+            (tables if kind == "table" else procedures)[key] = previous_value
+        else:
+            to_read[key] = info
+
+    def read_chunk(chunk):
+        with engine.connect() as connection:
+            return exporter.read(connection, chunk)
+
+    keys = list(to_read)
+    chunk_size = max(1, min(CHUNK_SIZE, -(-len(keys) // max(1, workers))))
+    chunks = [{key: to_read[key] for key in keys[i:i + chunk_size]} for i in range(0, len(keys), chunk_size)]
+    if chunks:
+        with ThreadPoolExecutor(max_workers=max(1, min(workers, len(chunks)))) as executor:
+            for chunk_tables, chunk_procedures in executor.map(read_chunk, chunks):
+                tables.update(chunk_tables)
+                procedures.update(chunk_procedures)
+
+    snapshot = {
+        "format": SNAPSHOT_FORMAT,
+        "created": datetime.now().isoformat(timespec="seconds"),
+        "dialect": engine.dialect.name,
+        "database": database,
+        "tables": dict(sorted(tables.items())),
+        "procedures": dict(sorted(procedures.items())),
+    }
+    stats = {
+        "incremental": previous is not None,
+        "objects": len(objects),
+        "read": len(to_read),
+        "reused": len(objects) - len(to_read),
+        "chunks": len(chunks),
+        "seconds": round(time.perf_counter() - start, 3),
+    }
+    logger.info(
+        f"Schema esportato in {stats['seconds']} s: {len(tables)} tabelle, {len(procedures)} procedure, "
+        f"{stats['read']} oggetti letti, {stats['reused']} invariati."
+    )
+    return snapshot, stats
+
+
+def _by_name(items):
+    return {item["name"]: item for item in items}
+
+
+def _diff_named(before, after):
+    """Elementi aggiunti, rimossi e modificati di due liste di dizionari con "name"."""
+    before, after = _by_name(before), _by_name(after)
+    return {
+        "added": [after[name] for name in after if name not in before],
+        "removed": sorted(name for name in before if name not in after),
+        "changed": [{"name": name, "before": before[name], "after": after[name]}
+                    for name in after if name in before and before[name] != after[name]],
+    }
+
+
+def _diff_table(before, after):
+    changes = {}
+    for field in ("columns", "foreign_keys", "indexes"):
+        diff = _diff_named(before[field], after[field])
+        if any(diff.values()):
+            changes[field] = diff
+    if before["primary_key"] != after["primary_key"]:
+        changes["primary_key"] = {"before": before["primary_key"], "after": after["primary_key"]}
+    return changes
+
+
+def _diff_procedure(before, after):
+    changes = {}
+    for field in ("parameters", "definition"):
+        if before[field] != after[field]:
+            changes[field] = {"before": before[field], "after": after[field]}
+    return changes
+
+
+def diff_snapshots(old, new):
+    """Differenze tra due snapshot: oggetti aggiunti, rimossi e modificati (solo cio' che cambia, non la versione)."""
+    diff = {}
+    for section, compare in (("tables", _diff_table), ("procedures", _diff_procedure)):
+        before, after = old[section], new[section]
+        changed = {}
+        for key in after:
+            if key in before:
+                changes = compare(before[key], after[key])
+                if changes:
+                    changed[key] = changes
+        diff[section] = {
+            "added": [key for key in after if key not in before],
+            "removed": [key for key in before if key not in after],
+            "changed": changed,
+        }
+    return diff
+
+
+def has_changes(diff):
+    return any(section["added"] or section["removed"] or section["changed"] for section in diff.values())
+
+
+def format_diff(diff):
+    """Righe leggibili della differenza: + aggiunto, - rimosso, ~ modificato."""
+    lines = []
+    for section, label in (("tables", "tabella"), ("procedures", "procedura")):
+        lines += [f"+ {label} {key}" for key in diff[section]["added"]]
+        lines += [f"- {label} {key}" for key in diff[section]["removed"]]
+        for key, changes in diff[section]["changed"].items():
+            for field, change in changes.items():
+                if isinstance(change, dict) and "added" in change:
+                    parts = [f"+{item['name']}" for item in change["added"]]
+                    parts += [f"-{name}" for name in change["removed"]]
+                    parts += [f"~{item['name']}" for item in change["changed"]]
+                    lines.append(f"~ {label} {key}: {field} {', '.join(parts)}")
+                else:
+                    lines.append(f"~ {label} {key}: {field}")
+    return lines
+
+
+def _quote(dialect, name):
+    if dialect == "mssql":
+        return "[" + name.replace("]", "]]") + "]"
+    return '"' + name.replace('"', '""') + '"'
+
+
+def render_ddl(snapshot):
+    """DDL dello snapshot: tabelle con PK, indici, poi chiavi esterne e procedure."""
+    dialect = snapshot["dialect"]
+
+    def q(name):
+        return _quote(dialect, name)
+
+    def qualified(schema, name):
+        return f"{q(schema)}.{q(name)}" if schema else q(name)
+
+    statements = []
+    for table in snapshot["tables"].values():
+        table_name = qualified(table["schema"], table["name"])
+        lines = []
+        for column in table["columns"]:
+            if column.get("computed"):
+                lines.append(f"    {q(column['name'])} AS {column['computed']}")
+                continue
+            line = f"    {q(column['name'])} {column['type']}"
+            if column.get("identity"):
+                line += " IDENTITY"
+            line += " NULL" if column["nullable"] else " NOT NULL"
+            if column.get("default") is not None:
+                line += f" DEFAULT {column['default']}"
+            lines.append(line)
+        pk = table["primary_key"]
+        if pk:
+            kind = " CLUSTERED" if pk.get("kind") == "clustered" else " NONCLUSTERED" if pk.get("kind") == "nonclustered" else ""
+            constraint = f"CONSTRAINT {q(pk['name'])} " if pk.get("name") else ""
+            lines.append(f"    {constraint}PRIMARY KEY{kind} ({', '.join(q(c) for c in pk['columns'])})")
+        statements.append(f"CREATE TABLE {table_name} (\n" + ",\n".join(lines) + "\n);")
+        for index in table["indexes"]:
+            columns = ", ".join(q(c) + (" DESC" if c in index["descending"] else "") for c in index["columns"])
+            statement = f"CREATE {'UNIQUE ' if index['unique'] else ''}INDEX {q(index['name'])} ON {table_name} ({columns})"
+            if index["included"]:
+                statement += f" INCLUDE ({', '.join(q(c) for c in index['included'])})"
+            statements.append(statement + ";")
+
+    for table in snapshot["tables"].values():
+        for fk in table["foreign_keys"]:
+            constraint = f"CONSTRAINT {q(fk['name'])} " if fk.get("name") else ""
+            statement = (
+                f"ALTER TABLE {qualified(table['schema'], table['name'])} ADD {constraint}"
+                f"FOREIGN KEY ({', '.join(q(c) for c in fk['columns'])}) "
+                f"REFERENCES {qualified(fk['referred_schema'], fk['referred_table'])} "
+                f"({', '.join(q(c) for c in fk['referred_columns'])})"
+            )
+            for action, value in (("DELETE", fk.get("on_delete")), ("UPDATE", fk.get("on_update"))):
+                if value and value.upper().replace("_", " ") not in ("NO ACTION", "NONE"):
+                    statement += f" ON {action} {value.upper().replace('_', ' ')}"
+            statements.append(statement + ";")
+
+    # SQL Server: CREATE PROCEDURE deve essere la prima istruzione del batch, quindi
+    # un GO chiude le istruzioni precedenti e uno segue ogni definizione
+    if dialect == "mssql" and any(procedure.get("definition") for procedure in snapshot["procedures"].values()):
+        statements.append("GO")
+    for procedure in snapshot["procedures"].values():
+        if procedure.get("definition"):
+            statements.append(procedure["definition"].strip() + ("\nGO" if dialect == "mssql" else ""))
+        else:
+            params = ", ".join(
+                f"@{p['name']} {p['type']}{' OUTPUT' if p['output'] else ''}" for p in procedure["parameters"]
+            )
+            statements.append(f"-- PROCEDURE {qualified(procedure['schema'], procedure['name'])}({params})")
+    return "\n\n".join(statements) + "\n"
@@ -0,0 +1,208 @@
+import logging
+import math
+import re
+from collections import Counter
+
+try:
+    import tiktoken
+except ImportError:  # dipendenza opzionale: senza, i token sono stimati dai caratteri
+    tiktoken = None
+
+logger = logging.getLogger(__name__)
+
+# Abbreviazioni dei tipi dei parametri delle procedure; nel prompt viene
+# aggiunta una legenda con quelle effettivamente usate
+TYPE_ABBREVIATIONS = {
+    "nvarchar": "nvc",
+    "varchar": "vc",
+    "nchar": "nch",
+    "char": "ch",
+    "datetime": "dt",
+    "datetime2": "dt2",
+    "smalldatetime": "sdt",
+    "datetimeoffset": "dto",
+    "decimal": "dec",
+    "numeric": "num",
+    "uniqueidentifier": "guid",
+    "smallint": "sint",
+    "tinyint": "tint",
+    "varbinary": "vbin",
+    "money": "mon",
+}
+
+# Colonne di servizio sacrificate per prime quando il prompt supera il budget.
+# Il nome intero deve essere di audit (CreatedAt, ModifiedBy, DataIns, RowVersion):
+# UpdateCount, OperatoreId o i flag di cancellazione logica (Deleted, DeletedAt)
+# servono al modello per filtrare e restano
+LOW_VALUE_COLUMN_RE = re.compile(
+    r"^(?:"
+    r"(?:created|creation|modified|modify|updated|update|last_?modified|last_?updated?|inserted|insert)"
+    r"(?:_?(?:at|by|on|date|time|datetime|dt|ts|user|utente|data|ora))?"
+    r"|row_?version|timestamp|ts|concurrency(?:_?(?:stamp|token))?"
+    r"|(?:user|utente|operatore)_?(?:ins|mod|agg|inserimento|modifica|aggiornamento)"
+    r"|data_?(?:ins|mod|agg|inserimento|modifica|aggiornamento)"
+    r")$",
+    re.IGNORECASE,
+)
+
+# Un gruppo di colonne viene fattorizzato solo se compare in almeno
+# MIN_GROUP_TABLES tabelle e ha almeno MIN_GROUP_COLUMNS colonne
+MIN_GROUP_TABLES = 3
+MIN_GROUP_COLUMNS = 2
+
+# Quota del budget sempre riservata alle procedure quando il prompt va ridotto:
+# oltre questa (o oltre quanto lasciano le tabelle) si tolgono le ultime
+# procedure prima di sacrificare tabelle
+PROCEDURE_BUDGET_SHARE = 0.25
+
+_encoding = None
+
+
+def estimate_tokens(value):
+    """Numero di token del testo: esatto con tiktoken, altrimenti stimato (~4 caratteri per token)."""
+    global _encoding
+    if tiktoken is not None:
+        if _encoding is None:
+            _encoding = tiktoken.get_encoding("o200k_base")
+        return len(_encoding.encode(value))
+    return math.ceil(len(value) / 4)
+
+
+class SerializedSchema:
+    """Schema serializzato per il prompt con il conteggio dei token usati."""
+
+    def __init__(self, text, tokens, dropped_columns=0, dropped_tables=0, dropped_procedures=0):
+        self.text = text
+        self.tokens = tokens
+        self.dropped_columns = dropped_columns
+        self.dropped_tables = dropped_tables
+        self.dropped_procedures = dropped_procedures
+
+
+def _column_groups(tables):
+    """Individua i gruppi di colonne ricorrenti in piu' tabelle (Id, CreatedAt, ...)."""
+    frequency = Counter(name for _, columns in tables for name in set(columns))
+    frequent = {name for name, count in frequency.items() if count >= MIN_GROUP_TABLES}
+    signatures = Counter()
+    for _, columns in tables:
+        signature = tuple(name for name in columns if name in frequent)
+        if len(signature) >= MIN_GROUP_COLUMNS:
+            signatures[signature] += 1
+    groups = [signature for signature, count in signatures.most_common() if count >= MIN_GROUP_TABLES]
+    return {signature: f"${i + 1}" for i, signature in enumerate(groups)}
+
+
+def _table_line(name, columns, groups):
+    for signature, alias in groups.items():
+        if len(signature) <= len(columns) and set(signature).issubset(columns):
+            rest = [column for column in columns if column not in signature]
+            return f"{name} ({', '.join([alias] + rest)})", alias
+    return f"{name} ({', '.join(columns)})", None
+
+
+def _procedure_line(procedure, abbreviate_types, used_types):
+    params = []
+    for name, data_type in procedure.parameters:
+        short = TYPE_ABBREVIATIONS.get((data_type or "").lower()) if abbreviate_types else None
+        if short:
+            used_types.add((short, data_type.lower()))
+            data_type = short
+        params.append(f"{name} {data_type}")
+    return f"{procedure.name}({', '.join(params)})"
+
+
+def _render(tables, procedures, factor_common_columns, abbreviate_types):
+    groups = _column_groups(tables) if factor_common_columns else {}
+    used_groups = set()
+    table_lines = []
+    for name, columns in tables:
+        line, alias = _table_line(name, columns, groups)
+        table_lines.append(line)
+        if alias:
+            used_groups.add(alias)
+
+    used_types = set()
+    procedure_lines = [_procedure_line(procedure, abbreviate_types, used_types) for procedure in procedures]
+
+    legend = [f"{alias} = {', '.join(signature)}" for signature, alias in groups.items() if alias in used_groups]
+    if legend:
+        legend.insert(0, "Recurring column groups ($n stands for the listed columns):")
+    if used_types:
+        legend.append("Types: " + ", ".join(f"{short}={full}" for short, full in sorted(used_types)))
+    return legend, table_lines, procedure_lines
+
+
+def serialize_schema(model, token_budget=0, factor_common_columns=True, abbreviate_types=True):
+    """Serializza lo schema nel formato piu' compatto che rientra nel budget di token.
+
+    Le tabelle del modello vanno ordinate per importanza: quando il testo
+    supera il budget si eliminano prima le colonne di servizio (mai chiavi
+    primarie o esterne), poi le ultime procedure oltre la loro quota del budget
+    (PROCEDURE_BUDGET_SHARE), poi le ultime tabelle e infine le procedure rimaste.
+    Con token_budget=0 il budget e' illimitato.
+    """
+    line_tokens = {}
+
+    def count(lines):
+        total = 0
+        for line in lines:
+            if line not in line_tokens:
+                line_tokens[line] = estimate_tokens(line + "\n")
+            total += line_tokens[line]
+        return total
+
+    tables = [(table.name, [column.name for column in table.columns]) for table in model.tables.values()]
+    procedures = list(model.procedures)
+    dropped_columns = dropped_tables = dropped_procedures = 0
+
+    def render_and_count():
+        legend, table_lines, procedure_lines = _render(tables, procedures, factor_common_columns, abbreviate_types)
+        lines = legend + table_lines + procedure_lines
+        return lines, table_lines, procedure_lines, count(lines)
+
+    def drop_procedures(excess):
+        # Toglie in un colpo solo le ultime procedure che coprono l'eccedenza
+        nonlocal dropped_procedures
+        while excess > 0 and procedures:
+            procedures.pop()
+            excess -= count([procedure_lines.pop()])
+            dropped_procedures += 1
+
+    lines, table_lines, procedure_lines, tokens = render_and_count()
+
+    if token_budget and tokens > token_budget:
+        trimmed = []
+        for name, columns in tables:
+            table = model.tables[name]
+            protected = set(table.primary_key) | {c for fk in table.foreign_keys for c in fk.columns}
+            kept = [c for c in columns if c in protected or not LOW_VALUE_COLUMN_RE.match(c)]
+            dropped_columns += len(columns) - len(kept)
+            trimmed.append((name, kept or columns[:1]))
+        tables = trimmed
+        lines, table_lines, procedure_lines, tokens = render_and_count()
+
+    if token_budget and tokens > token_budget and procedures:
+        # Le procedure tengono la loro quota o quanto lasciano libero le tabelle:
+        # una lunga lista di procedure non fa sparire le tabelle
+        allowance = max(token_budget * PROCEDURE_BUDGET_SHARE, token_budget - (tokens - count(procedure_lines)))
+        drop_procedures(count(procedure_lines) - allowance)
+        lines, table_lines, procedure_lines, tokens = render_and_count()
+
+    while token_budget and tokens > token_budget and len(tables) > 1:
+        # Toglie in un colpo solo le ultime tabelle che coprono l'eccedenza,
+        # poi ricalcola (i gruppi di colonne possono cambiare)
+        excess = tokens - token_budget
+        while excess > 0 and len(tables) > 1:
+            tables.pop()
+            excess -= count([table_lines.pop()])
+            dropped_tables += 1
+        lines, table_lines, procedure_lines, tokens = render_and_count()
+
+    while token_budget and tokens > token_budget and procedures:
+        drop_procedures(tokens - token_budget)
+        lines, table_lines, procedure_lines, tokens = render_and_count()
+
+    if token_budget and tokens > token_budget:
+        logger.warning(f"Schema oltre il budget anche dopo la riduzione: {tokens} token su {token_budget}.")
+
+    return SerializedSchema("\n".join(lines), tokens, dropped_columns, dropped_tables, dropped_procedures)
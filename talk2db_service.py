@@ -1,33 +1,62 @@
+import time
+# Inizio dell'import del modulo: riferimento per i tempi di avvio su /metrics
+_import_started = time.perf_counter()
 import argparse
+import copy
+import json
 import os
-import re
+import secrets
+import functools
+import importlib
 import sys
 import logging
-import requests
-from sqlalchemy import create_engine, inspect, text
-import pandas as pd
-from fastapi import FastAPI, HTTPException
+from typing import Optional
+import anyio
+import asyncio
+from sqlalchemy import text
+from contextlib import asynccontextmanager
+from fastapi import APIRouter, FastAPI, Header, HTTPException, Request
+from fastapi.responses import JSONResponse, PlainTextResponse, Response, StreamingResponse
 from pydantic import BaseModel
-import config
-from openai import OpenAI
+from talk2db_cache_backends import SqliteCacheBackend
+from talk2db_arrow import FORMAT_MEDIA_TYPES, ArrowEncoder, UnsupportedFormatError, encode_rows, negotiate_format
+from talk2db_cancellation import install_cancellation, run_cancellable
+from talk2db_catalog import SchemaCatalog
+from talk2db_cost_gate import CostGate, QueryRejected
+from talk2db_introspection import format_schema, load_schema_model
+from talk2db_llm import HuggingFaceBackend, OpenAIBackend
+from talk2db_metrics import REGISTRY, MetricsMiddleware, current_timings, stage
+from talk2db_pagination import PageRequest, decode_page_token, encode_page_token, fetch_page
+from talk2db_pool import DatabaseEngines, open_connections
+from talk2db_question_cache import QuestionCache, normalize_question
+from talk2db_result_cache import ResultCache, normalize_sql, parse_table_ttls
+from talk2db_serializer import serialize_schema
+from talk2db_singleflight import SingleFlight
+from talk2db_sql_validation import SQLGLOT_DIALECTS, SqlGuard, SqlValidationError, extract_sql
+from talk2db_streaming import QueryStream
+from talk2db_tenants import Tenant, TenantLimitExceeded, TenantRegistry, UnknownTenant
+from talk2db_workload import WorkloadLog
 
 # Configura il logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 
-# FastAPI app initialization
-app = FastAPI()
+# Endpoint del servizio; l'applicazione FastAPI viene creata da create_app()
+router = APIRouter()
 
-# Verifica le variabili di ambiente
-required_env_vars = ["T2DB_DB_USER", "T2DB_DB_PASS", "T2DB_DB_HOST", "T2DB_DB_PORT", "T2DB_DB_NAME", "T2DB_HF_API_TOKEN"]
+# T2DB_DB_URL, se presente, sostituisce i parametri di connessione a SQL Server
+DB_URL = os.getenv("T2DB_DB_URL")
+# Replica in sola lettura per le SELECT generate (facoltativa)
+DB_REPLICA_URL = os.getenv("T2DB_DB_REPLICA_URL")
 
-missing_vars = [var for var in required_env_vars if os.getenv(var) is None]
-
-if missing_vars:
-    logger.error(f"Errore: Le seguenti variabili di ambiente non sono impostate: {', '.join(missing_vars)}")
-    sys.exit(1)
-else:
-    logger.info("Tutte le variabili di ambiente sono impostate correttamente.")
+# Piu' database serviti dallo stesso processo (T2DB_TENANTS="VENDITE,MAGAZZINO"): le
+# richieste scelgono il database con il campo "database", senza il default
+# (T2DB_DEFAULT_TENANT, altrimenti il primo). Senza T2DB_TENANTS si usa solo il
+# database configurato con T2DB_DB_URL o T2DB_DB_*
+TENANTS = [name.strip() for name in os.getenv("T2DB_TENANTS", "").split(",") if name.strip()]
+# URL di ogni database con {tenant} al posto del nome (default: SQL Server con T2DB_DB_*)
+TENANT_URL_TEMPLATE = os.getenv("T2DB_TENANT_URL_TEMPLATE")
+TENANT_REPLICA_URL_TEMPLATE = os.getenv("T2DB_TENANT_REPLICA_URL_TEMPLATE")
 
 # Configura l'API di Hugging Face
 API_URL = os.getenv('T2DB_HF_API_URL')
@@ -35,10 +64,36 @@ API_TOKEN = os.getenv("T2DB_HF_API_TOKEN")  # Inserisci la tua chiave API in una
 
 headers = {"Authorization": f"Bearer {API_TOKEN}"}
 
+OPENAI_MODEL = os.getenv("T2DB_OAI_MODEL", "gpt-4o-mini")
+
 class QuestionRequest(BaseModel):
     question: str
+    # Righe per pagina; assente o oltre T2DB_MAX_ROWS vale T2DB_MAX_ROWS
+    page_size: Optional[int] = None
+    # Database da interrogare, tra quelli di T2DB_TENANTS; assente = quello di default
+    database: Optional[str] = None
+
+class PageTokenRequest(BaseModel):
+    page_token: str
+
+class InvalidateRequest(BaseModel):
+    # Tabelle da invalidare; assente = tutta la cache
+    tables: Optional[list[str]] = None
+
+def repair_instructions(repair):
+    """Richiesta di correzione per il modello: SQL precedente ed errori della validazione locale."""
+    previous_sql, errors = repair
+    problems = "\n".join(f"- {error}" for error in errors)
+    return f"""The previous query is not valid for this database:
+{previous_sql}
 
-def create_sql_prompt(user_question, db_schema):
+Problems found:
+{problems}
+Fix the query using only the tables, columns and procedures in the schema and provide only the corrected statement."""
+
+def create_sql_prompt(user_question, db_schema, repair=None):
+    if repair is not None:
+        user_question = f"{user_question}\n\n{repair_instructions(repair)}"
     prompt = f"""[INST] <<SYS>>
 You are a helpful assistant specialized in generating SQL queries. Your task is to translate the user's question into SQL code that will run on a database. Only respond with SQL code, without any additional text, explanations, or comments.
 <</SYS>>
@@ -50,46 +105,67 @@ Translate the question above into TSQL code and provide only the SQL statement.
 [/INST]"""
     return prompt
 
-def query_huggingface_api(prompt):
+# Limite di chiamate concorrenti per provider (T2DB_LLM_CONCURRENCY come default)
+LLM_CONCURRENCY = int(os.getenv("T2DB_LLM_CONCURRENCY", "8"))
+
+# Opzioni comuni dei client LLM: timeout, tentativi e backoff
+llm_options = {
+    "connect_timeout": float(os.getenv("T2DB_LLM_CONNECT_TIMEOUT", "5")),
+    "read_timeout": float(os.getenv("T2DB_LLM_READ_TIMEOUT", "60")),
+    "max_retries": int(os.getenv("T2DB_LLM_MAX_RETRIES", "3")),
+    "backoff_base": float(os.getenv("T2DB_LLM_BACKOFF_BASE", "0.5")),
+    "backoff_max": float(os.getenv("T2DB_LLM_BACKOFF_MAX", "8")),
+}
+
+# Componenti con risorse (database, cache, client LLM), creati da init_components()
+# alla creazione dell'applicazione: importare il modulo non apre connessioni.
+# Motori, schema, validatore e controllo dei costi sono per database (Tenant);
+# cache delle domande e dei risultati e client LLM sono condivisi
+tenants = None
+schema_cache = None
+question_cache = None
+result_cache = None
+openai_backend = None
+hf_backend = None
+
+async def query_huggingface_api(prompt):
     """Esegue una richiesta al modello Hugging Face con il prompt specificato."""
-    response = requests.post(API_URL, headers=headers, json={"inputs": prompt})
-    logger.debug(response)
-    if response.status_code == 200:
-        return response.json()[0]['generated_text']
-    else:
-        logger.error(f"Errore nella richiesta API: {response.status_code} - {response.text}")
-        raise Exception("Errore nella richiesta API")
+    try:
+        return await hf_backend.generate(prompt)
+    except Exception as e:
+        logger.error(f"Errore nella richiesta API: {e}")
+        raise
 
 # Funzione per chiamare l'API di OpenAI
-def query_openai_api(question, schema):
+async def query_openai_api(question, schema, repair=None):
     try:
-        client = OpenAI()
-        client.api_key = os.environ.get('T2DB_OAI_API_TOKEN')
-
-        completion = client.chat.completions.create(
-            model="gpt-4o-mini",
-            messages=[
-                {"role": "system", "content": """You are an expoert in TSQL. 
+        messages = [
+            {"role": "system", "content": """You are an expoert in TSQL. 
                  Your task is to translate the user's question into TSQL code that will run on SQLServer. 
                  Put aliases on table fields to avoid ambiguities, every filed in select clause must have an alias.
                  All the dates filed must be formatted as dd/mm/yyyy
                  Generate code for procedures execution declaring the variables for the procedures with the values passed in by the user and then
                  the call to the procedure.
                  Only respond with TSQL code, without any additional text, explanations, or comments."""},
-                {
-                    "role": "user",
-                    "content": f"""Database Schema:
+            {
+                "role": "user",
+                "content": f"""Database Schema:
 {schema}
 
 Question: {question}
 Translate the question above into TSQL code and provide only the TSQL statement. 
 Put aliases on table fields to avoid ambiguities."""
-                }
+            }
+        ]
+        if repair is not None:
+            # Correzione: la risposta precedente e gli errori trovati diventano parte della conversazione
+            messages += [
+                {"role": "assistant", "content": repair[0]},
+                {"role": "user", "content": repair_instructions(repair)},
             ]
-        )
+        content = await openai_backend.chat(messages)
 
-        sql_code = re.sub(r"^```sql\n|```$", "", completion.choices[0].message.content).strip()
-        return sql_code
+        return extract_sql(content)
 
     except Exception as e:
         logger.error(f"Errore nella richiesta API OpenAI: {e}")
@@ -102,20 +178,196 @@ DB_HOST = os.getenv("T2DB_DB_HOST")
 DB_PORT = os.getenv("T2DB_DB_PORT", "1433")
 DB_NAME = os.getenv("T2DB_DB_NAME")
 
-if not all([DB_USER, DB_PASS, DB_HOST, DB_NAME]):
-    logger.error("Errore: Assicurati che tutte le variabili di ambiente per la connessione al database siano impostate.")
-    sys.exit(1)
+def check_environment():
+    """Verifica le variabili di ambiente necessarie; termina il processo se mancano."""
+    if TENANTS:
+        # Con piu' database il nome viene da T2DB_TENANTS
+        required_env_vars = [] if TENANT_URL_TEMPLATE else ["T2DB_DB_USER", "T2DB_DB_PASS", "T2DB_DB_HOST", "T2DB_DB_PORT"]
+    else:
+        required_env_vars = [] if DB_URL else ["T2DB_DB_USER", "T2DB_DB_PASS", "T2DB_DB_HOST", "T2DB_DB_PORT", "T2DB_DB_NAME"]
+    missing_vars = [var for var in required_env_vars if os.getenv(var) is None]
+    if missing_vars:
+        logger.error(f"Errore: Le seguenti variabili di ambiente non sono impostate: {', '.join(missing_vars)}")
+        sys.exit(1)
+    if required_env_vars and not all(os.getenv(var) for var in required_env_vars):
+        logger.error("Errore: Assicurati che tutte le variabili di ambiente per la connessione al database siano impostate.")
+        sys.exit(1)
+    logger.info("Tutte le variabili di ambiente sono impostate correttamente.")
+    if not API_TOKEN:
+        logger.warning("T2DB_HF_API_TOKEN non impostata: il provider Hugging Face non e' utilizzabile.")
 
-connection_url = f"mssql+pyodbc://{DB_USER}:{DB_PASS}@{DB_HOST}/{DB_NAME}?driver=ODBC+Driver+17+for+SQL+Server&TrustServerCertificate=yes&Encrypt=no"
+def mssql_url(database):
+    return f"mssql+pyodbc://{DB_USER}:{DB_PASS}@{DB_HOST}/{database}?driver=ODBC+Driver+17+for+SQL+Server&TrustServerCertificate=yes&Encrypt=no"
+
+def tenant_urls(name):
+    """URL del database (e della replica, se configurata) da servire come tenant name."""
+    if not TENANTS:
+        # Qualunque URL SQLAlchemy, ad esempio sqlite:///bench.db per i benchmark offline
+        return DB_URL or mssql_url(DB_NAME), DB_REPLICA_URL
+    url = TENANT_URL_TEMPLATE.replace("{tenant}", name) if TENANT_URL_TEMPLATE else mssql_url(name)
+    replica_url = TENANT_REPLICA_URL_TEMPLATE.replace("{tenant}", name) if TENANT_REPLICA_URL_TEMPLATE else None
+    return url, replica_url
+
+def create_tenant(name):
+    """Motori, cache dello schema, validatore e controllo dei costi di un database.
+
+    I motori non aprono connessioni finche' non servono (o fino al riscaldamento).
+    """
+    url, replica_url = tenant_urls(name)
+    # Pool dimensionato sui thread del database (T2DB_DB_CONCURRENCY) se non indicato;
+    # le SELECT generate vanno sulla replica, se configurata
+    engines = DatabaseEngines(
+        url,
+        replica_url,
+        pool_size=int(os.getenv("T2DB_DB_POOL_SIZE", DB_CONCURRENCY)),
+        max_overflow=int(os.getenv("T2DB_DB_POOL_OVERFLOW", "10")),
+        pool_timeout=float(os.getenv("T2DB_DB_POOL_TIMEOUT", "30")),
+        pool_recycle=float(os.getenv("T2DB_DB_POOL_RECYCLE", "1800")),
+        pre_ping=os.getenv("T2DB_DB_POOL_PRE_PING", "1") == "1",
+    )
+    # Permette di interrompere sul database le query di richieste scadute o abbandonate
+    for routed_engine, _ in engines.all():
+        install_cancellation(routed_engine)
+    # Catalogo, sonde dello schema e piani stimati usano sempre il principale
+    engine = engines.primary
+
+    # Cache dello schema: ricostruito solo se il database cambia, allo scadere del TTL
+    # (T2DB_SCHEMA_TTL secondi, 0 = disattivato) o tramite /admin/schema/refresh
+    schema_catalog = SchemaCatalog(
+        engine,
+        functools.partial(get_db_schema_model, engine),
+        ttl=float(os.getenv("T2DB_SCHEMA_TTL", "0")),
+        probe_interval=float(os.getenv("T2DB_SCHEMA_PROBE_INTERVAL", "10")),
+        shared_cache=schema_cache,
+    )
+
+    # Validazione locale della SQL generata (richiede sqlglot): sintassi nel dialetto
+    # del database, tabelle, colonne e procedure dello schema in cache, tipi di
+    # istruzione ammessi ("*" = tutti); fino a T2DB_SQL_REPAIR_ATTEMPTS correzioni
+    sql_guard = SqlGuard(
+        SQLGLOT_DIALECTS.get(engine.dialect.name),
+        enabled=os.getenv("T2DB_SQL_VALIDATION", "1") == "1",
+        allowed_statements=[kind.strip().lower() for kind in os.getenv("T2DB_SQL_ALLOWED_STATEMENTS", "select,exec").split(",")],
+        repair_attempts=int(os.getenv("T2DB_SQL_REPAIR_ATTEMPTS", "2")),
+    )
+
+    # Controllo dei costi sul piano stimato prima dell'esecuzione:
+    # T2DB_COST_GATE=off|warn|reject, soglie a 0 = non controllate
+    cost_gate = CostGate(
+        engine,
+        mode=os.getenv("T2DB_COST_GATE", "off"),
+        max_rows=float(os.getenv("T2DB_COST_MAX_ROWS", "0")),
+        max_cost=float(os.getenv("T2DB_COST_MAX_COST", "0")),
+        max_scan_rows=float(os.getenv("T2DB_COST_MAX_SCAN_ROWS", "0")),
+        reject_cross_joins=os.getenv("T2DB_COST_REJECT_CROSS_JOINS", "1") == "1",
+    )
+
+    tenant = Tenant(name, engines, schema_catalog, sql_guard, cost_gate, connections=engines.max_connections())
+    schema_catalog.listeners.append(functools.partial(schema_changed, tenant))
+    logger.info(f"Motore del database {name} configurato" + (" con replica in sola lettura." if replica_url else "."))
+    return tenant
+
+def schema_changed(tenant, snapshot):
+    """Aggiorna le cache condivise quando lo schema di un database cambia versione."""
+    previous, tenant.schema_version = tenant.schema_version, snapshot.version
+    if previous == snapshot.version:
+        return
+    if question_cache is not None:
+        if not TENANTS:
+            # Le voci generate con uno schema precedente non servono piu'
+            question_cache.purge(keep_schema_version=snapshot.version)
+        elif previous is not None and previous not in tenants.schema_versions(exclude=tenant):
+            # Le voci sono per versione dello schema: database con lo stesso schema
+            # le condividono, quindi si eliminano solo se nessun altro la usa
+            question_cache.discard_schema_version(previous)
+    if result_cache is not None and previous is not None:
+        # Con lo schema cambiato i risultati memorizzati possono non essere piu' validi
+        result_cache.invalidate()
+
+def init_components():
+    """Crea registro dei database, cache e client LLM a partire dalle variabili di ambiente.
+
+    Il database di default viene configurato subito, gli altri alla prima richiesta.
+    """
+    global tenants, schema_cache, question_cache, result_cache, openai_backend, hf_backend, workload_log
+
+    # Cache condivisa tra i worker dello stesso host (T2DB_SHARED_CACHE=/var/tmp/talk2db_cache.db):
+    # schema, SQL generata e risultati in un file SQLite (WAL) invece che nella
+    # memoria di ogni processo, con gli stessi limiti di dimensione
+    shared_path = os.getenv("T2DB_SHARED_CACHE")
+    # Snapshot dello schema per database e versione: pochi, ma uno per tenant
+    schema_cache = SqliteCacheBackend(shared_path, "schema", max_entries=64) if shared_path else None
+
+    # Al massimo T2DB_MAX_TENANTS database attivi e T2DB_MAX_CONNECTIONS connessioni
+    # riservate (0 = nessun limite); quelli inutilizzati da T2DB_TENANT_IDLE_SECONDS
+    # vengono chiusi (di default solo con T2DB_TENANTS: con un solo database non
+    # si chiude mai). La memoria e' limitata dalle cache condivise piu' lo schema
+    # in cache dei database attivi
+    names = TENANTS or [os.getenv("T2DB_DEFAULT_TENANT") or DB_NAME or "default"]
+    default = os.getenv("T2DB_DEFAULT_TENANT") or names[0]
+    tenants = TenantRegistry(
+        create_tenant,
+        names,
+        default,
+        max_tenants=int(os.getenv("T2DB_MAX_TENANTS", "16")),
+        max_connections=int(os.getenv("T2DB_MAX_CONNECTIONS", "0")),
+        idle_seconds=float(os.getenv("T2DB_TENANT_IDLE_SECONDS", "600" if TENANTS else "0")),
+    )
+    try:
+        tenants.release(tenants.acquire(default))
+    except Exception as e:
+        logger.error(f"Errore nella connessione al database: {e}")
+        sys.exit(1)
+
+    # Client persistenti con pool di connessioni, condivisi tra le richieste
+    openai_backend = OpenAIBackend(
+        os.environ.get('T2DB_OAI_API_TOKEN') or os.environ.get('OPENAI_API_KEY'),
+        OPENAI_MODEL,
+        base_url=os.getenv("T2DB_OAI_BASE_URL", "https://api.openai.com/v1"),
+        concurrency=int(os.getenv("T2DB_OAI_CONCURRENCY", LLM_CONCURRENCY)),
+        **llm_options,
+    )
+    hf_backend = HuggingFaceBackend(
+        API_URL,
+        API_TOKEN,
+        concurrency=int(os.getenv("T2DB_HF_CONCURRENCY", LLM_CONCURRENCY)),
+        **llm_options,
+    )
+
+    # Cache domanda -> SQL generata (T2DB_QUESTION_CACHE_SIZE=0 la disattiva),
+    # per versione dello schema: vale per tutti i database con lo stesso schema
+    question_cache = None
+    if QUESTION_CACHE_SIZE > 0:
+        question_cache = QuestionCache(
+            max_entries=QUESTION_CACHE_SIZE,
+            db_path=os.getenv("T2DB_QUESTION_CACHE_DB"),
+            extract_literals=os.getenv("T2DB_QUESTION_CACHE_LITERALS", "0") == "1",
+            backend=SqliteCacheBackend(shared_path, "question", max_entries=QUESTION_CACHE_SIZE) if shared_path else None,
+        )
+
+    # Cache dei risultati delle SELECT per SQL normalizzata e database (T2DB_RESULT_CACHE_MB=0
+    # la disattiva); T2DB_RESULT_CACHE_TABLE_TTLS="ORDINI=5,CLIENTI=300" sovrascrive il TTL per tabella
+    result_cache = None
+    if RESULT_CACHE_MB > 0:
+        max_bytes = int(RESULT_CACHE_MB * 1024 * 1024)
+        result_cache = ResultCache(
+            max_bytes=max_bytes,
+            default_ttl=float(os.getenv("T2DB_RESULT_CACHE_TTL", "30")),
+            table_ttls=parse_table_ttls(os.getenv("T2DB_RESULT_CACHE_TABLE_TTLS")),
+            backend=SqliteCacheBackend(shared_path, "result", max_bytes=max_bytes) if shared_path else None,
+        )
+
+    # Registro del carico (T2DB_WORKLOAD_LOG=/var/log/talk2db/workload-{pid}.jsonl): una riga per
+    # richiesta con SQL generata e tempi, da rieseguire con replay_workload.py; ruota ogni
+    # T2DB_WORKLOAD_LOG_MB tenendo T2DB_WORKLOAD_LOG_BACKUPS file, T2DB_WORKLOAD_SAMPLE < 1 campiona
+    workload_path = os.getenv("T2DB_WORKLOAD_LOG")
+    workload_log = WorkloadLog(
+        workload_path,
+        max_bytes=int(float(os.getenv("T2DB_WORKLOAD_LOG_MB", "50")) * 1024 * 1024),
+        backups=int(os.getenv("T2DB_WORKLOAD_LOG_BACKUPS", "5")),
+        sample_rate=float(os.getenv("T2DB_WORKLOAD_SAMPLE", "1")),
+    ) if workload_path else None
 
-try:
-    logger.info("Connessione al database...")
-    engine = create_engine(connection_url)
-    logger.info("Connessione al database stabilita.")
-except Exception as e:
-    logger.error(f"Errore nella connessione al database: {e}")
-    sys.exit(1)
-    
 filtered_tables = [
     "__EFMigrationsHistory", "ANTENNE", "ANTENNE_LOG", "AspNetRoleClaims", "AspNetRoles", 
     "AspNetUserClaims", "AspNetUserLogins", "AspNetUserRoles", "AspNetUsers", "AspNetUserTokens", 
@@ -130,87 +382,192 @@ filtered_tables = [
     "TRANSP_POSIZIONI_LOG", "TRANSPONDER_WEIGHTS", "TRANSPONDERS", "VERSIONIPATCHDB"
 ]
 
-def get_db_procedures():
-    """Estrae tutte le stored procedures e i loro parametri, rimuovendo '@' dai parametri e includendo i loro tipi."""
-    try:
-        # Query per estrarre le stored procedures
-        query_procs = """
-            SELECT SPECIFIC_NAME 
-            FROM INFORMATION_SCHEMA.ROUTINES
-            WHERE ROUTINE_TYPE = 'PROCEDURE'
-        """
-        
-        # Esegui la query
-        with engine.connect() as connection:
-            result = connection.execute(text(query_procs))
-            stored_procs = result.fetchall()
-        
-        procedures_list = []
-        
-        # Per ogni stored procedure, recupera i parametri
-        for proc in stored_procs:
-            proc_name = proc[0]
-            
-            # Query per ottenere i parametri e i tipi della stored procedure
-            query_params = f"""
-                SELECT PARAMETER_NAME, DATA_TYPE
-                FROM INFORMATION_SCHEMA.PARAMETERS
-                WHERE SPECIFIC_NAME = '{proc_name}'
-            """
-            
-            # Esegui la query dei parametri e dei tipi
-            with engine.connect() as connection:
-                result_params = connection.execute(text(query_params))
-                parameters = result_params.fetchall()
-            
-            # Rimuovi '@' dai parametri e includi il tipo
-            param_list = [f"{param[0].replace('@', '')} {param[1]}" for param in parameters]
-            formatted_proc = f"{proc_name}({', '.join(param_list)})" if param_list else f"{proc_name}()"
-            procedures_list.append(formatted_proc)
-        
-        return procedures_list
+def get_db_schema_model(engine):
+    """Carica il modello dello schema (tabelle, colonne, chiavi e procedure) con query di catalogo massive."""
+    return load_schema_model(engine, excluded_tables=filtered_tables)
 
+def get_db_schema(engine):
+    """Recupera lo schema del database in formato compatto."""
+    try:
+        return format_schema(get_db_schema_model(engine))
     except Exception as e:
-        logger.error(f"Errore nell'estrazione delle stored procedures: {e}")
+        logger.error(f"Errore nel recupero dello schema del database: {e}")
         raise
 
+# Voci della cache domanda -> SQL generata (0 la disattiva)
+QUESTION_CACHE_SIZE = int(os.getenv("T2DB_QUESTION_CACHE_SIZE", "1000"))
+# Dimensione della cache dei risultati in MB (0, il default, la disattiva: ogni
+# richiesta legge dal database, come senza cache)
+RESULT_CACHE_MB = float(os.getenv("T2DB_RESULT_CACHE_MB", "0"))
 
+# Numero di tabelle e procedure pertinenti da includere nel prompt (0 = schema completo)
+SCHEMA_TOP_K = int(os.getenv("T2DB_SCHEMA_TOP_K", "15"))
+PROCEDURE_TOP_K = int(os.getenv("T2DB_PROCEDURE_TOP_K", "5"))
+# Budget di token per lo schema nel prompt (0 = nessun limite)
+SCHEMA_TOKEN_BUDGET = int(os.getenv("T2DB_SCHEMA_TOKEN_BUDGET", "3000"))
 
-def get_db_schema():
-    """Recupera lo schema del database in formato compatto."""
-    try:
-        inspector = inspect(engine)
-        schema_context = ""
+# Limiti di concorrenza per fase: le chiamate LLM sono asincrone (limitate per
+# provider nei backend), il lavoro sul database e la serializzazione girano in
+# pool di thread dedicati
+DB_CONCURRENCY = int(os.getenv("T2DB_DB_CONCURRENCY", "8"))
+SERIALIZE_CONCURRENCY = int(os.getenv("T2DB_SERIALIZE_CONCURRENCY", "4"))
 
-        table_names = inspector.get_table_names()
+db_limiter = anyio.CapacityLimiter(DB_CONCURRENCY)
+serialize_limiter = anyio.CapacityLimiter(SERIALIZE_CONCURRENCY)
 
-        for table_name in table_names:
-             if table_name not in filtered_tables:
-                columns = inspector.get_columns(table_name)
-                column_names = [column["name"] for column in columns]
-                schema_context += f"{table_name} ({', '.join(column_names)})\n"
-        
-        procedures_list = get_db_procedures()
+async def run_db(fn, *args):
+    """Esegue lavoro bloccante sul database senza fermare l'event loop."""
+    return await anyio.to_thread.run_sync(fn, *args, limiter=db_limiter)
 
-        schema_context += '\n'.join(procedures_list)
+# Tempo massimo di esecuzione delle query per richiesta (secondi, 0 = nessun limite)
+QUERY_TIMEOUT = float(os.getenv("T2DB_QUERY_TIMEOUT", "0"))
 
-        # print(schema_context)
-        return schema_context
-    except Exception as e:
-        logger.error(f"Errore nel recupero dello schema del database: {e}")
+async def run_until_disconnect(http_request, coroutine):
+    """Esegue la coroutine della richiesta annullandola (chiamata LLM e query
+    comprese) se il client si disconnette prima della risposta."""
+    async def wait_disconnect():
+        while (await http_request.receive())["type"] != "http.disconnect":
+            pass
+
+    task = asyncio.ensure_future(coroutine)
+    watcher = asyncio.ensure_future(wait_disconnect())
+    try:
+        await asyncio.wait({task, watcher}, return_when=asyncio.FIRST_COMPLETED)
+    finally:
+        watcher.cancel()
+        if not task.done():
+            task.cancel()
+    if not task.cancelled() and task.done():
+        return task.result()
+    try:
+        # Attende che l'annullamento arrivi al database e al provider LLM
+        await task
+    except asyncio.CancelledError:
+        pass
+    logger.info("Client disconnesso: richiesta annullata.")
+    # 499 (client closed request): nessuno leggera' la risposta
+    return Response(status_code=499)
+
+def capture_workload(tenant, endpoint, question, status, error=None, **fields):
+    """Aggiunge la richiesta al registro del carico, se attivo, con i tempi per fase della richiesta."""
+    if workload_log is None:
+        return
+    if isinstance(error, dict):
+        error = error.get("error")
+    workload_log.capture(
+        current_timings.get(), question=question, endpoint=endpoint, database=tenant.name,
+        schema_version=tenant.schema_version, status=status, error=str(error)[:500] if error else None, **fields,
+    )
+
+async def run_captured(http_request, tenant, endpoint, question, answer):
+    """run_until_disconnect(answer(record)) registrando l'esito nel registro del carico.
+
+    answer riempie record (sql, page, rows, bytes) man mano che li conosce, cosi'
+    anche le richieste fallite o annullate compaiono con la SQL generata.
+    """
+    record = {}
+    status, error = 500, None
+    try:
+        response = await run_until_disconnect(http_request, answer(record))
+        status = getattr(response, "status_code", 200)
+        return response
+    except HTTPException as e:
+        status, error = e.status_code, e.detail
         raise
+    finally:
+        capture_workload(tenant, endpoint, question, status, error, **record)
+
+# Accorpamento delle richieste identiche in corso (T2DB_COALESCE=0 lo disattiva):
+# stessa domanda normalizzata -> una sola pipeline (schema, LLM, query),
+# stessa SQL normalizzata e pagina -> una sola esecuzione sul database
+COALESCE = os.getenv("T2DB_COALESCE", "1") == "1"
+question_flight = SingleFlight("question", enabled=COALESCE)
+sql_flight = SingleFlight("sql", enabled=COALESCE)
+
+async def run_serialize(fn, *args):
+    """Esegue la conversione dei risultati (CPU) senza fermare l'event loop."""
+    return await anyio.to_thread.run_sync(fn, *args, limiter=serialize_limiter)
+
+# Righe lette dal cursore per ogni lotto dell'endpoint in streaming
+STREAM_BATCH_SIZE = int(os.getenv("T2DB_STREAM_BATCH_SIZE", "500"))
+
+# Righe massime restituite da /question per pagina; le successive si leggono
+# con il token di continuazione su /question/page
+MAX_ROWS = int(os.getenv("T2DB_MAX_ROWS", "1000"))
+# Chiave HMAC dei token di continuazione; se manca ne viene generata una a ogni avvio
+PAGE_TOKEN_SECRET = (os.getenv("T2DB_PAGE_TOKEN_SECRET") or secrets.token_hex(32)).encode("utf-8")
+
+ADMIN_TOKEN = os.getenv("T2DB_ADMIN_TOKEN")
+
+def check_admin_token(token):
+    """Verifica il token degli endpoint amministrativi: senza T2DB_ADMIN_TOKEN sono disattivati."""
+    if not ADMIN_TOKEN:
+        raise HTTPException(status_code=404, detail="Endpoint amministrativi disattivati (T2DB_ADMIN_TOKEN non impostata)")
+    if token is None or not secrets.compare_digest(token.encode("utf-8"), ADMIN_TOKEN.encode("utf-8")):
+        raise HTTPException(status_code=403, detail="Token amministrativo non valido")
+
+def select_schema_context(snapshot, question):
+    """Riduce lo schema alle tabelle (con le vicine via FK) e procedure pertinenti alla domanda
+    e lo serializza entro il budget di token."""
+    model = snapshot.model
+    if SCHEMA_TOP_K > 0:
+        model = snapshot.index.search(question, table_k=SCHEMA_TOP_K, procedure_k=PROCEDURE_TOP_K)
+    serialized = serialize_schema(model, token_budget=SCHEMA_TOKEN_BUDGET)
+    logger.info(
+        f"Schema nel prompt: {len(model.tables) - serialized.dropped_tables} tabelle, "
+        f"{len(model.procedures) - serialized.dropped_procedures} procedure, {serialized.tokens} token."
+    )
+    return serialized.text
+
+def llm_provider_key(use_openai):
+    """Identifica provider e modello, parte della chiave della cache delle domande."""
+    return f"openai:{OPENAI_MODEL}" if use_openai else f"huggingface:{API_URL}"
+
+async def cached_question_to_sql(tenant, question, snapshot, use_openai):
+    """Come question_to_sql, ma riusa la SQL gia' generata per la stessa domanda e versione dello schema."""
+    provider = llm_provider_key(use_openai)
+    if question_cache is not None:
+        with stage("question_cache"):
+            sql_query = await anyio.to_thread.run_sync(question_cache.get, question, snapshot.version, provider)
+        if sql_query is not None:
+            # Anche la SQL in cache (o riempita da un modello) passa dalla validazione locale
+            errors = await anyio.to_thread.run_sync(tenant.sql_guard.check, snapshot, sql_query)
+            if not errors:
+                logger.info("SQL generata presa dalla cache delle domande.")
+                return sql_query
+            logger.warning(f"SQL dalla cache delle domande non valida, eliminata e rigenerata: {'; '.join(errors)}")
+            await anyio.to_thread.run_sync(question_cache.discard, question, snapshot.version, provider)
 
-def question_to_sql(question, schema_context, use_openai):
-    """Genera una query SQL a partire dalla domanda e dal contesto dello schema."""
+    # Ricerca nell'indice e serializzazione sono CPU: fuori dall'event loop
+    with stage("prompt_build"):
+        schema_context = await anyio.to_thread.run_sync(select_schema_context, snapshot, question)
+
+    async def generate(repair):
+        with stage("llm"):
+            return await question_to_sql(question, schema_context, use_openai, repair)
+
+    # Validata sullo schema in cache ed eventualmente corretta dal modello prima di toccare il database
+    return await tenant.sql_guard.generate(snapshot, generate)
+
+def remember_sql(question, snapshot, use_openai, sql_query):
+    """Memorizza la SQL generata, da chiamare solo dopo un'esecuzione riuscita."""
+    if question_cache is not None:
+        question_cache.put(question, snapshot.version, llm_provider_key(use_openai), sql_query)
+
+async def question_to_sql(question, schema_context, use_openai, repair=None):
+    """Genera una query SQL a partire dalla domanda e dal contesto dello schema.
+
+    repair, se indicato, e' la coppia (SQL precedente, errori) da correggere.
+    """
     try:
         logger.info(f"Generazione della query SQL per la domanda: '{question}' con schema fornito.")
-        prompt = create_sql_prompt(question, schema_context)
+        prompt = create_sql_prompt(question, schema_context, repair)
         
         sql_query = ""
         if use_openai:
-            sql_query = query_openai_api(question, schema_context)
+            sql_query = await query_openai_api(question, schema_context, repair)
         else:
-            sql_query = query_huggingface_api(prompt)
+            sql_query = extract_sql(await query_huggingface_api(prompt))
 
 
         return sql_query
@@ -218,12 +575,13 @@ def question_to_sql(question, schema_context, use_openai):
         logger.error(f"Errore nella generazione della query SQL: {e}")
         raise
 
-def execute_query(query):
-    """Esegue la query SQL e restituisce i risultati come DataFrame."""
+def execute_query(tenant, query):
+    """Esegue la query SQL sul database del tenant e restituisce i risultati come DataFrame."""
     try:
-        with engine.connect() as connection:
+        with tenant.engines.for_sql(query).connect() as connection:
             logger.info(f"Esecuzione della query: {query}")
             result = connection.execute(text(query))
+            import pandas as pd  # import differito: pandas rallenta l'avvio
             df = pd.DataFrame(result.fetchall(), columns=result.keys())
             logger.info("Query eseguita con successo.")
             return df
@@ -232,6 +590,163 @@ def execute_query(query):
         raise
 
 
+def page_size_for(requested):
+    """Dimensione della pagina richiesta, entro il limite T2DB_MAX_ROWS."""
+    if not requested or requested <= 0:
+        return MAX_ROWS
+    return min(requested, MAX_ROWS)
+
+
+def execute_page(tenant, page):
+    """Esegue una pagina della query e restituisce il PageResult con il token della pagina successiva."""
+    try:
+        # Solleva QueryRejected se il piano stimato supera le soglie
+        with stage("cost_gate"):
+            cost_warnings = tenant.cost_gate.check(page.sql)
+        # La stessa SQL con una pagina o un database diversi e' una voce diversa della cache
+        variant = json.dumps({key: value for key, value in page.to_dict().items() if key != "sql"}, sort_keys=True)
+        with stage("result_cache"):
+            result = result_cache.get(page.sql, variant) if result_cache is not None else None
+        if result is not None:
+            logger.info("Pagina presa dalla cache dei risultati.")
+        else:
+            result = fetch_page(tenant.engines.for_sql(page.sql), page)
+            if result_cache is not None:
+                result_cache.put(page.sql, result, variant)
+        # La voce della cache in memoria e' lo stesso oggetto: token e avvisi vanno su una copia
+        result = copy.copy(result)
+        result.next_page_token = (
+            encode_page_token(result.next_page, PAGE_TOKEN_SECRET) if result.next_page is not None else None
+        )
+        result.cost_warnings = cost_warnings
+        logger.info(f"Pagina eseguita con successo: {len(result.rows)} righe.")
+        return result
+    except Exception as e:
+        logger.error(f"Errore durante l'esecuzione della query: {e}")
+        raise
+
+
+async def run_page(tenant, page):
+    """Esegue la pagina entro T2DB_QUERY_TIMEOUT, condividendo l'esecuzione con
+    le richieste concorrenti per la stessa SQL normalizzata e la stessa pagina.
+
+    Allo scadere, o se tutte le richieste in attesa vengono annullate,
+    l'istruzione in corso viene interrotta sul database."""
+    key = json.dumps({**page.to_dict(), "sql": normalize_sql(page.sql)}, sort_keys=True, default=str)
+    with anyio.fail_after(QUERY_TIMEOUT or None):
+        return await sql_flight.do(key, functools.partial(run_cancellable, execute_page, tenant, page, limiter=db_limiter))
+
+
+async def generate_sql(tenant, question, use_openai):
+    """Schema corrente del database e SQL generata (o presa dalla cache) per la domanda."""
+    with stage("schema_load"):
+        snapshot = await run_db(tenant.schema_catalog.get)
+    sql_query = await cached_question_to_sql(tenant, question, snapshot, use_openai)
+    return snapshot, sql_query
+
+
+async def question_pipeline(tenant, question, page_size, use_openai):
+    """Domanda -> (SQL, prima pagina dei risultati), memorizzando la SQL se l'esecuzione riesce."""
+    snapshot, sql_query = await generate_sql(tenant, question, use_openai)
+    logger.info(f"Query generata: {sql_query}")
+    # Al massimo una pagina: le altre con il token di continuazione, che ricorda il database
+    result = await run_page(tenant, PageRequest(sql_query, page_size_for(page_size), database=tenant.name))
+    await anyio.to_thread.run_sync(remember_sql, question, snapshot, use_openai, sql_query)
+    return sql_query, result
+
+
+def question_key(tenant, question, use_openai, *extra):
+    """Chiave di accorpamento: database, domanda normalizzata, provider ed eventuali parametri."""
+    return (tenant.name, normalize_question(question)[0], llm_provider_key(use_openai)) + extra
+
+
+async def acquire_tenant(name):
+    """Tenant del database richiesto, segnato in uso fino a tenants.release().
+
+    404 se il database non e' configurato, 503 se i limiti di database attivi o
+    di connessioni sono raggiunti e nessun database inattivo puo' essere chiuso.
+    """
+    try:
+        return await anyio.to_thread.run_sync(tenants.acquire, name)
+    except UnknownTenant as e:
+        raise HTTPException(status_code=404, detail=str(e))
+    except TenantLimitExceeded as e:
+        raise HTTPException(status_code=503, detail=str(e))
+
+
+@asynccontextmanager
+async def use_tenant(name):
+    tenant = await acquire_tenant(name)
+    try:
+        yield tenant
+    finally:
+        tenants.release(tenant)
+
+
+def unique_column_names(columns):
+    """Rende uniche le colonne duplicate aggiungendo la loro posizione."""
+    columns = list(columns)
+    return [f"{col}_{i}" if columns.count(col) > 1 else col for i, col in enumerate(columns)]
+
+
+def dataframe_to_json(results_df):
+    """Converte i risultati in JSON (lista di record), con colonne duplicate rese uniche."""
+    results_df = results_df.fillna("")
+    results_df.columns = unique_column_names(results_df.columns)
+    return results_df.to_json(orient='records')
+
+
+def page_to_json(result):
+    """Righe della pagina -> JSON (lista di record), come dataframe_to_json."""
+    import pandas as pd  # import differito: pandas rallenta l'avvio
+    with stage("serialize"):
+        return dataframe_to_json(pd.DataFrame(result.rows, columns=result.columns))
+
+
+def response_format(accept):
+    """Formato binario richiesto dal client (Arrow/Parquet) o None per il JSON; 406 se non disponibile."""
+    try:
+        return negotiate_format(accept)
+    except UnsupportedFormatError as e:
+        raise HTTPException(status_code=406, detail=str(e))
+
+
+def page_response(fmt, sql_query, result):
+    """Pagina in Arrow IPC o Parquet: SQL nei metadati dello schema, token e troncamento negli header."""
+    with stage("serialize"):
+        content = encode_rows(
+            fmt, unique_column_names(result.columns), result.description, result.rows, {"sql_query": sql_query}
+        )
+    headers = {"X-T2DB-Truncated": "true" if result.truncated else "false"}
+    if result.next_page_token:
+        headers["X-T2DB-Next-Page-Token"] = result.next_page_token
+    if result.cost_warnings:
+        headers["X-T2DB-Cost-Warnings"] = "; ".join(result.cost_warnings)
+    return Response(content, media_type=FORMAT_MEDIA_TYPES[fmt], headers=headers)
+
+
+def rejected_query_error(error):
+    """Risposta 422 con i motivi e la stima del piano per una query bloccata dal controllo dei costi."""
+    return HTTPException(
+        status_code=422,
+        detail={"error": str(error), "reasons": error.reasons, **error.estimate.to_dict()},
+    )
+
+
+def invalid_sql_error(error):
+    """Risposta 422 con gli errori della validazione locale e l'ultima SQL generata."""
+    return HTTPException(
+        status_code=422,
+        detail={"error": str(error), "errors": error.errors, "sql_query": error.sql},
+    )
+
+
+def rows_to_ndjson(rows):
+    """Una riga JSON (array di valori) per ogni record; date e decimali come stringhe."""
+    with stage("serialize"):
+        return "".join(json.dumps(list(row), default=str) + "\n" for row in rows)
+
+
 def save_dataframe_to_file(df, filename="output.csv"):
     """Salva il DataFrame in un file CSV."""
     try:
@@ -242,45 +757,528 @@ def save_dataframe_to_file(df, filename="output.csv"):
         raise
 
 
-@app.post("/question")
-async def process_question(request: QuestionRequest):
-    """Elaborazione della domanda dell'utente e restituzione dei risultati."""
-    try:
-        question = request.question
-        schema_context = get_db_schema()
-        
-        # Eseguiamo la generazione della query SQL
-        use_openai = True  # Puoi passare True se vuoi usare OpenAI
-        sql_query = question_to_sql(question, schema_context, use_openai)
+def query_timeout_error():
+    return HTTPException(status_code=504, detail=f"Esecuzione della query interrotta dopo {QUERY_TIMEOUT:g} s")
+
 
-        print(f"query generata: {sql_query}")
+@router.post("/question")
+async def process_question(request: QuestionRequest, http_request: Request, accept: Optional[str] = Header(None)):
+    """Elaborazione della domanda dell'utente e restituzione dei risultati.
 
-        # Eseguiamo la query e otteniamo i risultati
-        results_df = execute_query(sql_query)
+    Con Accept: application/vnd.apache.arrow.stream o application/vnd.apache.parquet
+    i risultati arrivano in formato colonnare invece che in JSON.
+    """
+    fmt = response_format(accept)
+    async with use_tenant(request.database) as tenant:
+        return await run_captured(http_request, tenant, "question", request.question,
+                                  functools.partial(answer_question, tenant, request, fmt))
 
-        results_df = results_df.fillna("")
-        # Rendi uniche le colonne duplicate
-        results_df.columns = [f"{col}_{i}" if results_df.columns.tolist().count(col) > 1 else col for i, col in enumerate(results_df.columns)]
+async def answer_question(tenant, request, fmt, record):
+    try:
+        question = request.question
+        use_openai = True  # Puoi passare True se vuoi usare OpenAI
 
+        # Generazione della SQL ed esecuzione, condivise con le richieste
+        # identiche gia' in corso
+        sql_query, result = await question_flight.do(
+            question_key(tenant, question, use_openai, "page", page_size_for(request.page_size)),
+            question_pipeline, tenant, question, request.page_size, use_openai,
+        )
+        record.update(sql=sql_query, page={"page_size": page_size_for(request.page_size)}, rows=len(result.rows))
 
         # save_dataframe_to_file(results_df)
         # return 
 
+        if fmt is not None:
+            response = await run_serialize(page_response, fmt, sql_query, result)
+            record["bytes"] = len(response.body)
+            record_first_answer()
+            return response
+
         # Converte i risultati in una lista di dizionari
-        json_result = results_df.to_json(orient='records') 
+        json_result = await run_serialize(page_to_json, result)
+        record["bytes"] = len(json_result)
 
-      
 
         # Ritorniamo i risultati in formato JSON
-        response = {"sql_query": sql_query, "results": json_result}
+        response = {
+            "sql_query": sql_query,
+            "results": json_result,
+            "next_page_token": result.next_page_token,
+            "truncated": result.truncated,
+            "cost_warnings": result.cost_warnings,
+        }
+        record_first_answer()
 
-        print(response)
         return response
     
+    except QueryRejected as e:
+        record.setdefault("sql", e.sql)
+        raise rejected_query_error(e)
+    except SqlValidationError as e:
+        record.setdefault("sql", e.sql)
+        raise invalid_sql_error(e)
+    except TimeoutError:
+        raise query_timeout_error()
     except Exception as e:
         logger.error(f"Errore durante il processo della domanda '{request.question}': {e}")
         raise HTTPException(status_code=500, detail=f"Errore: {str(e)}")
 
+@router.post("/question/page")
+async def process_question_page(request: PageTokenRequest, http_request: Request,
+                                accept: Optional[str] = Header(None)):
+    """Pagina successiva dei risultati di una domanda, senza rigenerare la SQL."""
+    fmt = response_format(accept)
+    try:
+        page = decode_page_token(request.page_token, PAGE_TOKEN_SECRET)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=f"Token di pagina non valido: {e}")
+    async with use_tenant(page.database) as tenant:
+        return await run_captured(http_request, tenant, "page", None, functools.partial(answer_page, tenant, page, fmt))
+
+async def answer_page(tenant, page, fmt, record):
+    # Posizione della pagina senza SQL e database, gia' nel record
+    record.update(sql=page.sql, page={key: value for key, value in page.to_dict().items()
+                                      if key not in ("sql", "database")})
+    try:
+        result = await run_page(tenant, page)
+        record["rows"] = len(result.rows)
+        if fmt is not None:
+            response = await run_serialize(page_response, fmt, page.sql, result)
+            record["bytes"] = len(response.body)
+            return response
+        json_result = await run_serialize(page_to_json, result)
+        record["bytes"] = len(json_result)
+        return {
+            "sql_query": page.sql,
+            "results": json_result,
+            "next_page_token": result.next_page_token,
+            "truncated": result.truncated,
+            "cost_warnings": result.cost_warnings,
+        }
+    except QueryRejected as e:
+        raise rejected_query_error(e)
+    except TimeoutError:
+        raise query_timeout_error()
+    except Exception as e:
+        logger.error(f"Errore durante la lettura della pagina: {e}")
+        raise HTTPException(status_code=500, detail=f"Errore: {str(e)}")
+
+@router.post("/question/stream")
+async def process_question_stream(request: QuestionRequest, http_request: Request,
+                                  accept: Optional[str] = Header(None)):
+    """Come /question, ma invia i risultati in NDJSON man mano che arrivano dal database.
+
+    Prima riga: {"sql_query": ..., "columns": [...], "cost_warnings": [...]}; poi un array JSON per
+    ogni record; ultima riga: {"row_count": n} oppure {"error": ...} se la
+    lettura si interrompe a meta'.
+
+    Con Accept Arrow o Parquet ogni lotto del cursore diventa un record batch
+    (o un row group) dello stesso flusso binario; un errore a meta' lettura
+    interrompe la risposta, che risulta incompleta.
+
+    T2DB_QUERY_TIMEOUT limita l'attesa della prima riga; se il client si
+    disconnette durante la lettura la query viene interrotta sul database.
+
+    Il database resta in uso fino all'apertura del cursore: se viene chiuso
+    come inattivo durante la lettura, la connessione gia' in uso termina
+    normalmente.
+    """
+    fmt = response_format(accept)
+    question = request.question
+    use_openai = True
+
+    async def start_stream(tenant):
+        # Solo la generazione e' condivisa: ogni richiesta legge il proprio cursore
+        snapshot, sql_query = await question_flight.do(
+            question_key(tenant, question, use_openai, "sql"), generate_sql, tenant, question, use_openai
+        )
+        logger.info(f"Query generata: {sql_query}")
+
+        cost_warnings = await run_db(tenant.cost_gate.check, sql_query)
+        stream = QueryStream(tenant.engines.for_sql(sql_query), sql_query, batch_size=STREAM_BATCH_SIZE,
+                             limiter=db_limiter)
+        with anyio.fail_after(QUERY_TIMEOUT or None):
+            columns = await stream.start()
+        return snapshot, sql_query, cost_warnings, stream, columns
+
+    async with use_tenant(request.database) as tenant:
+        def capture(status, error=None, **fields):
+            capture_workload(tenant, "stream", question, status, error, **fields)
+
+        try:
+            started = await run_until_disconnect(http_request, start_stream(tenant))
+            if isinstance(started, Response):
+                capture(started.status_code)
+                return started
+            snapshot, sql_query, cost_warnings, stream, columns = started
+        except QueryRejected as e:
+            capture(422, e, sql=e.sql)
+            raise rejected_query_error(e)
+        except SqlValidationError as e:
+            capture(422, e, sql=e.sql)
+            raise invalid_sql_error(e)
+        except TimeoutError:
+            error = query_timeout_error()
+            capture(error.status_code, error.detail)
+            raise error
+        except Exception as e:
+            logger.error(f"Errore durante il processo della domanda '{request.question}': {e}")
+            capture(500, e)
+            raise HTTPException(status_code=500, detail=f"Errore: {str(e)}")
+
+
+    async def arrow_chunks():
+        encoder = ArrowEncoder(fmt, unique_column_names(columns), stream.description, {"sql_query": sql_query})
+        sent = 0
+        try:
+            async for batch in stream.batches():
+                with stage("serialize"):
+                    chunk = await run_serialize(encoder.encode, batch)
+                if chunk:
+                    sent += len(chunk)
+                    yield chunk
+        except Exception as e:
+            logger.error(f"Errore durante lo streaming dei risultati: {e}")
+            capture(500, e, sql=sql_query, rows=stream.row_count, bytes=sent)
+            raise
+        chunk = await run_serialize(encoder.finish)
+        capture(200, sql=sql_query, rows=stream.row_count, bytes=sent + len(chunk))
+        yield chunk
+        await anyio.to_thread.run_sync(remember_sql, question, snapshot, use_openai, sql_query)
+
+    if fmt is not None:
+        headers = {"X-T2DB-Cost-Warnings": "; ".join(cost_warnings)} if cost_warnings else None
+        return StreamingResponse(arrow_chunks(), media_type=FORMAT_MEDIA_TYPES[fmt], headers=headers)
+
+    async def ndjson_lines():
+        line = json.dumps(
+            {"sql_query": sql_query, "columns": unique_column_names(columns), "cost_warnings": cost_warnings}
+        ) + "\n"
+        sent = len(line)
+        yield line
+        try:
+            async for batch in stream.batches():
+                lines = await run_serialize(rows_to_ndjson, batch)
+                sent += len(lines)
+                yield lines
+        except Exception as e:
+            logger.error(f"Errore durante lo streaming dei risultati: {e}")
+            capture(500, e, sql=sql_query, rows=stream.row_count, bytes=sent)
+            yield json.dumps({"error": str(e)}) + "\n"
+            return
+        capture(200, sql=sql_query, rows=stream.row_count, bytes=sent)
+        await anyio.to_thread.run_sync(remember_sql, question, snapshot, use_openai, sql_query)
+        yield json.dumps({"row_count": stream.row_count}) + "\n"
+
+    return StreamingResponse(ndjson_lines(), media_type="application/x-ndjson")
+
+async def close_llm_backends():
+    """Chiude i pool di connessioni verso i provider LLM."""
+    await openai_backend.aclose()
+    await hf_backend.aclose()
+
+def component_metrics():
+    """Contatori gia' mantenuti da cache e backend, esposti su /metrics a ogni lettura."""
+    live = tenants.live()
+    families = [
+        ("t2db_schema_rebuilds_total", "Ricostruzioni dello schema.", "counter",
+         [({"database": tenant.name}, tenant.schema_catalog.rebuilds) for tenant in live]),
+        ("t2db_schema_shared_loads_total", "Schemi presi dalla cache condivisa tra i worker.", "counter",
+         [({"database": tenant.name}, tenant.schema_catalog.shared_loads) for tenant in live]),
+        ("t2db_llm_requests_total", "Richieste HTTP ai provider LLM, tentativi compresi.", "counter",
+         [({"provider": backend.name}, backend.requests) for backend in (openai_backend, hf_backend)]),
+        ("t2db_llm_retries_total", "Tentativi ripetuti verso i provider LLM.", "counter",
+         [({"provider": backend.name}, backend.retries) for backend in (openai_backend, hf_backend)]),
+        ("t2db_cost_gate_rejected_total", "Query bloccate dal controllo dei costi.", "counter",
+         [({"database": tenant.name}, tenant.cost_gate.rejected) for tenant in live]),
+        ("t2db_sql_validation_total", "SQL generate validate localmente, per esito.", "counter",
+         [({"database": tenant.name, "result": result}, count) for tenant in live
+          for result, count in (("invalid", tenant.sql_guard.invalid),
+                                ("valid", tenant.sql_guard.checks - tenant.sql_guard.invalid))]),
+        ("t2db_sql_repairs_total", "Richieste di correzione della SQL inviate al modello.", "counter",
+         [({"database": tenant.name}, tenant.sql_guard.repairs) for tenant in live]),
+        ("t2db_sql_validation_rejected_total", "Domande respinte dopo l'esaurimento delle correzioni.", "counter",
+         [({"database": tenant.name}, tenant.sql_guard.rejected) for tenant in live]),
+    ]
+    for name, cache in (("question", question_cache), ("result", result_cache)):
+        if cache is not None:
+            families.append((f"t2db_{name}_cache_lookups_total", "Ricerche in cache per esito.", "counter",
+                             [({"result": "hit"}, cache.hits), ({"result": "miss"}, cache.misses)]))
+    flights = (question_flight, sql_flight)
+    families += [
+        ("t2db_coalesced_requests_total", "Richieste che hanno avviato (leader) o atteso (follower) un'esecuzione condivisa.",
+         "counter", [({"scope": flight.name, "role": role}, getattr(flight, role + "s"))
+                     for flight in flights for role in ("leader", "follower")]),
+        ("t2db_coalesced_waiting", "Richieste in attesa di un'esecuzione condivisa in corso.", "gauge",
+         [({"scope": flight.name}, flight.waiting()) for flight in flights]),
+        ("t2db_coalescing_saved_seconds_total", "Tempo di esecuzione risparmiato dai follower.", "counter",
+         [({"scope": flight.name}, flight.saved_seconds) for flight in flights]),
+    ]
+    # Pool di ogni database attivo (principale ed eventuale replica)
+    pools = [({"database": tenant.name, "pool": stats["pool"]}, stats, monitor)
+             for tenant in live
+             for stats, (_, monitor) in zip(tenant.engines.stats()["pools"], tenant.engines.all())]
+    families += [
+        ("t2db_db_pool_connections", "Connessioni del pool per stato.", "gauge",
+         [({**labels, "state": state}, stats.get(state)) for labels, stats, _ in pools
+          for state in ("size", "checked_out", "idle", "overflow")]),
+        ("t2db_db_pool_wait_seconds_total", "Tempo di attesa per ottenere una connessione dal pool.", "counter",
+         [(labels, monitor.wait_seconds) for labels, _, monitor in pools]),
+        ("t2db_db_pool_checkouts_total", "Richieste di una connessione al pool, scadute comprese.", "counter",
+         [(labels, stats["checkouts"]) for labels, stats, _ in pools]),
+        ("t2db_db_pool_timeouts_total", "Attese di una connessione scadute (T2DB_DB_POOL_TIMEOUT).", "counter",
+         [(labels, stats["timeouts"]) for labels, stats, _ in pools]),
+        ("t2db_db_pool_invalidated_total", "Connessioni scartate (ping fallito o disconnessione).", "counter",
+         [(labels, stats["invalidated"]) for labels, stats, _ in pools]),
+        ("t2db_db_routed_queries_total", "SQL generate eseguite per destinazione.", "counter",
+         [({"database": tenant.name, "target": target}, count)
+          for tenant in live for target, count in tenant.engines.routed.items()]),
+    ]
+    registry = tenants.stats()
+    families += [
+        ("t2db_tenants_live", "Database attivi (motori e schema in memoria).", "gauge", [({}, registry["live"])]),
+        ("t2db_tenants_reserved_connections", "Connessioni riservate dai pool dei database attivi.", "gauge",
+         [({}, registry["reserved_connections"])]),
+        ("t2db_tenants_total", "Database attivati, chiusi e richieste respinte per limiti raggiunti.", "counter",
+         [({"event": event}, registry[event]) for event in ("created", "evicted", "rejected")]),
+    ]
+    if result_cache is not None:
+        families.append(("t2db_result_cache_bytes", "Byte stimati occupati dalla cache dei risultati.", "gauge",
+                         [({}, result_cache.bytes)]))
+    if workload_log is not None:
+        families.append(("t2db_workload_records_total", "Richieste scritte nel registro del carico.", "counter",
+                         [({}, workload_log.records)]))
+    families.append(("t2db_startup_seconds", "Tempi di avvio dall'inizio dell'import del modulo, per fase.", "gauge",
+                     [({"phase": phase}, seconds) for phase, seconds in STARTUP_SECONDS.items()]))
+    return families
+
+@router.get("/metrics")
+async def metrics():
+    """Metriche in formato Prometheus: istogrammi per fase e per endpoint, contatori di richieste e token."""
+    return PlainTextResponse(REGISTRY.render(), media_type="text/plain; version=0.0.4")
+
+@router.get("/admin/schema/stats")
+async def schema_stats(database: Optional[str] = None, x_admin_token: str = Header(None)):
+    """Statistiche della cache dello schema (hit/miss, tempi di ricostruzione)."""
+    check_admin_token(x_admin_token)
+    async with use_tenant(database) as tenant:
+        return tenant.schema_catalog.stats()
+
+@router.post("/admin/schema/refresh")
+async def schema_refresh(database: Optional[str] = None, x_admin_token: str = Header(None)):
+    """Forza la ricostruzione dello schema."""
+    check_admin_token(x_admin_token)
+    async with use_tenant(database) as tenant:
+        try:
+            snapshot = await run_db(tenant.schema_catalog.refresh)
+            return {"version": snapshot.version, "build_ms": round(snapshot.build_ms, 1)}
+        except Exception as e:
+            logger.error(f"Errore durante il refresh dello schema: {e}")
+            raise HTTPException(status_code=500, detail=f"Errore: {str(e)}")
+
+@router.get("/admin/llm/stats")
+async def llm_stats(x_admin_token: str = Header(None)):
+    """Richieste, tentativi ripetuti ed errori per provider LLM."""
+    check_admin_token(x_admin_token)
+    return {"openai": openai_backend.stats(), "huggingface": hf_backend.stats()}
+
+@router.get("/admin/question-cache/stats")
+async def question_cache_stats(x_admin_token: str = Header(None)):
+    """Statistiche della cache domanda -> SQL."""
+    check_admin_token(x_admin_token)
+    if question_cache is None:
+        return {"enabled": False}
+    return question_cache.stats()
+
+@router.post("/admin/question-cache/purge")
+async def question_cache_purge(x_admin_token: str = Header(None)):
+    """Svuota la cache domanda -> SQL."""
+    check_admin_token(x_admin_token)
+    if question_cache is None:
+        return {"removed": 0}
+    return {"removed": await anyio.to_thread.run_sync(question_cache.purge)}
+
+@router.get("/admin/cost-gate/stats")
+async def cost_gate_stats(database: Optional[str] = None, x_admin_token: str = Header(None)):
+    """Query controllate, avvisi e blocchi del controllo dei costi."""
+    check_admin_token(x_admin_token)
+    async with use_tenant(database) as tenant:
+        return tenant.cost_gate.stats()
+
+@router.get("/admin/result-cache/stats")
+async def result_cache_stats(x_admin_token: str = Header(None)):
+    """Statistiche della cache dei risultati (hit ratio, byte occupati)."""
+    check_admin_token(x_admin_token)
+    if result_cache is None:
+        return {"enabled": False}
+    return result_cache.stats()
+
+@router.post("/admin/result-cache/invalidate")
+async def result_cache_invalidate(request: InvalidateRequest, x_admin_token: str = Header(None)):
+    """Invalida i risultati che citano le tabelle indicate (tutti se non indicate)."""
+    check_admin_token(x_admin_token)
+    if result_cache is None:
+        return {"removed": 0}
+    return {"removed": await anyio.to_thread.run_sync(result_cache.invalidate, request.tables)}
+
+@router.get("/admin/sql-validation/stats")
+async def sql_validation_stats(database: Optional[str] = None, x_admin_token: str = Header(None)):
+    """Statistiche della validazione locale della SQL (non valide, correzioni, rifiuti)."""
+    check_admin_token(x_admin_token)
+    async with use_tenant(database) as tenant:
+        return tenant.sql_guard.stats()
+
+@router.get("/admin/coalescing/stats")
+async def coalescing_stats(x_admin_token: str = Header(None)):
+    """Richieste accorpate per domanda e per SQL (leader, follower, tempo risparmiato)."""
+    check_admin_token(x_admin_token)
+    return {"question": question_flight.stats(), "sql": sql_flight.stats()}
+
+@router.get("/admin/db-pool/stats")
+async def db_pool_stats(database: Optional[str] = None, x_admin_token: str = Header(None)):
+    """Stato dei pool di connessioni (in uso, libere, attese, timeout) e query per destinazione."""
+    check_admin_token(x_admin_token)
+    async with use_tenant(database) as tenant:
+        return tenant.engines.stats()
+
+@router.get("/admin/workload/stats")
+async def workload_stats(x_admin_token: str = Header(None)):
+    """Statistiche del registro del carico (T2DB_WORKLOAD_LOG)."""
+    check_admin_token(x_admin_token)
+    if workload_log is None:
+        return {"enabled": False}
+    return workload_log.stats()
+
+@router.get("/admin/tenants/stats")
+async def tenants_stats(x_admin_token: str = Header(None)):
+    """Database attivi, connessioni riservate, chiusure per inattivita' e richieste respinte."""
+    check_admin_token(x_admin_token)
+    return tenants.stats()
+
+# Riscaldamento in background all'avvio (T2DB_WARMUP=0 lo disattiva): schema in
+# cache, validatore della SQL, connessioni del pool e import differiti; /health
+# risponde subito, /ready solo quando e' finito
+WARMUP = os.getenv("T2DB_WARMUP", "1") == "1"
+# Connessioni da aprire in anticipo (0 = fino alla dimensione del pool, al massimo T2DB_DB_CONCURRENCY)
+WARMUP_CONNECTIONS = int(os.getenv("T2DB_WARMUP_CONNECTIONS", "0"))
+
+# Tempi di avvio in secondi dall'inizio dell'import: import, create_app, warmup, first_answer
+STARTUP_SECONDS = {"import": None}
+warmed_up = False
+
+def record_first_answer():
+    if STARTUP_SECONDS.get("first_answer") is None:
+        STARTUP_SECONDS["first_answer"] = time.perf_counter() - _import_started
+        logger.info(f"Prima risposta dopo {STARTUP_SECONDS['first_answer']:.2f} s dall'avvio.")
+
+def open_pool_connections(tenant):
+    """Apre in anticipo le connessioni di ogni pool (principale e replica) del database."""
+    opened = 0
+    for pool_engine, _ in tenant.engines.all():
+        pool_size = getattr(pool_engine.pool, "size", lambda: 1)()
+        opened += open_connections(pool_engine, WARMUP_CONNECTIONS or min(pool_size, DB_CONCURRENCY))
+    return opened
+
+async def warm_up():
+    """Prepara il database di default prima che il servizio risulti pronto.
+
+    Gira in background mentre il servizio accetta gia' connessioni; un errore
+    (es. database non raggiungibile) viene ritentato con attesa crescente fino
+    a 30 s, e nel frattempo /ready risponde 503.
+    """
+    global warmed_up
+    start = time.perf_counter()
+    delay = 1.0
+    while True:
+        try:
+            async with use_tenant(None) as tenant:
+                snapshot = await run_db(tenant.schema_catalog.get)
+                if tenant.sql_guard.enabled:
+                    await anyio.to_thread.run_sync(tenant.sql_guard.validator, snapshot)
+                opened = await run_db(open_pool_connections, tenant)
+            await anyio.to_thread.run_sync(importlib.import_module, "pandas")
+            break
+        except Exception as e:
+            logger.warning(f"Riscaldamento non completato, nuovo tentativo tra {delay:.0f} s: {e}")
+            await anyio.sleep(delay)
+            delay = min(delay * 2, 30.0)
+    warmed_up = True
+    STARTUP_SECONDS["warmup"] = time.perf_counter() - start
+    logger.info(
+        f"Riscaldamento completato in {STARTUP_SECONDS['warmup']:.2f} s: schema {snapshot.version}, "
+        f"{opened} connessioni aperte."
+    )
+
+async def evict_idle_tenants():
+    """Chiude periodicamente i database inutilizzati da T2DB_TENANT_IDLE_SECONDS."""
+    interval = min(60.0, tenants.idle_seconds / 2)
+    while True:
+        await anyio.sleep(interval)
+        try:
+            await anyio.to_thread.run_sync(tenants.evict_idle)
+        except Exception as e:
+            logger.warning(f"Chiusura dei database inattivi non riuscita: {e}")
+
+@asynccontextmanager
+async def lifespan(application):
+    # Il riscaldamento non ritarda l'avvio: uvicorn accetta connessioni (e /health risponde) subito
+    warmer = asyncio.ensure_future(warm_up()) if WARMUP else None
+    evictor = asyncio.ensure_future(evict_idle_tenants()) if tenants.idle_seconds > 0 else None
+    yield
+    for task in (warmer, evictor):
+        if task is not None:
+            task.cancel()
+    await close_llm_backends()
+    await anyio.to_thread.run_sync(tenants.close)
+    if workload_log is not None:
+        await anyio.to_thread.run_sync(workload_log.close)
+
+@router.get("/health")
+async def health():
+    """Processo attivo (liveness)."""
+    return {"status": "ok"}
+
+@router.get("/ready")
+async def ready():
+    """Servizio pronto (readiness): riscaldamento finito, schema del database di default caricato
+    e database raggiungibile. Durante il riscaldamento risponde 503 senza caricare lo schema."""
+    if WARMUP and not warmed_up:
+        return JSONResponse({"ready": False, "warmed_up": False}, status_code=503)
+    try:
+        async with use_tenant(None) as tenant:
+            snapshot = await run_db(tenant.schema_catalog.get)
+    except Exception as e:
+        return JSONResponse({"ready": False, "error": str(e)}, status_code=503)
+    return {"ready": True, "warmed_up": warmed_up, "schema_version": snapshot.version}
+
+def create_app():
+    """Crea l'applicazione FastAPI: verifica l'ambiente, crea i componenti e registra gli endpoint.
+
+    Uso: uvicorn --factory talk2db_service:create_app
+    """
+    start = time.perf_counter()
+    check_environment()
+    init_components()
+    application = FastAPI(lifespan=lifespan)
+    # Tempi per fase su /metrics e nell'header Server-Timing (T2DB_SERVER_TIMING=0 lo disattiva)
+    application.add_middleware(MetricsMiddleware, server_timing=os.getenv("T2DB_SERVER_TIMING", "1") == "1")
+    application.include_router(router)
+    if component_metrics not in REGISTRY.collectors:
+        REGISTRY.collectors.append(component_metrics)
+    STARTUP_SECONDS["create_app"] = time.perf_counter() - start
+    return application
+
+def __getattr__(name):
+    # "uvicorn talk2db_service:app" resta valido: l'applicazione viene creata al primo accesso
+    if name == "app":
+        global app
+        app = create_app()
+        return app
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+STARTUP_SECONDS["import"] = time.perf_counter() - _import_started
+
 if __name__ == "__main__":
     import uvicorn
-    uvicorn.run(app, host="0.0.0.0", port=8000)
+    uvicorn.run(create_app(), host="0.0.0.0", port=8000)
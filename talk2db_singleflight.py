@@ -0,0 +1,91 @@
+import asyncio
+import logging
+import time
+
+from talk2db_metrics import stage
+
+logger = logging.getLogger(__name__)
+
+
+class _Call:
+    def __init__(self, task):
+        self.task = task
+        self.started = time.perf_counter()
+        self.waiters = 0
+        self.followers = 0
+
+
+class SingleFlight:
+    """Accorpa le chiamate concorrenti con la stessa chiave in un'unica esecuzione.
+
+    La prima richiesta (leader) avvia il lavoro in un task condiviso; quelle
+    che arrivano mentre e' in corso (follower) ne attendono il risultato, o
+    l'eccezione, invece di ripeterlo. Se tutte le richieste in attesa vengono
+    annullate (timeout, client disconnessi) il task viene annullato a sua volta,
+    e con esso la chiamata LLM o la query in corso.
+
+    Va usato da un solo event loop: lo stato non e' protetto da lock.
+    """
+
+    def __init__(self, name, enabled=True):
+        self.name = name
+        self.enabled = enabled
+        self._calls = {}
+        self.leaders = 0
+        self.followers = 0
+        self.cancelled = 0
+        # Tempo di esecuzione risparmiato: durata del lavoro condiviso per ogni follower
+        self.saved_seconds = 0.0
+
+    def _finished(self, key, call):
+        if self._calls.get(key) is call:
+            del self._calls[key]
+        if call.followers and not call.task.cancelled():
+            self.saved_seconds += (time.perf_counter() - call.started) * call.followers
+
+    async def do(self, key, fn, *args):
+        """Esegue fn(*args) (una coroutine function) o si accoda all'esecuzione gia' in corso per key."""
+        if not self.enabled:
+            return await fn(*args)
+        call = self._calls.get(key)
+        if call is None:
+            # Il task eredita il contesto del leader (tempi per fase, query annullabile)
+            call = _Call(asyncio.ensure_future(fn(*args)))
+            call.task.add_done_callback(lambda task: self._finished(key, call))
+            self._calls[key] = call
+            self.leaders += 1
+            leader = True
+        else:
+            call.followers += 1
+            self.followers += 1
+            leader = False
+            logger.info(f"Richiesta accodata a un'esecuzione gia' in corso ({self.name}, {call.waiters} in attesa).")
+        call.waiters += 1
+        try:
+            if leader:
+                return await asyncio.shield(call.task)
+            with stage(f"coalesced_{self.name}"):
+                return await asyncio.shield(call.task)
+        finally:
+            call.waiters -= 1
+            if call.waiters == 0 and not call.task.done():
+                # Nessuno attende piu' il risultato: una nuova richiesta ripartira' da capo
+                if self._calls.get(key) is call:
+                    del self._calls[key]
+                call.task.cancel()
+                self.cancelled += 1
+
+    def waiting(self):
+        """Richieste in attesa su esecuzioni in corso."""
+        return sum(call.waiters for call in self._calls.values())
+
+    def stats(self):
+        return {
+            "enabled": self.enabled,
+            "in_flight": len(self._calls),
+            "waiting": self.waiting(),
+            "leaders": self.leaders,
+            "followers": self.followers,
+            "cancelled": self.cancelled,
+            "saved_seconds": round(self.saved_seconds, 3),
+        }
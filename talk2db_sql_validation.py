@@ -0,0 +1,321 @@
+import difflib
+import logging
+import re
+import threading
+import time
+from importlib.util import find_spec
+
+import anyio
+
+from talk2db_metrics import stage
+
+logger = logging.getLogger(__name__)
+
+# Dipendenza opzionale: senza, la SQL generata non viene validata localmente.
+# Importata solo alla creazione del primo validatore perche' rallenta l'avvio.
+SQLGLOT_AVAILABLE = find_spec("sqlglot") is not None
+sqlglot = exp = Scope = traverse_scope = None
+
+
+def _load_sqlglot():
+    global sqlglot, exp, Scope, traverse_scope
+    if sqlglot is None:
+        import sqlglot as module
+        from sqlglot import exp as expressions
+        from sqlglot.optimizer.scope import Scope as scope_class, traverse_scope as traverse
+        exp, Scope, traverse_scope = expressions, scope_class, traverse
+        sqlglot = module
+
+
+# Dialetto sqlglot per ciascun dialetto SQLAlchemy
+SQLGLOT_DIALECTS = {
+    "mssql": "tsql",
+    "sqlite": "sqlite",
+    "postgresql": "postgres",
+    "mysql": "mysql",
+    "oracle": "oracle",
+}
+
+# Oggetti di sistema, fuori dal catalogo ma sempre leggibili
+SYSTEM_SCHEMAS = {"sys", "information_schema"}
+# Istruzioni ammesse comunque: servono a preparare i parametri delle procedure
+VARIABLE_STATEMENTS = {"declare", "set"}
+
+_FENCE_RE = re.compile(r"```[ \t]*(?:t?sql)?[ \t]*\n?(.*?)```", re.IGNORECASE | re.DOTALL)
+
+
+def extract_sql(content):
+    """SQL dalla risposta del modello: il contenuto del primo blocco ``` se presente, altrimenti il testo intero."""
+    match = _FENCE_RE.search(content)
+    return (match.group(1) if match else content).strip()
+
+
+class SqlValidationError(Exception):
+    """La SQL generata non supera la validazione locale, nemmeno dopo i tentativi di correzione."""
+
+    def __init__(self, errors, sql):
+        super().__init__("SQL generata non valida: " + "; ".join(errors))
+        self.errors = errors
+        self.sql = sql
+
+
+def _suggest(name, candidates):
+    matches = difflib.get_close_matches(name.lower(), list(candidates), n=1, cutoff=0.75)
+    return f" Did you mean {candidates[matches[0]]}?" if matches else ""
+
+
+def statement_kind(statement):
+    """Tipo dell'istruzione: select, exec, declare, set, insert, update, select_into, ..."""
+    if isinstance(statement, exp.Select) and statement.args.get("into"):
+        return "select_into"
+    if isinstance(statement, exp.Query):
+        return "select"
+    if isinstance(statement, exp.Execute):
+        return "exec"
+    if isinstance(statement, exp.Command):
+        return str(statement.this).lower()
+    return type(statement).__name__.lower()
+
+
+class SqlValidator:
+    """Validazione di una SQL rispetto allo schema in cache, senza interrogare il database.
+
+    Controlla la sintassi nel dialetto del database, il tipo delle istruzioni
+    e l'esistenza di tabelle, colonne e procedure citate. I messaggi sono in
+    inglese perche' vengono rimandati al modello per la correzione.
+    """
+
+    def __init__(self, model, dialect="tsql", allowed_statements=("select", "exec")):
+        _load_sqlglot()
+        self.dialect = dialect
+        self.allowed_statements = set(allowed_statements)
+        # Nomi in minuscolo: il collation di default di SQL Server non distingue le maiuscole
+        self.tables = {name.lower(): table.name for name, table in model.tables.items()}
+        self.columns = {
+            name.lower(): {column.name.lower(): column.name for column in table.columns}
+            for name, table in model.tables.items()
+        }
+        self.procedures = {procedure.name.lower(): procedure.name for procedure in model.procedures}
+        # EXEC senza schema: accettato se il nome e' di una sola procedura (SQL Server risolve lo schema)
+        bare_names = {}
+        for procedure in model.procedures:
+            bare_names.setdefault(procedure.name.rsplit(".", 1)[-1].lower(), []).append(procedure.name)
+        for bare, names in bare_names.items():
+            if len(names) == 1:
+                self.procedures.setdefault(bare, names[0])
+
+    def validate(self, sql):
+        """Restituisce gli errori trovati (lista vuota se la SQL e' valida)."""
+        try:
+            statements = [statement for statement in sqlglot.parse(sql, read=self.dialect) if statement is not None]
+        except sqlglot.ParseError as e:
+            detail = e.errors[0] if e.errors else {}
+            position = f" at line {detail.get('line')}, column {detail.get('col')}" if detail.get("line") else ""
+            near = f" near '{detail.get('highlight')}'" if detail.get("highlight") else ""
+            return [f"Syntax error{position}{near}: {detail.get('description', e)}"]
+        if not statements:
+            return ["Empty statement."]
+
+        errors = []
+        for statement in statements:
+            kind = statement_kind(statement)
+            if "*" not in self.allowed_statements and kind not in self.allowed_statements | VARIABLE_STATEMENTS:
+                errors.append(
+                    f"{kind.upper()} statements are not allowed; only {', '.join(sorted(self.allowed_statements)).upper()} "
+                    f"can be used."
+                )
+                continue
+            if kind == "exec":
+                errors.extend(self._check_procedure(statement))
+            else:
+                errors.extend(self._check_tables(statement))
+                if kind == "select":
+                    errors.extend(self._check_columns(statement))
+        # Lo stesso errore ripetuto non aiuta la correzione
+        return list(dict.fromkeys(errors))
+
+    def _check_procedure(self, statement):
+        if isinstance(statement.this, exp.Table):
+            name = ".".join(part for part in (statement.this.db, statement.this.name) if part)
+        else:
+            name = str(statement.this)
+        if name.lower() in self.procedures:
+            return []
+        return [f"Unknown procedure {name}.{_suggest(name, self.procedures)}"]
+
+    def _check_tables(self, statement):
+        errors = []
+        ctes = {cte.alias_or_name.lower() for cte in statement.find_all(exp.CTE)}
+        for table in statement.find_all(exp.Table):
+            name = table.name
+            if (not name or table.this.args.get("temporary") or name.startswith(("#", "@"))
+                    or name.lower() in ctes or table.catalog or table.db.lower() in SYSTEM_SCHEMAS):
+                # Funzioni tabellari, tabelle temporanee o variabili, CTE, altri database, viste di sistema
+                continue
+            if name.lower() not in self.tables:
+                errors.append(f"Unknown table {table.sql(self.dialect)}.{_suggest(name, self.tables)}")
+        return errors
+
+    def _source_columns(self, source):
+        """Colonne esposte da una sorgente dello scope, None se non determinabili."""
+        if isinstance(source, exp.Table):
+            return self.columns.get(source.name.lower())
+        if isinstance(source, Scope) and isinstance(source.expression, exp.Query):
+            if any(isinstance(select, exp.Star) or isinstance(select.unalias(), exp.Star)
+                   for select in source.expression.selects):
+                return None
+            return {name.lower(): name for name in source.expression.named_selects}
+        return None
+
+    def _check_columns(self, statement):
+        errors = []
+        try:
+            scopes = traverse_scope(statement)
+        except Exception as e:
+            logger.debug(f"Analisi degli scope non riuscita, colonne non controllate: {e}")
+            return errors
+        for scope in scopes:
+            # Alias della select, citabili senza qualificatore (ORDER BY)
+            aliases = {
+                select.alias.lower() for select in getattr(scope.expression, "selects", [])
+                if isinstance(select, exp.Alias)
+            }
+            for column in scope.columns:
+                name = column.name
+                if not name or isinstance(column.this, exp.Star):
+                    continue
+                if column.find_ancestor(exp.Select) is not scope.expression:
+                    # Colonna di una sottoquery: controllata nello scope della sottoquery
+                    continue
+                if column.table:
+                    errors.extend(self._check_qualified(scope, column))
+                elif name.lower() not in aliases:
+                    errors.extend(self._check_unqualified(scope, column))
+        return errors
+
+    def _check_qualified(self, scope, column):
+        qualifier = column.table
+        current = scope
+        while current is not None:
+            source = current.sources.get(qualifier) or next(
+                (value for key, value in current.sources.items() if key.lower() == qualifier.lower()), None
+            )
+            if source is not None:
+                columns = self._source_columns(source)
+                if columns is None or column.name.lower() in columns:
+                    return []
+                owner = source.name if isinstance(source, exp.Table) else qualifier
+                return [f"Unknown column {column.name} in {owner} ({qualifier}).{_suggest(column.name, columns)}"]
+            # Sottoquery correlate: l'alias puo' appartenere alla query esterna
+            current = current.parent if current.is_subquery else None
+        return [f"Unknown table or alias {qualifier} in {column.sql(self.dialect)}."]
+
+    def _check_unqualified(self, scope, column):
+        candidates = {}
+        current = scope
+        while current is not None:
+            owners = []
+            for alias, source in current.sources.items():
+                columns = self._source_columns(source)
+                if columns is None:
+                    # Una sorgente di cui non si conoscono le colonne potrebbe contenerla
+                    return []
+                if column.name.lower() in columns:
+                    owners.append(alias)
+                candidates.update(columns)
+            if len(owners) > 1:
+                return [f"Ambiguous column {column.name}: it exists in {', '.join(owners)}; qualify it with the table alias."]
+            if owners:
+                return []
+            # Sottoquery correlate: la colonna puo' appartenere alla query esterna
+            current = current.parent if current.is_subquery else None
+        if not candidates:
+            return []
+        return [f"Unknown column {column.name}.{_suggest(column.name, candidates)}"]
+
+
+class SqlGuard:
+    """Validazione della SQL generata con un numero limitato di correzioni da parte del modello.
+
+    Il validatore e' costruito una volta per versione dello schema; se sqlglot
+    non e' installato la validazione e' disattivata.
+    """
+
+    def __init__(self, dialect, enabled=True, allowed_statements=("select", "exec"), repair_attempts=2):
+        self.dialect = dialect
+        self.enabled = enabled and SQLGLOT_AVAILABLE and dialect is not None
+        if enabled and not self.enabled:
+            logger.info("Validazione locale della SQL non disponibile (sqlglot non installato o dialetto non supportato).")
+        self.allowed_statements = tuple(allowed_statements)
+        self.repair_attempts = repair_attempts
+        self._validator = None
+        self._lock = threading.Lock()
+        # check gira nei thread di anyio: contatori aggiornati sotto un lock a parte
+        self._stats_lock = threading.Lock()
+        self.checks = 0
+        self.invalid = 0
+        self.repairs = 0
+        self.repaired = 0
+        self.rejected = 0
+        self.total_ms = 0.0
+
+    def validator(self, snapshot):
+        with self._lock:
+            if self._validator is None or self._validator[0] != snapshot.version:
+                self._validator = (
+                    snapshot.version,
+                    SqlValidator(snapshot.model, self.dialect, self.allowed_statements),
+                )
+            return self._validator[1]
+
+    def check(self, snapshot, sql):
+        """Errori della SQL rispetto allo schema dello snapshot (lista vuota se valida o se disattivata)."""
+        if not self.enabled:
+            return []
+        start = time.perf_counter()
+        with stage("sql_validate"):
+            errors = self.validator(snapshot).validate(sql)
+        with self._stats_lock:
+            self.total_ms += (time.perf_counter() - start) * 1000
+            self.checks += 1
+            if errors:
+                self.invalid += 1
+        return errors
+
+    async def generate(self, snapshot, generate):
+        """SQL prodotta da generate(repair), validata e, se serve, corretta.
+
+        generate e' una coroutine function: riceve None alla prima chiamata e
+        (sql precedente, errori) per le correzioni. Dopo repair_attempts
+        correzioni senza successo solleva SqlValidationError: la SQL non
+        raggiunge mai il database. La validazione (parsing e costruzione del
+        validatore) gira in un thread, non sull'event loop.
+        """
+        sql = await generate(None)
+        for attempt in range(self.repair_attempts + 1):
+            errors = await anyio.to_thread.run_sync(self.check, snapshot, sql)
+            if not errors:
+                if attempt:
+                    self.repaired += 1
+                return sql
+            logger.warning(f"SQL generata non valida (tentativo {attempt + 1}): {'; '.join(errors)}")
+            if attempt == self.repair_attempts:
+                break
+            self.repairs += 1
+            sql = await generate((sql, errors))
+        self.rejected += 1
+        raise SqlValidationError(errors, sql)
+
+    def stats(self):
+        return {
+            "enabled": self.enabled,
+            "dialect": self.dialect,
+            "allowed_statements": list(self.allowed_statements),
+            "repair_attempts": self.repair_attempts,
+            "checks": self.checks,
+            "invalid": self.invalid,
+            "repairs": self.repairs,
+            "repaired": self.repaired,
+            "rejected": self.rejected,
+            "avg_ms": round(self.total_ms / self.checks, 3) if self.checks else None,
+        }
@@ -0,0 +1,111 @@
+import asyncio
+import logging
+
+import anyio
+import anyio.from_thread
+from sqlalchemy import text
+
+from talk2db_cancellation import QueryHandle, current_query
+from talk2db_metrics import stage
+
+logger = logging.getLogger(__name__)
+
+_END = object()
+
+
+class QueryStream:
+    """Esegue una query con cursore lato server in un thread e consegna i lotti di righe all'event loop.
+
+    Il buffer tra thread e consumatore contiene al massimo buffer_batches
+    lotti: se il client legge lentamente il thread si ferma, quindi la
+    memoria resta costante qualunque sia la dimensione del risultato.
+    """
+
+    def __init__(self, engine, query, batch_size=500, limiter=None, buffer_batches=2):
+        self.engine = engine
+        self.query = query
+        self.batch_size = batch_size
+        self.limiter = limiter
+        self.columns = None
+        # Descrizione DB-API del cursore (tipi delle colonne), disponibile dopo start()
+        self.description = None
+        self.row_count = 0
+        self._send, self._receive = anyio.create_memory_object_stream(buffer_batches)
+        self._task = None
+        self._handle = QueryHandle()
+
+    def _run(self):
+        def send(item):
+            anyio.from_thread.run(self._send.send, item)
+
+        with self.engine.connect() as connection:
+            logger.info(f"Esecuzione della query in streaming: {self.query}")
+            with stage("db_execute"):
+                result = connection.execution_options(stream_results=True, yield_per=self.batch_size).execute(
+                    text(self.query)
+                )
+            if result.returns_rows:
+                self.description = result.cursor.description
+            send(list(result.keys()) if result.returns_rows else [])
+            if result.returns_rows:
+                partitions = result.partitions(self.batch_size)
+                while True:
+                    with stage("db_fetch"):
+                        partition = next(partitions, None)
+                    if partition is None:
+                        break
+                    send(partition)
+
+    async def _produce(self):
+        # Il task ha un proprio contesto: il thread della query eredita l'handle
+        current_query.set(self._handle)
+        try:
+            await anyio.to_thread.run_sync(self._run, limiter=self.limiter)
+            await self._send.send(_END)
+        except (anyio.BrokenResourceError, anyio.ClosedResourceError):
+            # Il consumatore ha chiuso lo stream (client disconnesso)
+            logger.info("Streaming interrotto dal client.")
+        except Exception as e:
+            try:
+                await self._send.send(e)
+            except (anyio.BrokenResourceError, anyio.ClosedResourceError):
+                pass
+        finally:
+            self._send.close()
+
+    async def _next(self):
+        item = await self._receive.receive()
+        if isinstance(item, Exception):
+            raise item
+        return item
+
+    async def start(self):
+        """Avvia la query e attende i nomi delle colonne; solleva subito gli errori di esecuzione."""
+        self._task = asyncio.create_task(self._produce())
+        try:
+            self.columns = await self._next()
+        except BaseException:
+            await self.aclose()
+            raise
+        return self.columns
+
+    async def batches(self):
+        """Lotti di righe nell'ordine in cui arrivano dal database."""
+        try:
+            while True:
+                batch = await self._next()
+                if batch is _END:
+                    break
+                self.row_count += len(batch)
+                yield batch
+        finally:
+            await self.aclose()
+
+    async def aclose(self):
+        self._receive.close()
+        if self._task is not None:
+            if not self._task.done():
+                # Consumatore chiuso prima della fine: interrompe la query sul database
+                self._handle.cancel()
+            await self._task
+            self._task = None
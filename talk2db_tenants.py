@@ -0,0 +1,213 @@
+import logging
+import threading
+import time
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+
+class UnknownTenant(Exception):
+    """Il database richiesto non e' tra quelli configurati."""
+
+
+class TenantLimitExceeded(Exception):
+    """Nessun posto per un altro database attivo: limiti di database o di connessioni raggiunti."""
+
+
+class Tenant:
+    """Risorse di un database servito: motori, schema in cache, validatore e controllo dei costi.
+
+    connections e' il numero massimo di connessioni che i suoi pool possono
+    aprire, riservato sul budget globale finche' il tenant resta attivo.
+    """
+
+    def __init__(self, name, engines, schema_catalog, sql_guard, cost_gate, connections=0):
+        self.name = name
+        self.engines = engines
+        self.schema_catalog = schema_catalog
+        self.sql_guard = sql_guard
+        self.cost_gate = cost_gate
+        self.connections = connections
+        self.created_at = time.time()
+        self.last_used = time.monotonic()
+        # Richieste in corso: un tenant in uso non viene mai rimosso
+        self.active = 0
+        self.requests = 0
+        # Ultima versione dello schema vista, per riconoscere le modifiche
+        self.schema_version = None
+
+    @property
+    def engine(self):
+        """Motore principale: catalogo, sonde dello schema, piani stimati."""
+        return self.engines.primary
+
+    def close(self):
+        """Chiude le connessioni dei pool."""
+        for engine, _ in self.engines.all():
+            engine.dispose()
+
+    def stats(self):
+        return {
+            "active": self.active,
+            "requests": self.requests,
+            "idle_seconds": round(time.monotonic() - self.last_used, 1) if not self.active else 0,
+            "connections": self.connections,
+            "schema_version": self.schema_version,
+        }
+
+
+class TenantRegistry:
+    """Database serviti dallo stesso processo, creati alla prima richiesta.
+
+    factory(nome) crea il Tenant; solo i nomi in names sono accettati. Al
+    massimo max_tenants database restano attivi e la somma delle connessioni
+    riservate non supera max_connections (0 = nessun limite): per fare posto
+    viene rimosso il tenant inutilizzato da piu' tempo, e se sono tutti in uso
+    la richiesta viene respinta. evict_idle() chiude quelli fermi da piu' di
+    idle_seconds. Il database di default non viene mai rimosso: resta pronto
+    con schema, validatore e pool gia' caldi.
+    """
+
+    def __init__(self, factory, names, default, max_tenants=16, max_connections=0, idle_seconds=600):
+        self.factory = factory
+        self.names = list(names)
+        self.default = default
+        self.max_tenants = max_tenants
+        self.max_connections = max_connections
+        self.idle_seconds = idle_seconds
+        self._tenants = {}
+        self._lock = threading.Lock()
+        self.created = 0
+        self.evicted = 0
+        self.rejected = 0
+
+    def resolve(self, name):
+        """Nome del database da usare: quello richiesto o quello di default."""
+        name = name or self.default
+        if name not in self.names:
+            raise UnknownTenant(f"Database non configurato: {name}")
+        return name
+
+    def reserved_connections(self):
+        return sum(tenant.connections for tenant in self._tenants.values())
+
+    def _evict(self, tenant, reason):
+        """Toglie il tenant dal registro (sotto il lock); le connessioni si chiudono poi con _close."""
+        del self._tenants[tenant.name]
+        self.evicted += 1
+        logger.info(f"Database {tenant.name} rimosso ({reason}).")
+        return tenant
+
+    @staticmethod
+    def _close(tenants):
+        # Fuori dal lock: dispose() dei pool fa I/O di rete e acquire() non deve aspettarlo
+        for tenant in tenants:
+            try:
+                tenant.close()
+            except Exception as e:
+                logger.warning(f"Chiusura delle connessioni di {tenant.name} non riuscita: {e}")
+
+    def _make_room(self, connections, evicted):
+        """Rimuove i tenant inutilizzati meno recenti finche' c'e' posto per uno nuovo.
+
+        I tenant rimossi vanno in evicted, da chiudere fuori dal lock.
+        """
+
+        def full():
+            if self.max_tenants and len(self._tenants) >= self.max_tenants:
+                return True
+            return bool(self.max_connections) and self.reserved_connections() + connections > self.max_connections
+
+        while full():
+            idle = [tenant for tenant in self._tenants.values()
+                    if tenant.active == 0 and tenant.name != self.default]
+            if not idle:
+                self.rejected += 1
+                raise TenantLimitExceeded(
+                    f"Limite di database attivi ({self.max_tenants}) o di connessioni ({self.max_connections}) "
+                    f"raggiunto e tutti i database sono in uso"
+                )
+            evicted.append(self._evict(min(idle, key=lambda tenant: tenant.last_used), "meno recente"))
+
+    def acquire(self, name=None):
+        """Tenant del database (creato se serve), segnato in uso fino a release()."""
+        name = self.resolve(name)
+        evicted = []
+        try:
+            with self._lock:
+                tenant = self._tenants.get(name)
+                if tenant is None:
+                    tenant = self.factory(name)
+                    try:
+                        self._make_room(tenant.connections, evicted)
+                    except TenantLimitExceeded:
+                        evicted.append(tenant)
+                        raise
+                    self._tenants[name] = tenant
+                    self.created += 1
+                    logger.info(f"Database {name} attivato ({len(self._tenants)} attivi).")
+                tenant.active += 1
+                tenant.requests += 1
+                tenant.last_used = time.monotonic()
+                return tenant
+        finally:
+            self._close(evicted)
+
+    def release(self, tenant):
+        with self._lock:
+            tenant.active -= 1
+            tenant.last_used = time.monotonic()
+
+    @contextmanager
+    def use(self, name=None):
+        tenant = self.acquire(name)
+        try:
+            yield tenant
+        finally:
+            self.release(tenant)
+
+    def get(self, name=None):
+        """Tenant gia' attivo, senza crearlo ne' segnarlo in uso (None se non attivo)."""
+        return self._tenants.get(self.resolve(name))
+
+    def live(self):
+        with self._lock:
+            return list(self._tenants.values())
+
+    def schema_versions(self, exclude=None):
+        """Versioni dello schema dei tenant attivi (escluso eventualmente uno)."""
+        return {tenant.schema_version for tenant in self.live() if tenant is not exclude and tenant.schema_version}
+
+    def evict_idle(self):
+        """Chiude i tenant fermi da piu' di idle_seconds (mai quello di default); restituisce i nomi rimossi."""
+        if not self.idle_seconds:
+            return []
+        now = time.monotonic()
+        with self._lock:
+            idle = [self._evict(tenant, f"inattivo da {self.idle_seconds:g} s")
+                    for tenant in list(self._tenants.values())
+                    if tenant.active == 0 and tenant.name != self.default
+                    and now - tenant.last_used >= self.idle_seconds]
+        self._close(idle)
+        return [tenant.name for tenant in idle]
+
+    def close(self):
+        with self._lock:
+            tenants = [self._evict(tenant, "arresto del servizio") for tenant in list(self._tenants.values())]
+        self._close(tenants)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "configured": len(self.names),
+                "default": self.default,
+                "live": len(self._tenants),
+                "max_tenants": self.max_tenants,
+                "reserved_connections": self.reserved_connections(),
+                "max_connections": self.max_connections,
+                "idle_seconds": self.idle_seconds,
+                "created": self.created,
+                "evicted": self.evicted,
+                "rejected": self.rejected,
+                "tenants": {name: tenant.stats() for name, tenant in sorted(self._tenants.items())},
+            }
@@ -0,0 +1,289 @@
+import glob
+import hashlib
+import json
+import logging
+import os
+import queue
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from talk2db_metrics import RequestTimings, current_timings
+from talk2db_pagination import PageRequest, fetch_page
+from talk2db_question_cache import normalize_question
+from talk2db_result_cache import is_read_only, normalize_sql
+
+logger = logging.getLogger(__name__)
+
+# Fasi che misurano il lavoro sul database (attesa del pool esclusa)
+DB_STAGES = ("db_execute", "db_fetch")
+
+
+def question_hash(question):
+    """Impronta della domanda normalizzata: raggruppa le domande ripetute senza registrarne il testo."""
+    return hashlib.sha256(normalize_question(question)[0].encode("utf-8")).hexdigest()[:16]
+
+
+def _ms(stages, *names):
+    values = [stages[name] for name in names if name in stages]
+    return round(sum(values), 3) if values else None
+
+
+class WorkloadLog:
+    """Registro del carico: una riga JSON compatta per richiesta, con rotazione per dimensione.
+
+    Come RotatingFileHandler, oltre max_bytes il file diventa path.1 (e cosi'
+    via fino a backups). Con piu' worker il percorso puo' contenere {pid}, cosi'
+    ogni processo scrive e ruota il proprio file. sample_rate < 1 registra
+    solo una parte delle richieste.
+
+    write() accoda soltanto: scrittura, flush e rotazione avvengono in un
+    thread dedicato, cosi' la latenza del disco non ferma l'event loop.
+    """
+
+    def __init__(self, path, max_bytes=50 * 1024 * 1024, backups=5, sample_rate=1.0):
+        self.path = path.replace("{pid}", str(os.getpid()))
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self.sample_rate = sample_rate
+        self._lock = threading.Lock()
+        self._file = None
+        self._queue = queue.SimpleQueue()
+        self._writer = None
+        self.records = 0
+        self.rotations = 0
+        self.errors = 0
+
+    def _open(self):
+        if self._file is None:
+            directory = os.path.dirname(os.path.abspath(self.path))
+            os.makedirs(directory, exist_ok=True)
+            self._file = open(self.path, "a", encoding="utf-8")
+        return self._file
+
+    def _rotate(self):
+        self._file.close()
+        self._file = None
+        if self.backups > 0:
+            for index in range(self.backups - 1, 0, -1):
+                source = f"{self.path}.{index}"
+                if os.path.exists(source):
+                    os.replace(source, f"{self.path}.{index + 1}")
+            os.replace(self.path, f"{self.path}.1")
+        else:
+            os.remove(self.path)
+        self.rotations += 1
+
+    def write(self, record):
+        """Accoda il record per il thread di scrittura (avviato alla prima richiesta)."""
+        if self._writer is None:
+            with self._lock:
+                if self._writer is None:
+                    self._writer = threading.Thread(target=self._run, name="workload-log", daemon=True)
+                    self._writer.start()
+        self._queue.put(record)
+
+    def _run(self):
+        while True:
+            record = self._queue.get()
+            if record is None:
+                return
+            self._write(record)
+
+    def _write(self, record):
+        line = json.dumps(record, separators=(",", ":"), ensure_ascii=False, default=str) + "\n"
+        with self._lock:
+            try:
+                f = self._open()
+                if self.max_bytes and f.tell() and f.tell() + len(line) > self.max_bytes:
+                    self._rotate()
+                    f = self._open()
+                f.write(line)
+                # Riga completa subito su disco: il registro si puo' leggere mentre il servizio gira
+                f.flush()
+                self.records += 1
+            except OSError as e:
+                # Il registro non deve mai far fallire una richiesta
+                self.errors += 1
+                logger.warning(f"Scrittura del registro del carico non riuscita: {e}")
+
+    def capture(self, timings, question=None, **fields):
+        """Registra una richiesta con i tempi per fase presi da RequestTimings (se presente)."""
+        if self.sample_rate < 1 and random.random() >= self.sample_rate:
+            return
+        stages = dict(timings.stages) if timings is not None else {}
+        record = {"ts": round(time.time(), 3)}
+        record.update(fields)
+        record.update(
+            question_hash=question_hash(question) if question else None,
+            llm_ms=_ms(stages, "llm"),
+            db_ms=_ms(stages, *DB_STAGES),
+            total_ms=round(timings.elapsed_ms(), 3) if timings is not None else None,
+            # Da dove arriva il risultato: database, cache dei risultati o esecuzione condivisa
+            source=(
+                "coalesced" if any(name.startswith("coalesced") for name in stages)
+                else "db" if any(name in stages for name in DB_STAGES)
+                else "result_cache" if "result_cache" in stages
+                else None
+            ),
+        )
+        self.write(record)
+
+    def close(self):
+        """Scrive i record ancora in coda e chiude il file."""
+        writer = self._writer
+        if writer is not None:
+            self._queue.put(None)
+            writer.join()
+            self._writer = None
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+    def stats(self):
+        return {
+            "path": self.path,
+            "records": self.records,
+            "pending": self._queue.qsize(),
+            "rotations": self.rotations,
+            "errors": self.errors,
+            "max_bytes": self.max_bytes,
+            "backups": self.backups,
+            "sample_rate": self.sample_rate,
+        }
+
+
+def load_workload(patterns):
+    """Richieste registrate dai file (anche ruotati, es. "workload.log*"), in ordine di tempo."""
+    records = []
+    paths = sorted({path for pattern in patterns for path in glob.glob(pattern)})
+    for path in paths:
+        with open(path, encoding="utf-8") as f:
+            for number, line in enumerate(f, 1):
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    records.append(json.loads(line))
+                except ValueError:
+                    # Ultima riga troncata da un arresto brusco
+                    logger.warning(f"Riga {number} di {path} non valida, ignorata.")
+    records.sort(key=lambda record: record.get("ts") or 0)
+    return records
+
+
+def replayable(records, database=None, include_writes=False):
+    """Richieste riuscite con SQL, eventualmente di un solo database; le scritture solo se richieste."""
+    selected = []
+    for record in records:
+        sql = record.get("sql")
+        if not sql or record.get("status", 200) != 200:
+            continue
+        if database is not None and record.get("database") != database:
+            continue
+        if not include_writes and not is_read_only(sql):
+            continue
+        selected.append(record)
+    return selected
+
+
+def _replay_one(engine, record):
+    """Esegue la richiesta registrata: la stessa pagina per /question e /question/page, tutto per lo stream."""
+    timings = RequestTimings()
+    token = current_timings.set(timings)
+    result = {"record": record, "error": None, "rows": 0}
+    try:
+        page = dict(record.get("page") or {})
+        if record.get("endpoint") == "stream":
+            # Lo stream legge tutte le righe: una pagina grande quanto quelle registrate
+            page = {"page_size": max(record.get("rows") or 0, 1)}
+        page.pop("sql", None)
+        page.pop("database", None)
+        page.setdefault("page_size", 1000)
+        rows = fetch_page(engine, PageRequest(record["sql"], **page)).rows
+        result["rows"] = len(rows)
+    except Exception as e:
+        result["error"] = str(e).splitlines()[0][:300] if str(e) else type(e).__name__
+    finally:
+        current_timings.reset(token)
+    result["db_ms"] = _ms(timings.stages, *DB_STAGES)
+    result["total_ms"] = round(timings.elapsed_ms(), 3)
+    return result
+
+
+def replay_workload(engine, records, concurrency=4, speedup=1.0):
+    """Riesegue le richieste sul motore rispettando gli intervalli registrati divisi per speedup
+    (0 = tutte subito), con al massimo concurrency query in corso.
+
+    Restituisce un risultato per richiesta, con il ritardo rispetto al programma
+    (lag_ms) quando la concorrenza non basta a tenere il ritmo.
+    """
+    if not records:
+        return []
+    origin = records[0].get("ts") or 0
+    started = time.perf_counter()
+    futures = []
+
+    def run(record, due):
+        lag = (time.perf_counter() - started - due) * 1000
+        result = _replay_one(engine, record)
+        result["lag_ms"] = round(max(lag, 0.0), 3)
+        return result
+
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        for record in records:
+            due = ((record.get("ts") or origin) - origin) / speedup if speedup > 0 else 0.0
+            delay = due - (time.perf_counter() - started)
+            if delay > 0:
+                time.sleep(delay)
+            futures.append(executor.submit(run, record, due))
+        return [future.result() for future in futures]
+
+
+def find_regressions(results, factor=1.5, min_ms=5.0):
+    """Richieste piu' lente di factor volte rispetto alla registrazione (e di almeno min_ms), dalla peggiore."""
+    regressions = []
+    for result in results:
+        captured = result["record"].get("db_ms")
+        replayed = result.get("db_ms")
+        if result["error"] or captured is None or replayed is None:
+            continue
+        if replayed >= captured * factor and replayed - captured >= min_ms:
+            regressions.append({**result, "captured_ms": captured, "ratio": replayed / captured if captured else None})
+    regressions.sort(key=lambda item: item["db_ms"] - item["captured_ms"], reverse=True)
+    return regressions
+
+
+def top_statements(results, limit=10):
+    """Istruzioni generate piu' costose durante la replica, per SQL normalizzata e tempo totale."""
+    groups = {}
+    for result in results:
+        key = normalize_sql(result["record"]["sql"])
+        group = groups.setdefault(key, {
+            "sql": result["record"]["sql"], "executions": 0, "errors": 0, "total_ms": 0.0, "max_ms": 0.0,
+            "captured_total_ms": 0.0, "captured": 0, "rows": 0, "databases": set(),
+        })
+        group["executions"] += 1
+        group["databases"].add(result["record"].get("database"))
+        if result["error"]:
+            group["errors"] += 1
+            group["last_error"] = result["error"]
+            continue
+        elapsed = result.get("db_ms") or 0.0
+        group["total_ms"] += elapsed
+        group["max_ms"] = max(group["max_ms"], elapsed)
+        if result["record"].get("db_ms") is not None:
+            group["captured_total_ms"] += result["record"]["db_ms"]
+            group["captured"] += 1
+        group["rows"] += result["rows"]
+    ranked = sorted(groups.values(), key=lambda group: group["total_ms"], reverse=True)[:limit]
+    for group in ranked:
+        group["databases"] = sorted(name for name in group["databases"] if name)
+        successes = group["executions"] - group["errors"]
+        group["avg_ms"] = group["total_ms"] / successes if successes else None
+        # Media registrata solo sulle esecuzioni arrivate al database (non dalla cache)
+        group["captured_avg_ms"] = group.pop("captured_total_ms") / group["captured"] if group["captured"] else None
+        del group["captured"]
+    return ranked